@@ -3,33 +3,52 @@ import { Spotify } from '../shared/lib/spotify';
 import { IO } from '../shared/lib/IO';
 
 async function main() {
-	const logger = new ProgressLogger('beat aggregation', 6);
+	const logger = new ProgressLogger('beat aggregation', 7);
 
 	// Get input
 	const input = await IO.Input.getInput();
 	logger.increment('input');
 
-	// Get spotify client secret
-	const secrets = await Spotify.Connection.createSpotifyConnection();
-	logger.increment('spotify connection');
-
 	// Asserting URIs for fetching
 	const URIs = Spotify.GetTrackURIs.assertURIs(input);
 	logger.increment('URIs');
 
+	// Tracks analysed by an earlier run are skipped
+	const writer = await IO.Output.AnalysisWriter.open();
+	const missing = URIs.filter((uri) => !writer.has(uri));
+	console.log(
+		`${URIs.length - missing.length}/${URIs.length} tracks were analysed before`
+	);
+	logger.increment('earlier analyses');
+
+	if (missing.length === 0) {
+		logger.increment('spotify connection (not needed)');
+		logger.increment('tracks (not needed)');
+		logger.increment('analysis (not needed)');
+		logger.increment('write to disk (not needed)');
+		logger.done();
+		return;
+	}
+
+	// Get spotify client secret
+	const secrets = await Spotify.Connection.createSpotifyConnection();
+	logger.increment('spotify connection');
+
 	// Fetch track details
-	const tracks = await Spotify.Playing.getTracks(URIs, secrets);
+	const tracks = await Spotify.Playing.getTracks(missing, secrets);
 	const trackNameMap: Map<string, string> = new Map(
 		tracks.map((t) => [t.uri, t.name])
 	);
-	logger.increment('analysis');
+	logger.increment('tracks');
 
-	// Fetch audio analysis
-	const analyses = await Spotify.Analysis.get(secrets, URIs, trackNameMap);
+	// Fetch audio analysis, written to disk as it comes in
+	await Spotify.Analysis.get(secrets, missing, trackNameMap, (analysis) =>
+		writer.add(analysis)
+	);
 	logger.increment('analysis');
 
-	// Write to disk
-	await IO.Output.exportAnalyses(analyses);
+	// Write the rest to disk
+	await writer.write();
 	logger.increment('write to disk');
 
 	logger.done();
@@ -10,6 +10,7 @@ import * as fs from 'fs-extra';
 import * as glob from 'glob';
 import * as http from 'http';
 import * as path from 'path';
+import * as os from 'os';
 
 interface HTTPServer {
 	server: http.Server;
@@ -31,6 +32,8 @@ interface PuppetGlobal extends Window {
 const HOST_PATH = '__webserver__';
 const PORT = 5123;
 const BINS = 100;
+// The .npy header is padded so the data that follows it is aligned
+const NPY_ALIGNMENT = 64;
 
 namespace BinGenerator {
 	namespace Util {
@@ -109,10 +112,13 @@ namespace BinGenerator {
 				outDir: string;
 				interval: number;
 				inFiles: string[];
+				json: boolean;
 			}
 
 			export async function getIO() {
-				const io: Partial<IO> = {};
+				const io: Partial<IO> = {
+					json: false,
+				};
 
 				let inFileGlobs: string[] = [];
 
@@ -129,6 +135,8 @@ namespace BinGenerator {
 							arg.slice('--interval='.length),
 							10
 						);
+					} else if (arg === '--json') {
+						io.json = true;
 					} else {
 						inFileGlobs.push(arg);
 					}
@@ -208,21 +216,60 @@ namespace BinGenerator {
 				return file.split('.').slice(0, -1).join('.');
 			}
 
-			function getFileOutPath(io: IO.Input.IO, { file }: BinFile) {
+			function getFileOutPath(
+				io: IO.Input.IO,
+				{ file }: BinFile,
+				ext: string = 'npy'
+			) {
 				return path.join(
 					io.outDir,
-					`${removeExt(path.basename(file))}.bins.json`
+					`${removeExt(path.basename(file))}.bins.${ext}`
 				);
 			}
 
+			/**
+			 * Packs the bins into a float32 .npy file, which python
+			 * can memory-map instead of parsing
+			 */
+			export function toNpy(data: number[][]): Buffer {
+				const values = new Float32Array(data.length * BINS);
+				data.forEach((row, i) => {
+					values.set(row.slice(0, BINS), i * BINS);
+				});
+
+				const descr = os.endianness() === 'LE' ? '<f4' : '>f4';
+				// Magic string, version and header length
+				const preamble = 10;
+				let header = `{'descr': '${descr}', 'fortran_order': False, 'shape': (${data.length}, ${BINS}), }`;
+				const headerEnd =
+					Math.ceil((preamble + header.length + 1) / NPY_ALIGNMENT) *
+					NPY_ALIGNMENT;
+				header = header.padEnd(headerEnd - preamble - 1, ' ') + '\n';
+
+				const start = Buffer.alloc(headerEnd);
+				start.write('\x93NUMPY', 0, 'latin1');
+				start.writeUInt8(1, 6);
+				start.writeUInt8(0, 7);
+				start.writeUInt16LE(header.length, 8);
+				start.write(header, preamble, 'latin1');
+				return Buffer.concat([start, Buffer.from(values.buffer)]);
+			}
+
 			export async function writeBin(io: IO.Input.IO, binFile: BinFile) {
 				await fs.writeFile(
 					getFileOutPath(io, binFile),
-					JSON.stringify(binFile.data),
-					{
-						encoding: 'utf8',
-					}
+					toNpy(binFile.data)
 				);
+				if (io.json) {
+					// For tools that still read the old text format
+					await fs.writeFile(
+						getFileOutPath(io, binFile, 'json'),
+						JSON.stringify(binFile.data),
+						{
+							encoding: 'utf8',
+						}
+					);
+				}
 			}
 
 			export async function writeBins(
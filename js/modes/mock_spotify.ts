@@ -0,0 +1,79 @@
+import * as express from 'express';
+
+// Run the aggregators against it with
+// SPOTIFY_API_URL=http://localhost:1271/v1 SPOTIFY_ACCESS_TOKEN=mock
+const PORT = ~~(process.env.MOCK_PORT || 1271);
+// Every this many requests gets a 429, so the backoff gets exercised too
+const RATE_LIMIT_EVERY = ~~(process.env.MOCK_RATE_LIMIT_EVERY || 10);
+const TRACK_DURATION = 30;
+
+namespace MockSpotify {
+	let requests: number = 0;
+
+	function getTempo(id: string) {
+		// Different per track, but the same every run
+		let hash = 0;
+		for (let i = 0; i < id.length; i++) {
+			hash = (hash * 31 + id.charCodeAt(i)) % 1000;
+		}
+		return 80 + (hash % 80);
+	}
+
+	function getTrack(id: string) {
+		return {
+			id,
+			uri: `spotify:track:${id}`,
+			name: `Mock track ${id}`,
+			duration_ms: TRACK_DURATION * 1000,
+		};
+	}
+
+	function getAnalysis(id: string) {
+		const tempo = getTempo(id);
+		const beats = new Array(Math.floor((TRACK_DURATION * tempo) / 60))
+			.fill(null)
+			.map((_, i) => ({
+				start: (i * 60) / tempo,
+				duration: 60 / tempo,
+				confidence: 0.8,
+			}));
+		return {
+			track: { duration: TRACK_DURATION, tempo },
+			bars: [],
+			beats,
+			tatums: [],
+			sections: [],
+			segments: [],
+		};
+	}
+
+	export function start() {
+		const app = express();
+		app.use((req, res, next) => {
+			requests++;
+			if (RATE_LIMIT_EVERY > 0 && requests % RATE_LIMIT_EVERY === 0) {
+				console.log(`429 ${req.url}`);
+				res.status(429).set('Retry-After', '1').end();
+				return;
+			}
+			console.log(`200 ${req.url}`);
+			next();
+		});
+		app.get('/v1/tracks', (req, res) => {
+			const ids = ((req.query.ids as string) || '').split(',');
+			if (ids.length > 50) {
+				res.status(400).json({ error: 'too many ids' });
+				return;
+			}
+			res.json({ tracks: ids.map(getTrack) });
+		});
+		app.get('/v1/audio-analysis/:id', (req, res) => {
+			res.json(getAnalysis(req.params.id));
+		});
+		app.listen(PORT, () => {
+			console.log(`Mock Spotify API listening at http://localhost:${PORT}/v1`);
+		});
+	}
+}
+
+MockSpotify.start();
@@ -38,9 +38,78 @@ export namespace IO {
 			analyses: Spotify.Analysis.TrackAnalysis[]
 		) {
 			await fs.ensureDir(path.dirname(ANALYSIS_DATA_FILE));
-			await fs.writeFile(ANALYSIS_DATA_FILE, JSON.stringify(analyses), {
-				encoding: 'utf8',
-			});
+			// Written next to it first, a stopped run never leaves half a file
+			await fs.writeFile(
+				`${ANALYSIS_DATA_FILE}.tmp`,
+				JSON.stringify(analyses),
+				{
+					encoding: 'utf8',
+				}
+			);
+			await fs.rename(`${ANALYSIS_DATA_FILE}.tmp`, ANALYSIS_DATA_FILE);
+		}
+
+		// Analyses added before the file gets written again
+		const WRITE_EVERY = 25;
+
+		/**
+		 * The analyses of earlier runs merged with new ones, written every
+		 * WRITE_EVERY analyses so a stopped run keeps what it got
+		 */
+		export class AnalysisWriter {
+			private _unwritten: number = 0;
+			private _writing: Promise<void> = Promise.resolve();
+
+			constructor(
+				private _analyses: Map<string, Spotify.Analysis.TrackAnalysis>
+			) {}
+
+			static async open() {
+				let analyses: Spotify.Analysis.TrackAnalysis[] = [];
+				if (await fs.pathExists(ANALYSIS_DATA_FILE)) {
+					analyses = JSON.parse(
+						await fs.readFile(ANALYSIS_DATA_FILE, {
+							encoding: 'utf8',
+						})
+					);
+				}
+				const byURI: Map<
+					string,
+					Spotify.Analysis.TrackAnalysis
+				> = new Map(analyses.map((a) => [a.uri, a]));
+				return new AnalysisWriter(byURI);
+			}
+
+			has(uri: string) {
+				return this._analyses.has(uri);
+			}
+
+			get size() {
+				return this._analyses.size;
+			}
+
+			add(analysis: Spotify.Analysis.TrackAnalysis) {
+				this._analyses.set(analysis.uri, analysis);
+				if (++this._unwritten >= WRITE_EVERY) {
+					// Nothing waits on periodic writes, a failed one only
+					// gets logged and the next write tries again
+					this.write().catch((e) => {
+						console.error('Failed to write analyses', e);
+					});
+				}
+			}
+
+			write() {
+				this._unwritten = 0;
+				// Never two writes at once, the last one has everything. A
+				// failed write doesn't hold back the ones after it
+				this._writing = this._writing
+					.catch(() => undefined)
+					.then(() =>
+						exportAnalyses(Array.from(this._analyses.values()))
+					);
+				return this._writing;
+			}
 		}
 
 		export async function exportURIs(uris: string[]) {
@@ -0,0 +1,44 @@
+import { CACHE_DIR } from './constants';
+import * as fs from 'fs-extra';
+import * as path from 'path';
+
+export namespace Cache {
+	/**
+	 * API responses stored on disk a file per track URI, so a run only
+	 * requests what no earlier run got
+	 */
+	export class ResponseCache<T> {
+		private _dir: string;
+
+		constructor(kind: string) {
+			this._dir = path.join(CACHE_DIR, kind);
+		}
+
+		private _getPath(uri: string) {
+			// URIs are spotify:track:<base62 ID>
+			return path.join(this._dir, `${uri.split(':').pop()}.json`);
+		}
+
+		async get(uri: string): Promise<T | null> {
+			try {
+				return JSON.parse(
+					await fs.readFile(this._getPath(uri), {
+						encoding: 'utf8',
+					})
+				) as T;
+			} catch (e) {
+				// Not cached, or cut off by a run that got stopped
+				return null;
+			}
+		}
+
+		async set(uri: string, value: T) {
+			await fs.ensureDir(this._dir);
+			const filePath = this._getPath(uri);
+			await fs.writeFile(`${filePath}.tmp`, JSON.stringify(value), {
+				encoding: 'utf8',
+			});
+			await fs.rename(`${filePath}.tmp`, filePath);
+		}
+	}
+}
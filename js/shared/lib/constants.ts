@@ -8,4 +8,14 @@ export const DATA_DIR = path.join(__dirname, '../../../', 'data');
 export const ANALYSIS_DATA_FILE = path.join(DATA_DIR, 'analysis.json');
 export const URIS_DATA_FILE = path.join(DATA_DIR, 'uris.txt');
 export const TRACK_DIR = path.join(DATA_DIR, 'tracks');
+// API responses of earlier runs, a file per track
+export const CACHE_DIR = path.join(DATA_DIR, 'cache');
 export const BRABANT = 'spotify:track:0GiWi4EkPduFWHQyhiKpRB';
+
+// Set to run against a local mock of the API, like modes/mock_spotify
+export const SPOTIFY_API_URL =
+	process.env.SPOTIFY_API_URL || 'https://api.spotify.com/v1';
+// Skips logging in through the browser when set, the mock takes any token
+export const SPOTIFY_ACCESS_TOKEN = process.env.SPOTIFY_ACCESS_TOKEN;
+// Requests to the API that are in flight at once
+export const MAX_CONCURRENT_REQUESTS = 8;
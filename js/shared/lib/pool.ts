@@ -0,0 +1,36 @@
+export namespace Pool {
+	/**
+	 * Calls fn for every item with at most `concurrency` calls running at
+	 * once, the results are in the order of the items
+	 */
+	export async function map<T, R>(
+		items: T[],
+		concurrency: number,
+		fn: (item: T, index: number) => Promise<R>
+	): Promise<R[]> {
+		const results: R[] = new Array(items.length);
+		let next: number = 0;
+
+		async function work() {
+			while (next < items.length) {
+				const index = next++;
+				results[index] = await fn(items[index], index);
+			}
+		}
+
+		await Promise.all(
+			new Array(Math.max(Math.min(concurrency, items.length), 0))
+				.fill(null)
+				.map(() => work())
+		);
+		return results;
+	}
+
+	export function chunk<T>(items: T[], size: number): T[][] {
+		const chunks: T[][] = [];
+		for (let i = 0; i < items.length; i += size) {
+			chunks.push(items.slice(i, i + size));
+		}
+		return chunks;
+	}
+}
@@ -1,17 +1,66 @@
 import fetch, { RequestInit, Response } from 'node-fetch';
+import * as https from 'https';
+import * as http from 'http';
 import { wait } from './util';
 
+// Retries of a request that got rate limited or failed before giving up
+const MAX_RETRIES = 8;
+// Wait before the first retry when there's no Retry-After, doubled every retry
+const BASE_BACKOFF = 500;
+const MAX_BACKOFF = 30 * 1000;
+
 export namespace Req {
+	// Connections are kept open and reused instead of a handshake per request
+	const httpAgent = new http.Agent({ keepAlive: true });
+	const httpsAgent = new https.Agent({ keepAlive: true });
+
+	// A 429 holds back every request, not just the one that got it
+	let pausedUntil: number = 0;
+
+	function getBackoff(retry: number, res?: Response) {
+		const retryAfter = res?.headers.get('Retry-After');
+		if (retryAfter) {
+			return ~~retryAfter * 1000;
+		}
+		const backoff = Math.min(BASE_BACKOFF * 2 ** retry, MAX_BACKOFF);
+		// Jittered so requests that got held back together don't retry together
+		return backoff / 2 + (Math.random() * backoff) / 2;
+	}
+
 	export async function request(
 		url: string,
-		init?: RequestInit
+		init?: RequestInit,
+		retry: number = 0
 	): Promise<Response> {
-		const res = await fetch(url, init);
-		if (res.status === 429) {
-			const seconds = ~~res.headers.get('Retry-After')!;
-			await wait(seconds * 1000);
-			return await request(url, init);
+		const pause = pausedUntil - Date.now();
+		if (pause > 0) {
+			await wait(pause);
+		}
+
+		let res: Response | undefined;
+		try {
+			res = await fetch(url, {
+				agent: (parsedURL) =>
+					parsedURL.protocol === 'http:' ? httpAgent : httpsAgent,
+				...init,
+			});
+		} catch (e) {
+			if (retry >= MAX_RETRIES) {
+				throw e;
+			}
+		}
+		if (
+			res &&
+			((res.status !== 429 && res.status < 500) || retry >= MAX_RETRIES)
+		) {
+			return res;
+		}
+
+		const backoff = getBackoff(retry, res);
+		if (res?.status === 429) {
+			pausedUntil = Math.max(pausedUntil, Date.now() + backoff);
 		}
-		return res;
+		await wait(backoff);
+		return await request(url, init, retry + 1);
 	}
 }
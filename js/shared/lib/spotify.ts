@@ -1,6 +1,10 @@
 import { REDIRECT_URL, PORT, REDIRECT_PATH, BRABANT } from './constants.js';
+import { SPOTIFY_API_URL, SPOTIFY_ACCESS_TOKEN } from './constants.js';
+import { MAX_CONCURRENT_REQUESTS } from './constants.js';
 import { RequestInit } from 'node-fetch';
 import { ProgressBar } from './progress';
+import { Cache } from './cache';
+import { Pool } from './pool';
 import * as express from 'express';
 import * as fs from 'fs-extra';
 import * as path from 'path';
@@ -227,7 +231,7 @@ export namespace Spotify {
 			secrets: Types.Secrets,
 			init?: RequestInit
 		): Promise<Types.ExtendedResponse<T>> {
-			return ((await Req.request(`https://api.spotify.com/v1/${url}`, {
+			return ((await Req.request(`${SPOTIFY_API_URL}/${url}`, {
 				method: method.toUpperCase(),
 				headers: {
 					Accept: 'application/json',
@@ -287,7 +291,18 @@ export namespace Spotify {
 			return await response.json();
 		}
 
-		export async function createSpotifyConnection(scopes: string[] = []) {
+		export async function createSpotifyConnection(
+			scopes: string[] = []
+		): Promise<Types.Secrets> {
+			if (SPOTIFY_ACCESS_TOKEN) {
+				return {
+					access_token: SPOTIFY_ACCESS_TOKEN,
+					token_type: 'Bearer',
+					scope: scopes.join(' '),
+					expires_in: 3600,
+					refresh_token: '',
+				};
+			}
 			return new Promise<Types.Secrets>((resolve) => {
 				let server: http.Server | null = null;
 
@@ -452,34 +467,52 @@ export namespace Spotify {
 			analysis: AudioAnalysis;
 		}
 
+		/**
+		 * Analyses of every track, from the cache when an earlier run
+		 * requested them. Tracks whose analysis can't be had are left out.
+		 * onAnalysis gets called with every analysis as soon as it's there
+		 */
 		export async function get(
 			secrets: Types.Secrets,
 			ids: string[],
-			trackMap: Map<string, string>
+			trackMap: Map<string, string>,
+			onAnalysis?: (analysis: TrackAnalysis) => void
 		) {
-			const analyses: TrackAnalysis[] = [];
-			for (const id of ids) {
-				const res = await (((await Req.request(
-					`https://api.spotify.com/v1/audio-analysis/${id.slice(
-						'spotify:track:'.length
-					)}`,
-					{
-						method: 'GET',
-						headers: {
-							Accept: 'application/json',
-							'Content-Type': 'application/json',
-							Authorization: `Bearer ${secrets.access_token}`,
-						},
+			const cache = new Cache.ResponseCache<AudioAnalysis>('analysis');
+			const uniqueIDs = ids.filter((id, i) => ids.indexOf(id) === i);
+			const analyses = await Pool.map(
+				uniqueIDs,
+				MAX_CONCURRENT_REQUESTS,
+				async (id): Promise<TrackAnalysis | null> => {
+					let analysis = await cache.get(id);
+					if (!analysis) {
+						const res = await API.req<AudioAnalysis>(
+							'GET',
+							`audio-analysis/${id.slice('spotify:track:'.length)}`,
+							secrets
+						);
+						if (!res.ok) {
+							console.error(
+								`Failed to get the analysis of "${id}" (${res.status})`
+							);
+							return null;
+						}
+						analysis = await res.json();
+						await cache.set(id, analysis);
 					}
-				)) as unknown) as Types.ExtendedResponse<AudioAnalysis>).json();
 
-				analyses.push({
-					uri: id,
-					name: trackMap.get(id)!,
-					analysis: res,
-				});
-			}
-			return analyses;
+					const trackAnalysis = {
+						uri: id,
+						name: trackMap.get(id)!,
+						analysis,
+					};
+					onAnalysis?.(trackAnalysis);
+					return trackAnalysis;
+				}
+			);
+			return analyses.filter(
+				(analysis): analysis is TrackAnalysis => analysis !== null
+			);
 		}
 	}
 
@@ -524,21 +557,56 @@ export namespace Spotify {
 			);
 		}
 
+		// Most IDs the tracks endpoint takes at once
+		const TRACKS_PER_REQUEST = 50;
+
+		/**
+		 * The tracks of the URIs with BRABANT first, from the cache when an
+		 * earlier run requested them. Unknown tracks are left out
+		 */
 		export async function getTracks(
 			URIs: string[],
 			secrets: Types.Secrets
 		): Promise<Types.Track[]> {
-			const tracks = await (
-				await API.req<Types.Tracks>(
-					'GET',
-					`tracks?ids=${[BRABANT, ...URIs]
-						.map((t) => t.slice('spotify:track:'.length))
-						.join(',')}`,
-					secrets
-				)
-			).json();
+			const cache = new Cache.ResponseCache<Types.Track>('tracks');
+			const allURIs = [BRABANT, ...URIs].filter(
+				(uri, i, uris) => uris.indexOf(uri) === i
+			);
+			const cached = await Pool.map(
+				allURIs,
+				MAX_CONCURRENT_REQUESTS,
+				(uri) => cache.get(uri)
+			);
+			const missing = allURIs.filter((_, i) => !cached[i]);
+
+			const fetched: Map<string, Types.Track> = new Map();
+			await Pool.map(
+				Pool.chunk(missing, TRACKS_PER_REQUEST),
+				MAX_CONCURRENT_REQUESTS,
+				async (uris) => {
+					const tracks = await (
+						await API.req<Types.Tracks>(
+							'GET',
+							`tracks?ids=${uris
+								.map((t) => t.slice('spotify:track:'.length))
+								.join(',')}`,
+							secrets
+						)
+					).json();
+					// In the order they were asked for, null when unknown
+					await Promise.all(
+						tracks.tracks.map(async (track, i) => {
+							if (!track) return;
+							fetched.set(uris[i], track);
+							await cache.set(uris[i], track);
+						})
+					);
+				}
+			);
 
-			return tracks.tracks;
+			return allURIs
+				.map((uri, i) => cached[i] || fetched.get(uri))
+				.filter((track): track is Types.Track => !!track);
 		}
 	}
 }
@@ -1,5 +1,5 @@
 """Allows logging with time"""
-from typing import Callable, Optional, TextIO, Union
+from typing import Callable, List, Optional, TextIO, Union
 from io import TextIOWrapper
 import datetime
 import sys
@@ -11,6 +11,12 @@ COLOR_POSTFIX = "\x1b[0m"
 
 group_length = 0
 
+# Called with True when a group is entered and False when it's exited, used for profiling
+group_listeners: List[Callable[[bool], None]] = list()
+
+# The last line logged with logline, groups are named after it
+last_message = ""
+
 
 def print_prefix(
     output: Union[TextIOWrapper, TextIO] = sys.stdout,
@@ -53,6 +59,10 @@ def logline(
     indent: bool = True
 ):
     """Logs a line with given arguments"""
+    global last_message
+    if args:
+        last_message = " ".join(str(arg) for arg in args)
+
     # Get the current time
     print_prefix(output=output, debug_mode=debug_mode, error_mode=error_mode, warning_mode=warning_mode, indent=indent)
     is_first = True
@@ -92,6 +102,9 @@ def error(*args: object, output: TextIO = sys.stdout, spaces_between: bool = Tru
 
 def enter_group():
     """Enter an indentation group"""
+    # Before logging the marker, so last_message still holds the line that introduced this group
+    for listener in group_listeners:
+        listener(True)
     logline("\\", indent=False)
     global group_length
     group_length = group_length + 1
@@ -99,6 +112,8 @@ def enter_group():
 
 def exit_group():
     """Exits an indentation group"""
+    for listener in group_listeners:
+        listener(False)
     global group_length
     group_length = group_length - 1
     if group_length < 0:
@@ -0,0 +1,184 @@
+"""Low-overhead counters, gauges and histograms, rendered in the Prometheus text format"""
+from typing import Callable, Dict, List, Optional, Sequence, Tuple, TypeVar
+from abc import ABC, abstractmethod
+from bisect import bisect_left
+import threading
+
+M = TypeVar("M", bound="Metric")
+
+# Upper bounds of the default latency buckets, in seconds
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5)
+
+
+def format_labels(labels: Dict[str, str], extra: Optional[Tuple[str, str]] = None) -> str:
+    pairs = list(labels.items())
+    if extra:
+        pairs.append(extra)
+    if not pairs:
+        return ""
+    return "{" + ",".join('{}="{}"'.format(key, value) for key, value in pairs) + "}"
+
+
+class Metric(ABC):
+    """A single time series"""
+
+    kind = "untyped"
+
+    def __init__(self, name: str, descr: str, labels: Dict[str, str]):
+        self.name = name
+        self.descr = descr
+        self.labels = labels
+        self._lock = threading.Lock()
+
+    @abstractmethod
+    def render(self) -> List[str]:
+        """The lines of this metric's series, without HELP and TYPE"""
+
+
+class Counter(Metric):
+    """A value that only goes up, or that gets read from **func** whenever it's rendered"""
+
+    kind = "counter"
+
+    def __init__(self, name: str, descr: str, labels: Dict[str, str], func: Optional[Callable[[], float]] = None):
+        super().__init__(name, descr, labels)
+        self.value = 0.0
+        self.func = func
+
+    def inc(self, amount: float = 1.0):
+        with self._lock:
+            self.value += amount
+
+    def render(self) -> List[str]:
+        value = self.func() if self.func else self.value
+        return ["{}{} {}".format(self.name, format_labels(self.labels), value)]
+
+
+class Gauge(Metric):
+    """A value that can go up and down, or that gets read from **func** whenever it's rendered"""
+
+    kind = "gauge"
+
+    def __init__(self, name: str, descr: str, labels: Dict[str, str], func: Optional[Callable[[], float]] = None):
+        super().__init__(name, descr, labels)
+        self.value = 0.0
+        self.func = func
+
+    def inc(self, amount: float = 1.0):
+        with self._lock:
+            self.value += amount
+
+    def dec(self, amount: float = 1.0):
+        with self._lock:
+            self.value -= amount
+
+    def set(self, value: float):
+        self.value = value
+
+    def render(self) -> List[str]:
+        value = self.func() if self.func else self.value
+        return ["{}{} {}".format(self.name, format_labels(self.labels), value)]
+
+
+class Histogram(Metric):
+    """Counts observations into fixed buckets"""
+
+    kind = "histogram"
+
+    def __init__(self, name: str, descr: str, labels: Dict[str, str], buckets: Sequence[float] = LATENCY_BUCKETS):
+        super().__init__(name, descr, labels)
+        self.buckets = tuple(buckets)
+        # The last one catches everything above the largest bucket
+        self._counts = [0] * (len(self.buckets) + 1)
+        self._sum = 0.0
+
+    def observe(self, value: float):
+        index = bisect_left(self.buckets, value)
+        with self._lock:
+            self._counts[index] += 1
+            self._sum += value
+
+    def render(self) -> List[str]:
+        with self._lock:
+            counts = list(self._counts)
+            total_sum = self._sum
+
+        lines: List[str] = list()
+        cumulative = 0
+        for bound, count in zip(self.buckets, counts):
+            cumulative += count
+            lines.append("{}_bucket{} {}".format(self.name, format_labels(self.labels, ("le", str(bound))), cumulative))
+        cumulative += counts[-1]
+        lines.append("{}_bucket{} {}".format(self.name, format_labels(self.labels, ("le", "+Inf")), cumulative))
+        lines.append("{}_sum{} {}".format(self.name, format_labels(self.labels), total_sum))
+        lines.append("{}_count{} {}".format(self.name, format_labels(self.labels), cumulative))
+        return lines
+
+
+class Registry:
+    """Creates metrics and renders all of them"""
+
+    def __init__(self):
+        self._metrics: List[Metric] = list()
+        self._labels: Dict[str, str] = dict()
+        self._lock = threading.Lock()
+
+    def _add(self, metric: M) -> M:
+        with self._lock:
+            metric.labels = {**self._labels, **metric.labels}
+            self._metrics.append(metric)
+        return metric
+
+    def set_labels(self, **labels: str):
+        """Labels every metric, created before or after, with **labels** as well. Tells processes apart"""
+        with self._lock:
+            self._labels.update(labels)
+            for metric in self._metrics:
+                metric.labels = {**labels, **metric.labels}
+
+    def counter(self, name: str, descr: str, func: Optional[Callable[[], float]] = None, **labels: str) -> Counter:
+        return self._add(Counter(name, descr, labels, func))
+
+    def gauge(self, name: str, descr: str, func: Optional[Callable[[], float]] = None, **labels: str) -> Gauge:
+        return self._add(Gauge(name, descr, labels, func))
+
+    def histogram(self, name: str, descr: str, buckets: Sequence[float] = LATENCY_BUCKETS, **labels: str) -> Histogram:
+        return self._add(Histogram(name, descr, labels, buckets))
+
+    def render(self) -> str:
+        with self._lock:
+            # Stable, so series of one metric stay in order but end up next to each other
+            metrics = sorted(self._metrics, key=lambda metric: metric.name)
+
+        lines: List[str] = list()
+        described = set()
+        for metric in metrics:
+            # Series of the same metric share their HELP and TYPE lines
+            if metric.name not in described:
+                described.add(metric.name)
+                lines.append("# HELP {} {}".format(metric.name, metric.descr))
+                lines.append("# TYPE {} {}".format(metric.name, metric.kind))
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+def merge_renders(renders: List[str]) -> str:
+    """Joins the renders of several registries, the series of every metric end up together under one HELP and TYPE"""
+    headers: Dict[str, List[str]] = dict()
+    series: Dict[str, List[str]] = dict()
+    for render in renders:
+        name = ""
+        for line in render.splitlines():
+            if line.startswith("# "):
+                name = line.split(" ")[2]
+                if len(headers.setdefault(name, list())) < 2:
+                    headers[name].append(line)
+                series.setdefault(name, list())
+            elif line:
+                series[name].append(line)
+
+    lines: List[str] = list()
+    for name in headers:
+        lines.extend(headers[name])
+        lines.extend(series[name])
+    return "\n".join(lines) + "\n"
@@ -0,0 +1,188 @@
+"""Sampling CPU profiler and per log group memory tracking that work for every mode"""
+from typing import Dict, List, Optional, Tuple
+from collections import Counter
+from lib.log import logline
+from lib import log
+import tracemalloc
+import threading
+import datetime
+import time
+import sys
+import os
+
+# Seconds between two CPU samples
+SAMPLE_INTERVAL = 0.005
+
+# Amount of functions and allocation sites listed in the summaries
+TOP_ENTRIES = 30
+
+# Frames of tracebacks stored per allocation, more is more accurate but slower
+TRACEMALLOC_FRAMES = 5
+
+# Leaves the profilers' own allocations out of the summaries
+OWN_ALLOCATIONS = [tracemalloc.Filter(False, __file__), tracemalloc.Filter(False, tracemalloc.__file__)]
+
+
+def format_bytes(amount: float) -> str:
+    for unit in ("B", "KiB", "MiB"):
+        if abs(amount) < 1024:
+            return "{:.1f} {}".format(amount, unit)
+        amount /= 1024
+    return "{:.1f} GiB".format(amount)
+
+
+def describe_code(code) -> str:
+    return "{} ({}:{})".format(code.co_name, code.co_filename, code.co_firstlineno)
+
+
+class SamplingProfiler(threading.Thread):
+    """Periodically samples the stacks of all threads, cheap enough to leave on for a whole run"""
+
+    def __init__(self, interval: float = SAMPLE_INTERVAL):
+        super().__init__(daemon=True)
+        self.interval = interval
+        self.samples = 0
+        self.own_time: Counter = Counter()
+        self.total_time: Counter = Counter()
+        self.stacks: Counter = Counter()
+        self._stop_event = threading.Event()
+
+    def sample(self):
+        for thread_id, frame in sys._current_frames().items():
+            if thread_id == self.ident:
+                continue
+            stack: List[str] = list()
+            while frame is not None:
+                stack.append(describe_code(frame.f_code))
+                frame = frame.f_back
+
+            self.samples += 1
+            self.own_time[stack[0]] += 1
+            # Recursive functions only count once per sample
+            for func in set(stack):
+                self.total_time[func] += 1
+            self.stacks[";".join(reversed(stack))] += 1
+
+    def run(self):
+        while not self._stop_event.wait(self.interval):
+            self.sample()
+
+    def stop(self):
+        self._stop_event.set()
+        self.join()
+
+    def write(self, out_dir: str):
+        with open(os.path.join(out_dir, "cpu.txt"), "w") as out_file:
+            out_file.write("{} samples, one every {}ms\n".format(self.samples, self.interval * 1000))
+            for title, counts in (("own time", self.own_time), ("total time", self.total_time)):
+                out_file.write("\nTop functions by {}:\n".format(title))
+                for func, count in counts.most_common(TOP_ENTRIES):
+                    out_file.write("{:6.2f}% {}\n".format(count / max(self.samples, 1) * 100, func))
+
+        # Collapsed stacks, readable by flamegraph.pl and speedscope
+        with open(os.path.join(out_dir, "cpu.collapsed"), "w") as out_file:
+            for stack, count in self.stacks.most_common():
+                out_file.write("{} {}\n".format(stack, count))
+
+
+class MemoryTracker:
+    """Tracks the peak allocation within every log group using tracemalloc"""
+
+    def __init__(self):
+        # Name, memory at the start and the highest peak seen so far for every open group
+        self._open: List[List] = list()
+        self.groups: List[Tuple[int, str, int, int]] = list()
+        self._largest: Optional[tracemalloc.Snapshot] = None
+        self._largest_size = 0
+        self._final: Optional[tracemalloc.Snapshot] = None
+        # Python before 3.9 can't reset the peak, groups then report the peak of the run so far
+        self._can_reset = hasattr(tracemalloc, "reset_peak")
+
+    def start(self):
+        tracemalloc.start(TRACEMALLOC_FRAMES)
+        log.group_listeners.append(self.on_group)
+
+    def on_group(self, entering: bool):
+        current, peak = tracemalloc.get_traced_memory()
+        if entering:
+            if self._open:
+                self._open[-1][2] = max(self._open[-1][2], peak)
+            if self._can_reset:
+                tracemalloc.reset_peak()
+            self._open.append([log.last_message, current, current])
+        elif self._open:
+            name, start, group_peak = self._open.pop()
+            group_peak = max(group_peak, peak)
+            if self._open:
+                self._open[-1][2] = max(self._open[-1][2], group_peak)
+            self.groups.append((len(self._open), name, group_peak, current - start))
+            self._snapshot_if_largest(group_peak)
+
+    def _snapshot_if_largest(self, size: int):
+        # Snapshots are slow, only keep the one taken closest to the largest peak
+        if size > self._largest_size:
+            self._largest_size = size
+            self._largest = tracemalloc.take_snapshot().filter_traces(OWN_ALLOCATIONS)
+
+    def stop(self):
+        log.group_listeners.remove(self.on_group)
+        self._snapshot_if_largest(tracemalloc.get_traced_memory()[1])
+        self._final = tracemalloc.take_snapshot().filter_traces(OWN_ALLOCATIONS)
+        tracemalloc.stop()
+
+    def write(self, out_dir: str):
+        with open(os.path.join(out_dir, "memory.txt"), "w") as out_file:
+            out_file.write("Peak allocation per log group, in the order they finished:\n")
+            for depth, name, peak, growth in self.groups:
+                out_file.write(
+                    "{}{} peak {}, retained {}\n".format("  " * depth, name, format_bytes(peak), format_bytes(growth))
+                )
+
+            snapshots: Dict[str, Optional[tracemalloc.Snapshot]] = {
+                "at the largest peak ({})".format(format_bytes(self._largest_size)): self._largest,
+                "at exit": self._final,
+            }
+            for title, snapshot in snapshots.items():
+                if snapshot is None:
+                    continue
+                out_file.write("\nTop allocation sites {}:\n".format(title))
+                for stat in snapshot.statistics("lineno")[:TOP_ENTRIES]:
+                    frame = stat.traceback[0]
+                    out_file.write(
+                        "{:>12} in {} blocks at {}:{}\n".format(
+                            format_bytes(stat.size), stat.count, frame.filename, frame.lineno
+                        )
+                    )
+
+
+class Profiler:
+    """Runs the enabled profilers around a mode and writes their results to a directory"""
+
+    def __init__(self, mode: str, out_dir: str, cpu: bool, memory: bool):
+        self.out_dir = os.path.join(out_dir, "{}-{}".format(mode, datetime.datetime.now().strftime("%Y%m%d-%H%M%S")))
+        self.cpu = SamplingProfiler() if cpu else None
+        self.memory = MemoryTracker() if memory else None
+        self._start_time = 0.0
+
+    def __enter__(self):
+        self._start_time = time.time()
+        if self.memory:
+            self.memory.start()
+        if self.cpu:
+            self.cpu.start()
+        return self
+
+    def __exit__(self, *args):
+        if self.cpu:
+            self.cpu.stop()
+        if self.memory:
+            self.memory.stop()
+
+        os.makedirs(self.out_dir, exist_ok=True)
+        if self.cpu:
+            self.cpu.write(self.out_dir)
+        if self.memory:
+            self.memory.write(self.out_dir)
+        logline(
+            'wrote profile of {:.1f}s run to "{}"'.format(time.time() - self._start_time, self.out_dir), indent=False
+        )
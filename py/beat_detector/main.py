@@ -2,16 +2,40 @@
 """Main file used for launching everything"""
 
 from modes.realtime_test.realtime_test import mode_realtime_test
+from modes.convert_bins.convert_bins import mode_convert_bins
 from modes.preprocess.preprocess import mode_preprocess
+from modes.load_test.load_test import mode_load_test
+from modes.quantize.quantize import mode_quantize
+from modes.annotate.annotate import mode_annotate
+from modes.tune.tune import mode_tune
 from modes.train.train import mode_train
 from typing_extensions import Literal
 from modes.test.test import mode_test
+from lib.profiling import Profiler
 from typing import Any, Union
 from lib.log import logline
 import sys
 
+# Flags that work for every mode, they're taken out of sys.argv before the mode parses it
+PROFILE_CPU_FLAG = "--profile-cpu"
+PROFILE_MEMORY_FLAG = "--profile-memory"
+PROFILE_DIR_FLAG = "--profile-dir="
+DEFAULT_PROFILE_DIR = "./profiles/"
 
-def run_mode(mode: Union[Literal["preprocess"], Literal["train"], Literal["test"], Literal["realtime_test"]]) -> int:
+
+def run_mode(
+    mode: Union[
+        Literal["preprocess"],
+        Literal["train"],
+        Literal["test"],
+        Literal["realtime_test"],
+        Literal["load_test"],
+        Literal["annotate"],
+        Literal["convert_bins"],
+        Literal["quantize"],
+        Literal["tune"],
+    ],
+) -> int:
     if mode == "preprocess":
         return mode_preprocess()
     elif mode == "train":
@@ -20,6 +44,16 @@ def run_mode(mode: Union[Literal["preprocess"], Literal["train"], Literal["test"
         return mode_test() or 0
     elif mode == "realtime_test":
         return mode_realtime_test() or 0
+    elif mode == "load_test":
+        return mode_load_test() or 0
+    elif mode == "annotate":
+        return mode_annotate() or 0
+    elif mode == "convert_bins":
+        return mode_convert_bins()
+    elif mode == "quantize":
+        return mode_quantize()
+    elif mode == "tune":
+        return mode_tune()
     else:
         if mode == "":
             logline("No mode supplied. Choose one of:")
@@ -30,6 +64,16 @@ def run_mode(mode: Union[Literal["preprocess"], Literal["train"], Literal["test"
         logline("\ttrain		- train on given features")
         logline("\ttest		- test trained model")
         logline("\trealtime_test	- do a realtime test by listening to music")
+        logline("\tload_test	- find how many listeners a realtime_test server can handle")
+        logline("\tannotate	- annotate a directory of .wav files with beats")
+        logline("\tconvert_bins	- convert .bins.json files to the faster .bins.npy format")
+        logline("\tquantize	- convert trained weights to smaller float16 and int8 models")
+        logline("\ttune		- find the workers, threads and batching that serve the most sessions")
+        logline("")
+        logline("Profiling options, usable with any mode:")
+        logline("\t{}		- sample where CPU time is spent".format(PROFILE_CPU_FLAG))
+        logline("\t{}	- track peak memory per log group and the top allocation sites".format(PROFILE_MEMORY_FLAG))
+        logline("\t{}<dir>	- where profiles are written (default {})".format(PROFILE_DIR_FLAG, DEFAULT_PROFILE_DIR))
         return 1
 
 
@@ -39,8 +83,32 @@ def get_mode() -> Any:
     return ""
 
 
+def pop_flag(flag: str) -> bool:
+    if flag in sys.argv:
+        sys.argv.remove(flag)
+        return True
+    return False
+
+
+def pop_profile_dir() -> str:
+    for arg in sys.argv:
+        if arg.startswith(PROFILE_DIR_FLAG):
+            sys.argv.remove(arg)
+            return arg[len(PROFILE_DIR_FLAG) :]
+    return DEFAULT_PROFILE_DIR
+
+
 def main():
-    return run_mode(get_mode())
+    profile_cpu = pop_flag(PROFILE_CPU_FLAG)
+    profile_memory = pop_flag(PROFILE_MEMORY_FLAG)
+    profile_dir = pop_profile_dir()
+
+    mode = get_mode()
+    if not profile_cpu and not profile_memory:
+        return run_mode(mode)
+    # Also writes the profile when the mode is stopped with ctrl+c, like the realtime server
+    with Profiler(mode or "none", profile_dir, profile_cpu, profile_memory):
+        return run_mode(mode)
 
 
 if __name__ == "__main__":
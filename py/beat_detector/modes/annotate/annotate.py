@@ -0,0 +1,263 @@
+"""Main entrypoint for annotate mode"""
+
+from lib.log import logline, enter_group, exit_group, error
+from ..inference import load_model
+from typing import Callable, Dict, Iterable, List, NamedTuple, Optional
+from ..silence import SilenceGate, predict_audible
+from ..test.test import BeatFileWriter
+from ..realtime_test.timelines import PREDICT_FRAMES
+from ..spectrum import SpectrumStream
+from ..frontend import load_frontend
+from ..features import INTERVAL
+from ..audio import open_audio
+from lib.io import IO, IOInput
+from lib.timer import Timer
+from glob import glob
+import numpy as np
+import threading
+import pathlib
+import queue
+import time
+import os
+
+# Items a queue between two stages holds before the earlier stage has to wait
+QUEUE_SIZE = 8
+
+
+def get_io() -> IO:
+    return IO(
+        {
+            "i": IOInput(
+                "./data/tracks/",
+                str,
+                has_input=True,
+                arg_name="input_dir",
+                descr="Directory of .wav files to annotate",
+                alias="input_dir",
+                is_generic=True,
+            ),
+            "iw": IOInput(
+                "./data/weights.h5",
+                str,
+                has_input=True,
+                arg_name="input_weights",
+                descr="Input weights file, or a .tflite model written by quantize mode",
+                alias="input_weights",
+            ),
+            "it": IOInput(
+                "./data/train_config.json",
+                str,
+                has_input=True,
+                arg_name="input_train",
+                descr="Train config, holds the frontend the model was trained with",
+                alias="input_train",
+            ),
+            "o": IOInput(
+                "./data/annotated/",
+                str,
+                has_input=True,
+                arg_name="output_annotated",
+                descr="Directory where annotated files are stored",
+                alias="output_annotated",
+            ),
+            "n": IOInput(
+                INTERVAL,
+                int,
+                has_input=True,
+                arg_name="interval",
+                descr="Interval between frames, has to match the one the model was trained at",
+                alias="interval",
+            ),
+        }
+    )
+
+
+class Message(NamedTuple):
+    """A piece of a track passed between stages, a payload of None marks the end of the track"""
+
+    path: str
+    payload: Optional[np.ndarray]
+    sample_rate: int = 0
+    # Along with predictions, the frames that were silent and never ran through the model
+    skipped: Optional[np.ndarray] = None
+
+
+class Stage(threading.Thread):
+    """Runs **func** on everything that comes in, passing along what it yields. None shuts the stage down"""
+
+    def __init__(
+        self,
+        name: str,
+        func: Callable[[Message], Iterable[Message]],
+        in_queue: "queue.Queue[Optional[Message]]",
+        out_queue: "Optional[queue.Queue[Optional[Message]]]",
+    ):
+        super().__init__(name=name, daemon=True)
+        self.func = func
+        self.in_queue = in_queue
+        self.out_queue = out_queue
+        self.busy_time = 0.0
+
+    def run(self):
+        try:
+            while True:
+                message = self.in_queue.get()
+                if message is None:
+                    break
+                try:
+                    self._handle(message)
+                except Exception as e:
+                    # Only this message is lost, the stage keeps going so the ones around it don't wait forever
+                    error('{} failed on "{}": {}'.format(self.name, message.path, e))
+        finally:
+            if self.out_queue is not None:
+                self.out_queue.put(None)
+
+    def _handle(self, message: Message):
+        # Passes outputs on as soon as they're there, waiting for a full queue doesn't count as busy
+        outputs = iter(self.func(message))
+        while True:
+            start_time = time.perf_counter()
+            output = next(outputs, None)
+            self.busy_time += time.perf_counter() - start_time
+            if output is None:
+                break
+            if self.out_queue is not None:
+                self.out_queue.put(output)
+
+
+def decode(message: Message) -> Iterable[Message]:
+    """Splits the track a message points to into chunks of samples"""
+    try:
+        sample_rate, chunks = open_audio(message.path)
+        for chunk in chunks:
+            yield Message(message.path, chunk, sample_rate)
+    except Exception as e:
+        error('failed to decode "{}": {}'.format(message.path, e))
+    yield Message(message.path, None)
+
+
+class BinExtractor:
+    """Turns chunks of samples into batches of frames"""
+
+    def __init__(self, interval: int):
+        self.interval = interval
+        self.streams: Dict[str, SpectrumStream] = dict()
+        self.pending: Dict[str, List[np.ndarray]] = dict()
+
+    def __call__(self, message: Message) -> Iterable[Message]:
+        if message.payload is None:
+            pending = self.pending.pop(message.path, [])
+            self.streams.pop(message.path, None)
+            if pending:
+                yield Message(message.path, np.concatenate(pending))
+            yield message
+            return
+
+        if message.path not in self.streams:
+            self.streams[message.path] = SpectrumStream(message.sample_rate, self.interval)
+            self.pending[message.path] = list()
+
+        pending = self.pending[message.path]
+        pending.append(self.streams[message.path].push(message.payload))
+        if sum(len(frames) for frames in pending) >= PREDICT_FRAMES:
+            yield Message(message.path, np.concatenate(pending))
+            pending.clear()
+
+
+class Predictor:
+    """Runs batches of frames through the model, the state carries over between the batches of a track"""
+
+    def __init__(self, io: IO):
+        self.interval = io.get("interval")
+        self.frontend = load_frontend(io.get("input_train"))
+        self.model = load_model(io.get("input_weights"), self.frontend.length)
+        self.gates: Dict[str, SilenceGate] = dict()
+
+    def __call__(self, message: Message) -> Iterable[Message]:
+        if message.payload is None:
+            self.gates.pop(message.path, None)
+            yield message
+            return
+
+        if message.path not in self.gates:
+            # A new track, it shouldn't continue from the state of the previous one
+            self.model.reset_states()
+            self.gates[message.path] = SilenceGate(self.interval)
+
+        frames = message.payload
+        skipped, resets = self.gates[message.path].push(frames)
+        features = np.reshape(self.frontend.apply(frames), (len(frames), self.frontend.length, 1))
+        yield Message(message.path, predict_audible(self.model, features, skipped, resets), skipped=skipped)
+
+
+class Writer:
+    """Appends the predictions of every track to its beat JSON file as they come in"""
+
+    def __init__(self, io: IO):
+        self.interval = io.get("interval")
+        self.out_dir = io.get("output_annotated")
+        self.files: Dict[str, BeatFileWriter] = dict()
+        self.tracks = 0
+
+    def __call__(self, message: Message) -> Iterable[Message]:
+        if message.path not in self.files:
+            out_path = os.path.join(self.out_dir, "{}.json".format(pathlib.Path(message.path).stem))
+            self.files[message.path] = BeatFileWriter(out_path, self.interval)
+
+        if message.payload is not None:
+            self.files[message.path].add(message.payload, message.skipped)
+            return []
+
+        writer = self.files.pop(message.path)
+        writer.close()
+        self.tracks += 1
+        logline("wrote {} frames of beats for {}".format(writer.frames, message.path))
+        return []
+
+
+def mode_annotate():
+    """The main annotate entrypoint"""
+    start_time = time.time()
+
+    io = get_io()
+
+    logline("annotate")
+    enter_group()
+
+    paths = sorted(glob(os.path.join(io.get("input_dir"), "*.wav")))
+    logline("found {} tracks".format(len(paths)))
+    pathlib.Path(io.get("output_annotated")).mkdir(parents=True, exist_ok=True)
+
+    logline("reconstructing model")
+    predictor = Predictor(io)
+    writer = Writer(io)
+
+    queues: List["queue.Queue[Optional[Message]]"] = [queue.Queue(QUEUE_SIZE) for _ in range(4)]
+    stages = [
+        Stage("decode", decode, queues[0], queues[1]),
+        Stage("extract bins", BinExtractor(io.get("interval")), queues[1], queues[2]),
+        Stage("predict", predictor, queues[2], queues[3]),
+        Stage("write", writer, queues[3], None),
+    ]
+
+    logline("annotating")
+    enter_group()
+    pipeline_start = time.perf_counter()
+    for stage in stages:
+        stage.start()
+    for path in paths:
+        # Decoding starts from just the path
+        queues[0].put(Message(path, None))
+    queues[0].put(None)
+    for stage in stages:
+        stage.join()
+    duration = time.perf_counter() - pipeline_start
+    exit_group()
+
+    logline("annotated {} tracks at {} tracks/minute".format(writer.tracks, round(writer.tracks / duration * 60, 2)))
+    for stage in stages:
+        logline("{} was busy {}% of the time".format(stage.name, round(stage.busy_time / duration * 100, 1)))
+
+    exit_group()
+    logline("done annotating, runtime is {}".format(Timer.stringify_time(Timer.format_time(time.time() - start_time))))
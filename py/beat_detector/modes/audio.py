@@ -0,0 +1,210 @@
+"""Decodes WAV files straight into numpy arrays"""
+from typing import Iterator, Optional, Tuple
+import numpy as np
+import subprocess
+import struct
+import mmap
+import os
+
+WAVE_FORMAT_PCM = 0x0001
+WAVE_FORMAT_IEEE_FLOAT = 0x0003
+WAVE_FORMAT_EXTENSIBLE = 0xFFFE
+
+# Amount of sample frames decoded at once when streaming
+CHUNK_FRAMES = 1 << 16
+
+# Rate non-WAV files are resampled to when decoding
+DEFAULT_SAMPLE_RATE = 44100
+
+
+class WavFormatError(Exception):
+    """The file is not a WAV file this reader can decode"""
+
+
+class WavReader:
+    """A WAV file whose samples get decoded on demand as normalized mono float32"""
+
+    def __init__(self, path: str):
+        self.path = path
+        self.channels = 0
+        self.sample_rate = 0
+        self.sample_width = 0
+        self.block_align = 0
+        self.is_float = False
+        self.data_offset = 0
+        self.data_size = 0
+
+        self._file = open(path, "rb")
+        self._map: Optional[mmap.mmap] = None
+        try:
+            self._parse_header()
+        except Exception:
+            self._file.close()
+            raise
+
+    def _parse_header(self):
+        riff, _, wave_id = struct.unpack("<4sI4s", self._file.read(12))
+        if riff != b"RIFF" or wave_id != b"WAVE":
+            raise WavFormatError('"{}" is not a RIFF/WAVE file'.format(self.path))
+
+        file_size = os.fstat(self._file.fileno()).st_size
+        has_fmt = False
+        while True:
+            header = self._file.read(8)
+            if len(header) < 8:
+                raise WavFormatError('"{}" has no data chunk'.format(self.path))
+            chunk_id, size = struct.unpack("<4sI", header)
+
+            if chunk_id == b"fmt ":
+                self._parse_fmt(self._file.read(size))
+                has_fmt = True
+            elif chunk_id == b"data":
+                if not has_fmt:
+                    raise WavFormatError('"{}" has its data chunk before its fmt chunk'.format(self.path))
+                self.data_offset = self._file.tell()
+                # Streaming writers leave the size at 0 or 0xFFFFFFFF, the data
+                # then simply runs until the end of the file
+                if size in (0, 0xFFFFFFFF) or self.data_offset + size > file_size:
+                    size = file_size - self.data_offset
+                self.data_size = size - (size % self.block_align)
+                return
+            else:
+                self._file.seek(size, os.SEEK_CUR)
+
+            # Chunks are padded to an even size
+            if size % 2 == 1:
+                self._file.seek(1, os.SEEK_CUR)
+
+    def _parse_fmt(self, fmt: bytes):
+        format_tag, channels, sample_rate, _, block_align, bits = struct.unpack("<HHIIHH", fmt[:16])
+        if format_tag == WAVE_FORMAT_EXTENSIBLE and len(fmt) >= 26:
+            (format_tag,) = struct.unpack("<H", fmt[24:26])
+
+        if format_tag == WAVE_FORMAT_PCM and bits not in (8, 16, 24, 32):
+            raise WavFormatError("unsupported integer sample size {} in {}".format(bits, self.path))
+        if format_tag == WAVE_FORMAT_IEEE_FLOAT and bits not in (32, 64):
+            raise WavFormatError("unsupported float sample size {} in {}".format(bits, self.path))
+        if format_tag not in (WAVE_FORMAT_PCM, WAVE_FORMAT_IEEE_FLOAT):
+            raise WavFormatError("unsupported format tag {} in {}".format(hex(format_tag), self.path))
+
+        self.channels = channels
+        self.sample_rate = sample_rate
+        self.sample_width = bits // 8
+        self.block_align = block_align or channels * self.sample_width
+        self.is_float = format_tag == WAVE_FORMAT_IEEE_FLOAT
+
+    @property
+    def frames(self) -> int:
+        """The amount of sample frames (one sample per channel) in the file"""
+        return self.data_size // self.block_align
+
+    @property
+    def duration(self) -> float:
+        """The duration in seconds"""
+        return self.frames / self.sample_rate
+
+    def _get_map(self) -> mmap.mmap:
+        if self._map is None:
+            self._map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        return self._map
+
+    def _decode(self, raw: memoryview) -> np.ndarray:
+        """Decodes raw sample frames into mono float32 in the range [-1, 1]"""
+        if self.is_float:
+            samples = np.frombuffer(raw, dtype="<f{}".format(self.sample_width)).astype(np.float32)
+        elif self.sample_width == 1:
+            samples = (np.frombuffer(raw, dtype=np.uint8).astype(np.float32) - 128.0) * (1.0 / 128)
+        elif self.sample_width == 3:
+            # Place each 3 byte sample in the upper bytes of an int32, the
+            # arithmetic shift then takes care of sign extension
+            packed = np.frombuffer(raw, dtype=np.uint8).reshape(-1, 3)
+            widened = np.zeros((packed.shape[0], 4), dtype=np.uint8)
+            widened[:, 1:] = packed
+            samples = (widened.view("<i4").ravel() >> 8).astype(np.float32) * (1.0 / (1 << 23))
+        else:
+            dtype = "<i{}".format(self.sample_width)
+            scale = 1.0 / (1 << (self.sample_width * 8 - 1))
+            samples = np.frombuffer(raw, dtype=dtype).astype(np.float32) * scale
+
+        if self.channels == 1:
+            return samples
+        return samples.reshape(-1, self.channels).mean(axis=1, dtype=np.float32)
+
+    def _byte_range(self, start: int, frames: int) -> Tuple[int, int]:
+        start = min(max(start, 0), self.frames)
+        end = min(start + frames, self.frames)
+        return self.data_offset + start * self.block_align, self.data_offset + end * self.block_align
+
+    def read(self, start: int = 0, frames: Optional[int] = None) -> np.ndarray:
+        """Decodes **frames** sample frames starting at frame **start**, all remaining ones by default"""
+        if frames is None:
+            frames = self.frames - start
+        begin, end = self._byte_range(start, frames)
+        if begin >= end:
+            return np.zeros(0, dtype=np.float32)
+        return self._decode(memoryview(self._get_map())[begin:end])
+
+    def iter_chunks(self, chunk_frames: int = CHUNK_FRAMES) -> Iterator[np.ndarray]:
+        """Decodes the file in fixed-size chunks, only one of which is held in memory at a time"""
+        for start in range(0, self.frames, chunk_frames):
+            yield self.read(start, chunk_frames)
+
+    def close(self):
+        if self._map is not None:
+            self._map.close()
+            self._map = None
+        self._file.close()
+
+    def __enter__(self) -> "WavReader":
+        return self
+
+    def __exit__(self, *args: object):
+        self.close()
+
+
+def decode_with_ffmpeg(
+    path: str,
+    sample_rate: int = DEFAULT_SAMPLE_RATE,
+    chunk_frames: int = CHUNK_FRAMES,
+    start: float = 0.0,
+    duration: Optional[float] = None,
+) -> Iterator[np.ndarray]:
+    """Decodes any format ffmpeg understands into mono float32 chunks, piping instead of converting on disk.
+    **start** and **duration** in seconds select part of the file"""
+    # Seeking before the input skips decoding everything in front of it
+    command = ["ffmpeg", "-loglevel", "error", "-ss", str(start), "-i", path]
+    if duration is not None:
+        command += ["-t", str(duration)]
+    process = subprocess.Popen(
+        command + ["-f", "f32le", "-ac", "1", "-ar", str(sample_rate), "-"],
+        stdout=subprocess.PIPE,
+    )
+    assert process.stdout is not None
+    try:
+        while True:
+            raw = process.stdout.read(chunk_frames * 4)
+            if not raw:
+                break
+            yield np.frombuffer(raw[: len(raw) - len(raw) % 4], dtype="<f4")
+    finally:
+        process.stdout.close()
+        process.wait()
+
+
+def open_audio(path: str, start: float = 0.0, duration: Optional[float] = None) -> Tuple[int, Iterator[np.ndarray]]:
+    """The sample rate and mono float32 chunks of an audio file, WAV files are decoded natively.
+    **start** and **duration** in seconds select part of the file"""
+    if path.lower().endswith(".wav"):
+        reader = WavReader(path)
+
+        def read_chunks() -> Iterator[np.ndarray]:
+            with reader:
+                first = int(start * reader.sample_rate)
+                end = reader.frames
+                if duration is not None:
+                    end = min(first + int(duration * reader.sample_rate), end)
+                for chunk_start in range(first, end, CHUNK_FRAMES):
+                    yield reader.read(chunk_start, min(CHUNK_FRAMES, end - chunk_start))
+
+        return reader.sample_rate, read_chunks()
+    return DEFAULT_SAMPLE_RATE, decode_with_ffmpeg(path, start=start, duration=duration)
@@ -0,0 +1,105 @@
+"""Main entrypoint for convert bins mode"""
+
+from lib.log import logline, enter_group, exit_group, error
+from ..preprocess.files import convert_bins
+from typing import Tuple
+from lib.io import IO, IOInput
+from lib.timer import Timer
+from glob import glob
+import numpy as np
+import time
+import json
+import os
+
+
+def get_io() -> IO:
+    return IO(
+        {
+            "i": IOInput(
+                glob("../../data/tracks/*.bins.json"),
+                list,
+                has_input=True,
+                arg_name="input_files",
+                descr="Input .bins.json files",
+                alias="input_files",
+                is_generic=True,
+            ),
+            "r": IOInput(
+                False,
+                bool,
+                has_input=False,
+                arg_name="remove_json",
+                descr="Remove every .bins.json file once it's converted",
+                alias="remove_json",
+            ),
+            "f": IOInput(
+                False,
+                bool,
+                has_input=False,
+                arg_name="force",
+                descr="Also convert files that already have a .bins.npy file",
+                alias="force",
+            ),
+        }
+    )
+
+
+def time_loads(json_path: str, npy_path: str) -> Tuple[float, float]:
+    """Seconds it takes to read the bins of both files"""
+    start_time = time.perf_counter()
+    with open(json_path, "rb") as json_str:
+        json.load(json_str)
+    json_time = time.perf_counter() - start_time
+
+    start_time = time.perf_counter()
+    np.array(np.load(npy_path, mmap_mode="r"))
+    return json_time, time.perf_counter() - start_time
+
+
+def mode_convert_bins() -> int:
+    """The main convert bins entrypoint"""
+    start_time = time.time()
+
+    io = get_io()
+
+    logline("convert bins")
+    enter_group()
+
+    json_paths = sorted(set(path for path in io.get("input_files") if path.endswith(".bins.json")))
+    if not json_paths:
+        error("no .bins.json files")
+        exit_group()
+        return 1
+
+    json_time = npy_time = 0.0
+    converted = 0
+    for json_path in json_paths:
+        npy_path = json_path[: -len(".json")] + ".npy"
+        if os.path.isfile(npy_path) and not io.get("force"):
+            logline('skipping "{}", it is already converted'.format(json_path))
+            continue
+
+        convert_bins(json_path)
+        file_json_time, file_npy_time = time_loads(json_path, npy_path)
+        json_time += file_json_time
+        npy_time += file_npy_time
+        converted += 1
+        logline('wrote "{}"'.format(npy_path))
+
+        if io.get("remove_json"):
+            os.remove(json_path)
+
+    if converted > 0:
+        logline(
+            "reading the bins took {}s as JSON and {}s as .npy, {}x faster".format(
+                round(json_time, 3), round(npy_time, 3), round(json_time / max(npy_time, 1e-9), 1)
+            )
+        )
+
+    exit_group()
+    logline(
+        "done converting {} files, runtime is {}".format(
+            converted, Timer.stringify_time(Timer.format_time(time.time() - start_time))
+        )
+    )
+    return 0
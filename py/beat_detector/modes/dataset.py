@@ -0,0 +1,264 @@
+"""Preprocessed datasets, stored once at their finest interval and resampled to coarser ones on load.
+A dataset is either a single .pickle file or a directory of shards, listed by an index per worker that wrote them"""
+
+from typing import Any, Callable, Collection, Dict, List, Optional, Set, Tuple, Union
+from .features import Preprocessed, get_beat_times, INTERVAL, OUT_VEC_SIZE, OFFSET_INDEX, NO_OFFSET
+from .frontend import FrontEnd
+from glob import glob
+import numpy as np
+import pathlib
+import pickle
+import json
+import os
+
+# Files per shard, a crash loses at most this many files of work
+SHARD_FILES = 16
+
+
+def label_outputs(beats: List[Tuple[float, float]], length: int, interval: int) -> np.ndarray:
+    """Marks every beat (time in ms, confidence) on the frame closest to it, ties go to the earlier frame.
+    The offset of the beat within that frame is kept as well, the most confident one's when a frame gets several"""
+    outputs = np.zeros((length, OUT_VEC_SIZE), dtype=np.float32)
+    outputs[:, OFFSET_INDEX] = NO_OFFSET
+    if len(beats) == 0:
+        return outputs
+
+    times, confidences = np.asarray(beats, dtype=np.float64).T
+    indices = (times // interval).astype(np.int64)
+    indices += times - indices * interval > interval / 2
+    in_range = indices < length
+    times, confidences, indices = times[in_range], confidences[in_range], indices[in_range]
+    np.maximum.at(outputs[:, 0], indices, confidences)
+
+    # The first of every frame in order of descending confidence
+    order = np.argsort(-confidences, kind="stable")
+    frames, first = np.unique(indices[order], return_index=True)
+    outputs[frames, OFFSET_INDEX] = (times[order][first] - frames * interval) / interval + NO_OFFSET
+    return outputs
+
+
+def beats_from_outputs(outputs: np.ndarray, interval: int) -> List[Tuple[float, float]]:
+    """Recovers beats from labelled frames, for datasets stored before beats were kept"""
+    indices = np.flatnonzero(outputs[:, 0])
+    if outputs.shape[1] > OFFSET_INDEX:
+        times = get_beat_times(indices, outputs[indices, OFFSET_INDEX], interval)
+    else:
+        times = indices * interval
+    return [(float(time), float(outputs[index, 0])) for time, index in zip(times, indices)]
+
+
+def upgrade_outputs(file_config: Dict[str, Any], interval: int) -> Dict[str, Any]:
+    """Adds the offsets to outputs stored before they were predicted. Relabelled from the beats when they're
+    there, otherwise every beat stays right on its frame"""
+    outputs = np.asarray(file_config["outputs"], dtype=np.float32)
+    if outputs.shape[1] == OUT_VEC_SIZE:
+        return file_config
+    if file_config.get("beats") is not None:
+        return {**file_config, "outputs": label_outputs(file_config["beats"], len(outputs), interval)}
+    offsets = np.full((len(outputs), OUT_VEC_SIZE - outputs.shape[1]), NO_OFFSET, dtype=np.float32)
+    return {**file_config, "outputs": np.concatenate([outputs, offsets], axis=1)}
+
+
+def pool_frames(features: np.ndarray, factor: int) -> np.ndarray:
+    """Averages every **factor** consecutive frames into one, a trailing partial frame is dropped"""
+    length = len(features) // factor
+    return features[: length * factor].reshape(length, factor, -1).mean(axis=1)
+
+
+def resample(file: Preprocessed, source_interval: int, interval: int) -> Preprocessed:
+    if interval == source_interval:
+        return file
+    if interval % source_interval != 0:
+        raise ValueError(
+            "interval {}ms is not a multiple of the dataset's interval of {}ms".format(interval, source_interval)
+        )
+
+    features = pool_frames(np.asarray(file.features, dtype=np.float32), interval // source_interval)
+    beats = file.beats if file.beats is not None else beats_from_outputs(np.asarray(file.outputs), source_interval)
+    return Preprocessed(
+        {
+            "file_name": file.file_name,
+            "features": features,
+            "outputs": label_outputs(beats, len(features), interval),
+            "beats": beats,
+            "shard": file.shard,
+        }
+    )
+
+
+def apply_frontend(file: Preprocessed, frontend: FrontEnd) -> Preprocessed:
+    if frontend.kind == "linear":
+        return file
+    return Preprocessed(
+        {
+            "file_name": file.file_name,
+            "features": frontend.apply(file.features),
+            "outputs": file.outputs,
+            "beats": file.beats,
+            # Silence is gated on the linear bins, also when running the model
+            "silent_spans": file.silent_spans,
+            "shard": file.shard,
+        },
+        frontend.length,
+    )
+
+
+def get_meta(contents: Any) -> Dict[str, Any]:
+    # Datasets without metadata are a plain list of files, always at the default interval
+    if isinstance(contents, list):
+        return {"interval": INTERVAL}
+    return contents["meta"]
+
+
+def is_sharded(path: str) -> bool:
+    return not path.endswith(".pickle")
+
+
+def read_index(directory: str) -> Tuple[Dict[str, Any], List[Dict[str, Any]]]:
+    """The meta and shards of a sharded dataset, joined from the indices of every worker"""
+    index_paths = sorted(glob(os.path.join(directory, "index-*.json")))
+    if not index_paths:
+        raise FileNotFoundError("no dataset index in {}".format(directory))
+
+    meta: Optional[Dict[str, Any]] = None
+    shards: List[Dict[str, Any]] = list()
+    for index_path in index_paths:
+        with open(index_path, "r") as index_file:
+            index = json.load(index_file)
+        if meta is not None and index["meta"] != meta:
+            raise ValueError("{} was written with another interval or frontend than the rest".format(index_path))
+        meta = index["meta"]
+        shards.extend(index["shards"])
+    return meta, shards
+
+
+def read_contents(path: str, names: Optional[Collection[str]]) -> Tuple[Dict[str, Any], List[Dict[str, Any]]]:
+    """The meta and file configs of a dataset, of a sharded one only the shards holding **names** are read"""
+    if not is_sharded(path):
+        with open(path, "rb") as in_file:
+            contents = pickle.load(in_file)
+        file_configs = contents if isinstance(contents, list) else contents["files"]
+        return get_meta(contents), [config for config in file_configs if names is None or config["file_name"] in names]
+
+    meta, shards = read_index(path)
+    file_configs: List[Dict[str, Any]] = list()
+    for shard in shards:
+        if names is not None and not any(name in names for name in shard["files"]):
+            continue
+        with open(os.path.join(path, shard["name"]), "rb") as in_file:
+            for config in pickle.load(in_file):
+                if names is None or config["file_name"] in names:
+                    file_configs.append({**config, "shard": shard["name"]})
+    return meta, file_configs
+
+
+def load_dataset(
+    path: str,
+    interval: Optional[int] = None,
+    frontend: Optional[FrontEnd] = None,
+    names: Optional[Collection[str]] = None,
+) -> Tuple[List[Preprocessed], int, FrontEnd]:
+    """Loads a dataset, resampled to **interval** and run through **frontend** when they're given, otherwise
+    the dataset's own are used. Only loads the files in **names** if it's given. Returns the files, their interval
+    and the frontend they went through"""
+    meta, file_configs = read_contents(path, names)
+    frontend = frontend or FrontEnd.from_config(meta.get("frontend"))
+    files = [Preprocessed(upgrade_outputs(file_config, meta["interval"])) for file_config in file_configs]
+    if interval:
+        files = [resample(file, meta["interval"], interval) for file in files]
+    return [apply_frontend(file, frontend) for file in files], interval or meta["interval"], frontend
+
+
+def get_dataset_meta(interval: int, frontend: FrontEnd) -> Dict[str, Any]:
+    return {"interval": interval, "frontend": frontend.to_config()}
+
+
+def save_dataset(path: str, file_configs: List[Dict[str, Any]], interval: int, frontend: FrontEnd):
+    """Stores the linear bins, **frontend** is only what loaders use by default"""
+    pathlib.Path(os.path.dirname(path)).mkdir(parents=True, exist_ok=True)
+    with open(path, "wb+") as out_file:
+        pickle.dump({"meta": get_dataset_meta(interval, frontend), "files": file_configs}, out_file)
+
+
+def write_atomic(path: str, mode: str, write: Callable[[Any], None]):
+    """Writes to a temporary file that replaces **path** once it's complete, readers never see half a file"""
+    with open(path + ".tmp", mode) as out_file:
+        write(out_file)
+    os.replace(path + ".tmp", path)
+
+
+class PickleWriter:
+    """Collects every file and writes them to a single .pickle file when closed"""
+
+    def __init__(self, path: str, interval: int, frontend: FrontEnd):
+        self.path = path
+        self.interval = interval
+        self.frontend = frontend
+        self.file_configs: List[Dict[str, Any]] = list()
+        self.done_files: Set[str] = set()
+
+    def add(self, file_config: Dict[str, Any]):
+        self.file_configs.append(file_config)
+
+    def close(self):
+        save_dataset(self.path, self.file_configs, self.interval, self.frontend)
+
+
+class ShardWriter:
+    """Writes files to shards as they come in, every worker to its own shards and index so they can run
+    side by side, even on other machines sharing the directory. Picks up where an earlier run of the worker stopped"""
+
+    def __init__(
+        self, directory: str, interval: int, frontend: FrontEnd, worker: int = 0, shard_files: int = SHARD_FILES
+    ):
+        self.directory = directory
+        self.worker = worker
+        self.shard_files = shard_files
+        self.index_path = os.path.join(directory, "index-{:03d}.json".format(worker))
+        self.pending: List[Dict[str, Any]] = list()
+
+        pathlib.Path(directory).mkdir(parents=True, exist_ok=True)
+        self.index: Dict[str, Any] = {"meta": get_dataset_meta(interval, frontend), "shards": list()}
+        if os.path.isfile(self.index_path):
+            with open(self.index_path, "r") as index_file:
+                index = json.load(index_file)
+            if index["meta"] != self.index["meta"]:
+                raise ValueError("{} was written with another interval or frontend".format(self.index_path))
+            self.index = index
+
+    @property
+    def done_files(self) -> Set[str]:
+        """Files already stored by an earlier run"""
+        return set(name for shard in self.index["shards"] for name in shard["files"])
+
+    def add(self, file_config: Dict[str, Any]):
+        self.pending.append(file_config)
+        if len(self.pending) >= self.shard_files:
+            self.flush()
+
+    def flush(self):
+        if not self.pending:
+            return
+        name = "shard-{:03d}-{:05d}.pickle".format(self.worker, len(self.index["shards"]))
+        write_atomic(os.path.join(self.directory, name), "wb", lambda out_file: pickle.dump(self.pending, out_file))
+        self.index["shards"].append(
+            {
+                "name": name,
+                "files": [config["file_name"] for config in self.pending],
+                "frames": sum(len(config["features"]) for config in self.pending),
+            }
+        )
+        # The index only lists a shard once it's completely written
+        write_atomic(self.index_path, "w", lambda out_file: json.dump(self.index, out_file, indent=1))
+        self.pending = list()
+
+    def close(self):
+        self.flush()
+
+
+def create_writer(
+    path: str, interval: int, frontend: FrontEnd, worker: int = 0, shard_files: int = SHARD_FILES
+) -> Union[PickleWriter, ShardWriter]:
+    if is_sharded(path):
+        return ShardWriter(path, interval, frontend, worker, shard_files)
+    return PickleWriter(path, interval, frontend)
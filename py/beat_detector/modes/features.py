@@ -1,4 +1,5 @@
-from typing import Any, List, Dict
+from typing import Any, List, Dict, Optional, Tuple
+from .silence import find_silent_spans
 import numpy as np
 
 # Interval in milliseconds
@@ -10,8 +11,15 @@ BINS = 100
 # Padding from spectrum description
 FEATURE_LEN = BINS
 
-# prediction is of whether this is a beat
-OUT_VEC_SIZE = 1
+# prediction is of whether this is a beat, and where in the frame it falls
+OUT_VEC_SIZE = 2
+
+# Column of the outputs holding the offset of the beat within its frame, 0 being half an interval before the
+# frame's time and 1 half an interval after it
+OFFSET_INDEX = 1
+
+# Offset of frames without a beat, right on the frame's time
+NO_OFFSET = 0.5
 
 # Range that it needs to be correct
 CORRECT_RANGE = 0.2
@@ -35,26 +43,41 @@ class Features:
 class ExpectedOutput:
     """A class describing the expected output at a given time unit of sound"""
 
-    def __init__(self, beat_confidence: float):
+    def __init__(self, beat_confidence: float, beat_offset: float = NO_OFFSET):
         self.beat_confidence = beat_confidence
+        self.beat_offset = beat_offset
 
     def to_arr(self):
         """Convert to an array"""
-        return [self.beat_confidence]
+        return [self.beat_confidence, self.beat_offset]
 
 
 class Preprocessed:
     """Preprocessed data"""
 
-    def __init__(self, preprocessed_json: Dict[str, Any]):
+    def __init__(self, preprocessed_json: Dict[str, Any], feature_len: int = FEATURE_LEN):
         self.file_name: str = preprocessed_json["file_name"]
         self.features: List[float] = preprocessed_json["features"]
         self.outputs: List[float] = preprocessed_json["outputs"]
+        # Beat times in ms with their confidence, missing in datasets from before they were stored
+        self.beats: Optional[List[Tuple[float, float]]] = preprocessed_json.get("beats")
+        # Shard of a sharded dataset the file is stored in
+        self.shard: Optional[str] = preprocessed_json.get("shard")
 
-        assert np.array(self.features).shape[1] == Features.length()
+        assert np.array(self.features).shape[1] == feature_len
         assert np.array(self.outputs).shape[1] == OUT_VEC_SIZE
 
+        if "silent_spans" in preprocessed_json:
+            self.silent_spans: List[Tuple[int, int]] = preprocessed_json["silent_spans"]
+        else:
+            # Preprocessed before silence was marked
+            self.silent_spans = find_silent_spans(np.array(self.features))
+
 
 def is_in_range(diff: float):
     return abs(diff) <= CORRECT_RANGE
 
+
+def get_beat_times(frames: np.ndarray, offsets: np.ndarray, interval: int) -> np.ndarray:
+    """Times in ms of beats on **frames**, moved within their frame by the predicted offsets"""
+    return (np.asarray(frames) + np.clip(offsets, 0, 1) - NO_OFFSET) * interval
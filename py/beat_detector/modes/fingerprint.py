@@ -0,0 +1,127 @@
+"""Fingerprints of tracks from pairs of spectral peaks, to find the same song stored under different names"""
+from typing import Dict, List, Sequence, Set, Tuple
+from scipy.ndimage import maximum_filter
+import numpy as np
+
+# Bands the bins get pooled into first, coarse enough for a remaster to keep its peaks in the same band
+BANDS = 32
+
+# A peak is the largest value this many frames before and after it, and one band to either side
+PEAK_FRAMES = 6
+
+# Peaks every anchor gets paired with, and how many frames ahead they may be
+FAN_OUT = 4
+MAX_PAIR_FRAMES = 63
+
+# Alignments are counted in steps of this many frames, so a one frame shift still lines up
+OFFSET_STEP = 2
+
+# Share of the hashes of the shorter track that have to line up at one offset
+DUPLICATE_SCORE = 0.2
+# Matches required no matter how short the tracks are
+MIN_MATCHES = 20
+
+
+def pool_bands(frames: np.ndarray, bands: int = BANDS) -> np.ndarray:
+    """Averages the bins of every frame into at most **bands** equally wide bands"""
+    bands = min(bands, frames.shape[1])
+    edges = np.linspace(0, frames.shape[1], bands + 1).astype(np.int64)
+    return np.add.reduceat(frames, edges[:-1], axis=1) / np.diff(edges)
+
+
+def find_peaks(spectrum: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """Frames and bands of the local maxima that stand out above their frame's mean"""
+    # Past the edges nothing counts, so a peak there only has to beat what's inside
+    local_max = maximum_filter(spectrum, size=(PEAK_FRAMES * 2 + 1, 3), mode="constant", cval=-np.inf)
+    peaks = (spectrum >= local_max) & (spectrum > spectrum.mean(axis=1, keepdims=True)) & (spectrum > 0)
+    # Row-major, so they come out sorted by frame
+    return np.nonzero(peaks)
+
+
+def fingerprint(frames: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """Hashes of (band, band, frames between) peak pairs along with the frame of their first peak"""
+    frames = np.asarray(frames, dtype=np.float32)
+    if len(frames) == 0:
+        return np.zeros(0, dtype=np.uint32), np.zeros(0, dtype=np.int64)
+    times, bands = find_peaks(pool_bands(frames))
+
+    hashes: List[np.ndarray] = list()
+    anchors: List[np.ndarray] = list()
+    for distance in range(1, FAN_OUT + 1):
+        deltas = times[distance:] - times[:-distance]
+        valid = (deltas > 0) & (deltas <= MAX_PAIR_FRAMES)
+        first = bands[:-distance][valid].astype(np.uint32)
+        second = bands[distance:][valid].astype(np.uint32)
+        hashes.append((first << 16) | (second << 8) | deltas[valid].astype(np.uint32))
+        anchors.append(times[:-distance][valid].astype(np.int64))
+    return np.concatenate(hashes), np.concatenate(anchors)
+
+
+class FingerprintIndex:
+    """All hashes of a set of tracks sorted by hash, every query scores how well it lines up with each track"""
+
+    def __init__(self, fingerprints: Sequence[Tuple[np.ndarray, np.ndarray]]):
+        self.sizes = np.array([len(hashes) for hashes, _ in fingerprints], dtype=np.int64)
+        tracks = np.repeat(np.arange(len(fingerprints), dtype=np.int64), self.sizes)
+        hashes = np.concatenate([hashes for hashes, _ in fingerprints]) if fingerprints else np.zeros(0, np.uint32)
+        times = np.concatenate([times for _, times in fingerprints]) if fingerprints else np.zeros(0, np.int64)
+
+        order = np.argsort(hashes, kind="stable")
+        self.hashes = hashes[order]
+        self.times = times[order]
+        self.tracks = tracks[order]
+
+    def query(self, hashes: np.ndarray, times: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        """Every track with a matching hash, and the most hashes that line up at a single offset for each"""
+        left = np.searchsorted(self.hashes, hashes, side="left")
+        counts = np.searchsorted(self.hashes, hashes, side="right") - left
+        total = int(counts.sum())
+        if total == 0:
+            return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+
+        # Indices of every posting of every hash, without a loop over the hashes
+        starts = np.repeat(left - np.cumsum(counts) + counts, counts)
+        matched = starts + np.arange(total)
+        offsets = (self.times[matched] - np.repeat(times, counts)) // OFFSET_STEP
+
+        # One key per track and offset, counting the keys counts the votes for every alignment
+        shift = int(np.abs(offsets).max())
+        span = 2 * shift + 1
+        unique_keys, votes = np.unique(self.tracks[matched] * span + offsets + shift, return_counts=True)
+        key_tracks = unique_keys // span
+
+        # Keys are sorted, so every track's offsets are next to each other
+        track_starts = np.flatnonzero(np.diff(np.concatenate([[-1], key_tracks])))
+        return key_tracks[track_starts], np.maximum.reduceat(votes, track_starts)
+
+
+def find_duplicates(
+    names: Sequence[str], fingerprints: Sequence[Tuple[np.ndarray, np.ndarray]], score: float = DUPLICATE_SCORE
+) -> List[List[str]]:
+    """Groups of names whose tracks are near duplicates of each other, each sorted. Tracks without any are left out"""
+    index = FingerprintIndex(fingerprints)
+    parents = list(range(len(names)))
+
+    def find(track: int) -> int:
+        while parents[track] != track:
+            parents[track] = parents[parents[track]]
+            track = parents[track]
+        return track
+
+    for track, (hashes, times) in enumerate(fingerprints):
+        if len(hashes) == 0:
+            continue
+        matched, votes = index.query(hashes, times)
+        shorter = np.minimum(index.sizes[matched], len(hashes))
+        for other in matched[(matched != track) & (votes >= MIN_MATCHES) & (votes >= shorter * score)]:
+            parents[find(int(other))] = find(track)
+
+    groups: Dict[int, List[str]] = dict()
+    for track, name in enumerate(names):
+        groups.setdefault(find(track), list()).append(name)
+    return sorted(sorted(group) for group in groups.values() if len(group) > 1)
+
+
+def get_dropped(groups: List[List[str]]) -> Set[str]:
+    """Every name but the first of each group of duplicates, the first being the one that's kept"""
+    return set(name for group in groups for name in group[1:])
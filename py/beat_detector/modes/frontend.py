@@ -0,0 +1,104 @@
+"""Pools the linear spectrum bins into fewer log or mel spaced bands before they reach the model"""
+from typing import Any, Dict, Optional
+from .audio import DEFAULT_SAMPLE_RATE
+from scipy import sparse
+from .features import BINS
+import numpy as np
+import json
+import os
+
+FRONTENDS = ("linear", "mel", "log")
+
+# Lowest frequency a log spaced band starts at, everything below it ends up in the first band
+LOG_MIN_FREQUENCY = 30.0
+
+
+def hz_to_mel(hz: np.ndarray) -> np.ndarray:
+    return 2595 * np.log10(1 + hz / 700)
+
+
+def mel_to_hz(mel: np.ndarray) -> np.ndarray:
+    return 700 * (10 ** (mel / 2595) - 1)
+
+
+def band_edges(kind: str, bands: int, bins: int, sample_rate: int) -> np.ndarray:
+    """Edges of the bands, in (fractional) bins"""
+    nyquist = sample_rate / 2
+    if kind == "mel":
+        edges_hz = mel_to_hz(np.linspace(0, hz_to_mel(np.array(nyquist)), bands + 1))
+    else:
+        edges_hz = np.concatenate([[0], np.geomspace(LOG_MIN_FREQUENCY, nyquist, bands)])
+    edges = edges_hz / nyquist * bins
+
+    # Low bands can be narrower than a single bin, which would make them copies of
+    # their neighbours. Widen them to a full bin and let the higher ones give way
+    for i in range(1, bands):
+        edges[i] = min(max(edges[i], edges[i - 1] + 1), bins - (bands - i))
+    edges[-1] = bins
+    return edges
+
+
+def pooling_matrix(
+    kind: str, bands: int, bins: int = BINS, sample_rate: int = DEFAULT_SAMPLE_RATE
+) -> sparse.csr_matrix:
+    """A (bins, bands) matrix that averages the bins every band overlaps, weighted by how much it overlaps them"""
+    edges = band_edges(kind, bands, bins, sample_rate)
+    rows, cols, weights = list(), list(), list()
+    for band in range(bands):
+        low, high = edges[band], edges[band + 1]
+        for bin_index in range(int(np.floor(low)), int(np.ceil(high))):
+            overlap = min(high, bin_index + 1) - max(low, bin_index)
+            if overlap > 0:
+                rows.append(bin_index)
+                cols.append(band)
+                weights.append(overlap / (high - low))
+    return sparse.csr_matrix((weights, (rows, cols)), shape=(bins, bands), dtype=np.float32)
+
+
+class FrontEnd:
+    """Turns frames of linear spectrum bins into the features the model sees"""
+
+    def __init__(self, kind: str = "linear", bands: int = BINS):
+        if kind not in FRONTENDS:
+            raise ValueError("unknown frontend {}, choose one of {}".format(kind, ", ".join(FRONTENDS)))
+        if not 0 < bands <= BINS:
+            raise ValueError("bands has to be between 1 and {}".format(BINS))
+
+        self.kind = kind
+        self.bands = BINS if kind == "linear" else bands
+        self.matrix = None if kind == "linear" else pooling_matrix(kind, self.bands)
+
+    @property
+    def length(self) -> int:
+        return self.bands
+
+    def apply(self, frames: np.ndarray) -> np.ndarray:
+        """Pools an (n, BINS) array of frames into (n, bands)"""
+        frames = np.asarray(frames, dtype=np.float32)
+        if self.matrix is None:
+            return frames
+        return np.asarray(frames @ self.matrix, dtype=np.float32)
+
+    def to_config(self) -> Dict[str, Any]:
+        return {"kind": self.kind, "bands": self.bands}
+
+    @staticmethod
+    def from_config(config: Optional[Dict[str, Any]]) -> "FrontEnd":
+        # Anything stored before frontends existed fed the linear bins straight to the model
+        if not config:
+            return FrontEnd()
+        return FrontEnd(config["kind"], config["bands"])
+
+    def __eq__(self, other: object) -> bool:
+        return isinstance(other, FrontEnd) and self.to_config() == other.to_config()
+
+    def __str__(self) -> str:
+        return "{} ({} bands)".format(self.kind, self.bands)
+
+
+def load_frontend(train_config_path: str) -> FrontEnd:
+    """The frontend a model was trained with, linear when there's no train config"""
+    if not os.path.isfile(train_config_path):
+        return FrontEnd()
+    with open(train_config_path, "r") as train_config_file:
+        return FrontEnd.from_config(json.load(train_config_file).get("frontend"))
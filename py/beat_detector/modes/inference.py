@@ -0,0 +1,185 @@
+"""Inference backends, the Keras model itself, a compiled step function or a TFLite conversion at reduced precision"""
+from .model import create_model, create_step_model, read_weights, STATE_NAMES
+from .features import FEATURE_LEN, OUT_VEC_SIZE
+from typing import Any, Dict, List, Optional, Tuple, Union
+from abc import ABC, abstractmethod
+import numpy as np
+import warnings
+import json
+import time
+import os
+
+with warnings.catch_warnings():
+    warnings.filterwarnings("ignore", category=FutureWarning)
+    from tensorflow.keras.models import Sequential
+    import tensorflow as tf
+
+# float32 runs the converted model as is, float16 halves the weights and int8 quantizes them (dynamic range)
+PRECISIONS = ("float32", "float16", "int8")
+
+LITE_EXTENSION = ".tflite"
+
+
+def get_lite_path(weights_path: str, precision: str) -> str:
+    """Where the conversion of a weights file is stored, ./data/weights.h5 turns into ./data/weights.int8.tflite"""
+    base = weights_path[: weights_path.rfind(".")] if "." in weights_path else weights_path
+    return "{}.{}{}".format(base, precision, LITE_EXTENSION)
+
+
+def convert_weights(weights_path: str, precision: str, feature_len: int = FEATURE_LEN) -> bytes:
+    """Converts trained weights to a TFLite model that runs one frame at a time, its states passed in and out"""
+    if precision not in PRECISIONS:
+        raise ValueError("unknown precision {}, choose one of {}".format(precision, ", ".join(PRECISIONS)))
+
+    step_model = create_step_model(feature_len)
+    step_model.set_weights(read_weights(weights_path))
+
+    state_spec = tf.TensorSpec((1, feature_len), tf.float32)
+
+    # Named inputs and outputs, a plain Keras conversion would name them after its layers
+    @tf.function(input_signature=[tf.TensorSpec((1, feature_len, 1), tf.float32)] + [state_spec] * len(STATE_NAMES))
+    def step(frames, h1, c1, h2, c2):
+        outputs = step_model([frames, h1, c1, h2, c2])
+        return {"predictions": outputs[0], **dict(zip(STATE_NAMES, outputs[1:]))}
+
+    converter = tf.lite.TFLiteConverter.from_concrete_functions([step.get_concrete_function()], step_model)
+    if precision != "float32":
+        converter.optimizations = [tf.lite.Optimize.DEFAULT]
+    if precision == "float16":
+        converter.target_spec.supported_types = [tf.float16]
+    return converter.convert()
+
+
+class StepModel(ABC):
+    """The parts of the Keras API the modes use, for a model that takes and returns its states every step"""
+
+    backend = ""
+    # Whether step takes the frames and states of several sessions stacked along the batch dimension
+    supports_batches = False
+
+    def __init__(self, feature_len: int, out_size: int):
+        self.feature_len = feature_len
+        self.out_size = out_size
+        self.states: Dict[str, Any] = dict()
+        self.reset_states()
+
+    @abstractmethod
+    def step(self, frames: np.ndarray, states: Dict[str, Any]) -> Dict[str, Any]:
+        """Runs a single frame, returns the predictions along with the new states"""
+
+    @property
+    def input_shape(self) -> Tuple[None, int, int]:
+        return (None, self.feature_len, 1)
+
+    @property
+    def output_shape(self) -> Tuple[None, int]:
+        return (None, self.out_size)
+
+    def reset_states(self):
+        self.states = {name: np.zeros((1, self.feature_len), dtype=np.float32) for name in STATE_NAMES}
+
+    def get_states(self) -> List[np.ndarray]:
+        return [np.array(self.states[name]) for name in STATE_NAMES]
+
+    def set_states(self, states: List[np.ndarray]):
+        self.states = dict(zip(STATE_NAMES, states))
+
+    def predict_on_batch(self, frames: np.ndarray) -> np.ndarray:
+        outputs = self.step(np.asarray(frames, dtype=np.float32), self.states)
+        self.states = {name: outputs[name] for name in STATE_NAMES}
+        return np.asarray(outputs["predictions"])
+
+    def predict(self, frames: np.ndarray, batch_size: int = 1, verbose: int = 0) -> np.ndarray:
+        """Runs frames one after the other, like the stateful Keras model with a batch size of 1"""
+        frames = np.asarray(frames, dtype=np.float32)
+        if len(frames) == 0:
+            return np.zeros((0, self.out_size), dtype=np.float32)
+        return np.concatenate([self.predict_on_batch(frames[i : i + 1]) for i in range(len(frames))])
+
+    def to_json(self) -> str:
+        return json.dumps({"backend": self.backend, "feature_len": self.feature_len})
+
+
+class CompiledModel(StepModel):
+    """The step model traced once into a graph with a fixed signature, skipping everything Keras does per predict call.
+    The batch dimension is left open, so the realtime server can run the frames of several sessions in one step"""
+
+    backend = "compiled"
+    supports_batches = True
+
+    def __init__(self, weights_path: str, feature_len: int = FEATURE_LEN, weights: Optional[List[np.ndarray]] = None):
+        self.step_model = create_step_model(feature_len, batch_size=None)
+        self.step_model.set_weights(read_weights(weights_path) if weights is None else weights)
+        state_spec = tf.TensorSpec((None, feature_len), tf.float32)
+        self._step = tf.function(
+            self._run_step,
+            input_signature=[tf.TensorSpec((None, feature_len, 1), tf.float32)] + [state_spec] * len(STATE_NAMES),
+        )
+        super().__init__(feature_len, OUT_VEC_SIZE)
+
+    def _run_step(self, frames, h1, c1, h2, c2):
+        outputs = self.step_model([frames, h1, c1, h2, c2], training=False)
+        return {"predictions": outputs[0], **dict(zip(STATE_NAMES, outputs[1:]))}
+
+    def step(self, frames: np.ndarray, states: Dict[str, Any]) -> Dict[str, Any]:
+        return self._step(frames, *[states[name] for name in STATE_NAMES])
+
+
+class LiteModel(StepModel):
+    """Runs a converted model, its states kept outside of the interpreter"""
+
+    backend = "tflite"
+
+    def __init__(self, model_path: Optional[str] = None, model_content: Optional[bytes] = None):
+        with warnings.catch_warnings():
+            # Deprecated in favour of a separate package, which isn't a dependency
+            warnings.filterwarnings("ignore", category=UserWarning)
+            self.interpreter = tf.lite.Interpreter(model_path=model_path, model_content=model_content, num_threads=1)
+        self.runner = self.interpreter.get_signature_runner()
+        self.size = len(model_content) if model_content is not None else os.path.getsize(model_path)
+        super().__init__(
+            int(self.runner.get_input_details()["frames"]["shape"][1]),
+            int(self.runner.get_output_details()["predictions"]["shape"][-1]),
+        )
+
+    def step(self, frames: np.ndarray, states: Dict[str, Any]) -> Dict[str, Any]:
+        return self.runner(frames=frames, **states)
+
+
+def load_model(
+    weights_path: str, feature_len: int = FEATURE_LEN, compiled: bool = True, weights: Optional[List[np.ndarray]] = None
+) -> Union[Sequential, StepModel]:
+    """The model for a batch size of 1. A .tflite file is run by TFLite, weights by the compiled step model
+    or by Keras itself when **compiled** is off. **weights** read by read_weights skip reading the file again"""
+    if weights_path.endswith(LITE_EXTENSION):
+        model = LiteModel(weights_path)
+        if model.feature_len != feature_len:
+            raise ValueError("{} takes {} features, not {}".format(weights_path, model.feature_len, feature_len))
+        return model
+    if compiled:
+        return CompiledModel(weights_path, feature_len, weights)
+    model = create_model(1, feature_len=feature_len)
+    if weights is None:
+        model.load_weights(weights_path)
+    else:
+        model.set_weights(weights)
+    return model
+
+
+def warm_up(model: Union[Sequential, StepModel]) -> float:
+    """Runs a first frame so the graph is built before anyone waits on it, returns how many ms that took"""
+    start_time = time.perf_counter()
+    model.predict_on_batch(np.zeros((1, model.input_shape[1], 1), dtype=np.float32))
+    model.reset_states()
+    return (time.perf_counter() - start_time) * 1000
+
+
+def step_latency(model: Union[Sequential, StepModel], steps: int = 200) -> float:
+    """Mean ms a single predict_on_batch call takes, the way the realtime server calls it"""
+    frames = np.random.uniform(0, 1, (steps, 1, model.input_shape[1], 1)).astype(np.float32)
+    warm_up(model)
+    start_time = time.perf_counter()
+    for frame in frames:
+        model.predict_on_batch(frame)
+    model.reset_states()
+    return (time.perf_counter() - start_time) * 1000 / steps
@@ -0,0 +1,261 @@
+"""Main entrypoint for load test mode"""
+
+from lib.log import logline, enter_group, exit_group, warn, error
+from ..dataset import load_dataset
+from ..frontend import FrontEnd
+from ..features import INTERVAL
+from typing import Dict, List, Optional, Tuple
+from urllib.parse import urlsplit
+from lib.io import IO, IOInput
+import http.client
+import numpy as np
+import threading
+import json
+import time
+
+# Seconds before a request is given up on
+REQUEST_TIMEOUT = 10
+
+
+def get_io() -> IO:
+    return IO(
+        {
+            "i": IOInput(
+                "./data/preprocessed/",
+                str,
+                has_input=True,
+                arg_name="input_preprocessed",
+                descr="Preprocessed dataset whose frames are replayed",
+                alias="input_preprocessed",
+                is_generic=True,
+            ),
+            "u": IOInput(
+                "http://localhost:1234",
+                str,
+                has_input=True,
+                arg_name="url",
+                descr="URL of a running realtime_test server",
+                alias="url",
+            ),
+            "n": IOInput(
+                INTERVAL,
+                int,
+                has_input=True,
+                arg_name="interval",
+                descr="Interval in ms at which every client sends a frame, also the latency budget",
+                alias="interval",
+            ),
+            "c": IOInput(
+                1, int, has_input=True, arg_name="clients", descr="Clients in the first step", alias="clients"
+            ),
+            "mc": IOInput(
+                256,
+                int,
+                has_input=True,
+                arg_name="max_clients",
+                descr="Stop after this many clients",
+                alias="max_clients",
+            ),
+            "d": IOInput(
+                10.0,
+                float,
+                has_input=True,
+                arg_name="duration",
+                descr="Seconds every step runs for",
+                alias="duration",
+            ),
+            "q": IOInput(
+                99.0,
+                float,
+                has_input=True,
+                arg_name="percentile",
+                descr="Latency percentile that has to stay within the interval for a step to pass",
+                alias="percentile",
+            ),
+        }
+    )
+
+
+def read_frames(io: IO) -> List[np.ndarray]:
+    # The server runs its own frontend, it's sent the linear bins like a browser would
+    files, _, _ = load_dataset(io.get("input_preprocessed"), io.get("interval"), FrontEnd())
+    # Clients cycle through a track, an empty one has nothing to send
+    return [np.array(file.features, dtype=np.float32) for file in files if len(file.features) > 0]
+
+
+class Client(threading.Thread):
+    """A simulated listener, sending one frame every interval on its own connection"""
+
+    def __init__(self, url: str, session_id: str, frames: np.ndarray, interval: int, stop_at: float):
+        super().__init__(daemon=True)
+        self.url = urlsplit(url)
+        self.session_id = session_id
+        self.frames = frames
+        self.interval = interval / 1000
+        self.stop_at = stop_at
+        self.latencies: List[float] = list()
+        self.errors = 0
+        # Sends that were skipped because the previous response came in too late, like a real client would
+        self.late_sends = 0
+
+    def send(self, connection: http.client.HTTPConnection, frame: np.ndarray):
+        body = json.dumps({"session": self.session_id, "data": frame.tolist()})
+        connection.request("POST", "/api/beat", body, {"Content-Type": "application/json"})
+        response = connection.getresponse()
+        response.read()
+        if response.status != 200:
+            raise http.client.HTTPException("status {}".format(response.status))
+
+    def run(self):
+        connection = http.client.HTTPConnection(self.url.hostname, self.url.port or 80, timeout=REQUEST_TIMEOUT)
+        next_send = time.perf_counter()
+        index = 0
+        while next_send < self.stop_at:
+            delay = next_send - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+            elif delay < -self.interval:
+                skipped = int(-delay / self.interval)
+                self.late_sends += skipped
+                next_send += skipped * self.interval
+
+            start_time = time.perf_counter()
+            try:
+                self.send(connection, self.frames[index % len(self.frames)])
+                self.latencies.append(time.perf_counter() - start_time)
+            except (OSError, http.client.HTTPException):
+                self.errors += 1
+                connection.close()
+            index += 1
+            next_send += self.interval
+        connection.close()
+
+
+def get_server_cpu(url: str) -> Optional[List[float]]:
+    """CPU seconds used by every process of the server, read from its metrics endpoint"""
+    parts = urlsplit(url)
+    connection = http.client.HTTPConnection(parts.hostname, parts.port or 80, timeout=REQUEST_TIMEOUT)
+    try:
+        connection.request("GET", "/api/metrics")
+        lines = connection.getresponse().read().decode("utf8").splitlines()
+    except (OSError, http.client.HTTPException):
+        return None
+    finally:
+        connection.close()
+    # A series per worker when the server runs more than one
+    return [
+        float(line.split(" ")[1])
+        for line in lines
+        if line.startswith(("process_cpu_seconds_total ", "process_cpu_seconds_total{"))
+    ]
+
+
+def run_step(io: IO, tracks: List[np.ndarray], clients: int) -> Dict[str, float]:
+    """Runs a number of clients for the configured duration and collects their latencies"""
+    duration = io.get("duration")
+    # Spread the clients over a single interval so they don't all hit the server at once
+    spread = io.get("interval") / 1000 / clients
+    stop_at = time.perf_counter() + duration + io.get("interval") / 1000
+
+    cpu_start = get_server_cpu(io.get("url"))
+    threads: List[Client] = list()
+    for i in range(clients):
+        session_id = "load-{}-{}".format(clients, i)
+        threads.append(Client(io.get("url"), session_id, tracks[i % len(tracks)], io.get("interval"), stop_at))
+    for thread in threads:
+        thread.start()
+        time.sleep(spread)
+    for thread in threads:
+        thread.join()
+    cpu_end = get_server_cpu(io.get("url"))
+
+    latencies = np.array([latency for thread in threads for latency in thread.latencies]) * 1000
+    if len(latencies) == 0:
+        latencies = np.array([np.inf])
+    p50, p95, p99, percentile = np.percentile(latencies, [50, 95, 99, io.get("percentile")])
+    return {
+        "throughput": len(latencies) / duration,
+        "p50": p50,
+        "p95": p95,
+        "p99": p99,
+        "percentile": percentile,
+        "misses": float(np.count_nonzero(latencies > io.get("interval"))) / len(latencies) * 100,
+        "late": sum(thread.late_sends for thread in threads),
+        "errors": sum(thread.errors for thread in threads),
+        "cpu": (sum(cpu_end) - sum(cpu_start)) / duration * 100 if cpu_start and cpu_end else -1,
+    }
+
+
+def format_step(clients: int, result: Dict[str, float]) -> str:
+    cpu = "{:.0f}%".format(result["cpu"]) if result["cpu"] >= 0 else "?"
+    return (
+        "{} clients: {:.1f} req/s, p50 {:.1f}ms, p95 {:.1f}ms, p99 {:.1f}ms, "
+        "{:.1f}% over budget, {} late sends, {} errors, server cpu {}".format(
+            clients,
+            result["throughput"],
+            result["p50"],
+            result["p95"],
+            result["p99"],
+            result["misses"],
+            int(result["late"]),
+            int(result["errors"]),
+            cpu,
+        )
+    )
+
+
+def run_steps(io: IO, tracks: List[np.ndarray]) -> Optional[Tuple[int, Dict[str, float]]]:
+    """Doubles the amount of clients until the latency budget breaks, returns the last step that held"""
+    last_passed: Optional[Tuple[int, Dict[str, float]]] = None
+    clients = io.get("clients")
+    while clients <= io.get("max_clients"):
+        result = run_step(io, tracks, clients)
+        logline(format_step(clients, result))
+        if result["percentile"] > io.get("interval") or result["errors"] > 0:
+            warn(
+                "budget broke at {} clients, p{:g} was {:.1f}ms".format(
+                    clients, io.get("percentile"), result["percentile"]
+                )
+            )
+            return last_passed
+        last_passed = (clients, result)
+        clients *= 2
+    return last_passed
+
+
+def mode_load_test():
+    """The main load test entrypoint"""
+    io = get_io()
+
+    logline("load test")
+    enter_group()
+
+    server_cpu = get_server_cpu(io.get("url"))
+    if server_cpu is None:
+        error("no realtime_test server reachable at {}, start one first".format(io.get("url")))
+        exit_group()
+        return 1
+    logline("server runs {} worker(s)".format(max(len(server_cpu), 1)))
+
+    logline("reading frames")
+    tracks = read_frames(io)
+    if not tracks:
+        error("no frames to send in {}".format(io.get("input_preprocessed")))
+        exit_group()
+        return 1
+
+    logline("warming up the server")
+    Client(io.get("url"), "load-warmup", tracks[0], io.get("interval"), time.perf_counter() + 1).run()
+
+    logline("stepping up clients sending every {}ms for {}s per step".format(io.get("interval"), io.get("duration")))
+    enter_group()
+    last_passed = run_steps(io, tracks)
+    exit_group()
+
+    if last_passed is None:
+        logline("not even {} clients stayed within the budget".format(io.get("clients")))
+    else:
+        logline("sustained {} clients within the {}ms budget".format(last_passed[0], io.get("interval")))
+
+    exit_group()
+    return 0
@@ -1,33 +1,49 @@
-from .features import Features, BINS, OUT_VEC_SIZE
+from .features import FEATURE_LEN, OUT_VEC_SIZE, OFFSET_INDEX
+from typing import List, Optional
 from lib.io import IO
+import numpy as np
 import warnings
+import h5py
 
 with warnings.catch_warnings():
     warnings.filterwarnings("ignore", category=FutureWarning)
-    from tensorflow.keras.layers import LSTM, Dense
-    from tensorflow.keras.models import Sequential
+    from tensorflow.keras.layers import LSTM, Dense, Input
+    from tensorflow.keras.models import Sequential, Model
+    import tensorflow as tf
 
 DROPOUT = 0.5
 RECURRENT_DROPOUT = 0.2
 
+# Hidden and cell state of both LSTM layers, in the order get_states returns them
+STATE_NAMES = ("h1", "c1", "h2", "c2")
 
-def create_model(batch_size: int) -> Sequential:
+
+def beat_loss(y_true, y_pred):
+    """Squared error of the confidence, plus that of the offset weighed by how confident the beat is. Frames
+    without a beat don't have an offset to learn"""
+    confidence_loss = tf.square(y_true[:, 0] - y_pred[:, 0])
+    offset_loss = tf.square(y_true[:, OFFSET_INDEX] - y_pred[:, OFFSET_INDEX]) * y_true[:, 0]
+    return confidence_loss + offset_loss
+
+
+def create_model(batch_size: int, stateful: bool = True, feature_len: int = FEATURE_LEN) -> Sequential:
+    """The LSTM runs over the features of a frame, a narrower frontend makes for a smaller and faster model"""
     model = Sequential(
         [
             LSTM(
-                BINS,
-                input_shape=(Features.length(), 1),
+                feature_len,
+                input_shape=(feature_len, 1),
                 batch_size=batch_size,
                 return_sequences=True,
-                stateful=True,
+                stateful=stateful,
                 dropout=DROPOUT,
                 recurrent_dropout=RECURRENT_DROPOUT,
             ),
             LSTM(
-                BINS,
+                feature_len,
                 batch_size=batch_size,
                 return_sequences=False,
-                stateful=True,
+                stateful=stateful,
                 dropout=DROPOUT,
                 recurrent_dropout=RECURRENT_DROPOUT,
             ),
@@ -35,11 +51,90 @@ def create_model(batch_size: int) -> Sequential:
         ]
     )
 
-    model.compile(loss="mean_squared_error", optimizer="adam")
+    model.compile(loss=beat_loss, optimizer="adam")
 
     return model
 
 
+def create_step_model(feature_len: int = FEATURE_LEN, batch_size: Optional[int] = 1) -> Model:
+    """The inference model for a single frame, with the states as inputs and outputs instead of kept in the layers.
+    Takes the same weights as create_model. A batch size of None runs a frame of any amount of sessions at once"""
+    frames = Input((feature_len, 1), batch_size=batch_size, name="frames")
+    states = [Input((feature_len,), batch_size=batch_size, name=name) for name in STATE_NAMES]
+    sequences, h1, c1 = LSTM(feature_len, return_sequences=True, return_state=True)(frames, initial_state=states[:2])
+    last, h2, c2 = LSTM(feature_len, return_state=True)(sequences, initial_state=states[2:])
+    predictions = Dense(OUT_VEC_SIZE, activation="relu")(last)
+    return Model([frames] + states, [predictions, h1, c1, h2, c2])
+
+
 def apply_weights(model: Sequential, io: IO) -> Sequential:
     model.load_weights(io.get("input_weights"))
     return model
+
+
+def read_weights(path: str) -> List[np.ndarray]:
+    """Reads a weights file in the order set_weights takes them, without TensorFlow. The realtime server reads
+    them once before forking its workers, which each build their own model from the arrays they inherit"""
+    with h5py.File(path, "r") as weights_file:
+        if "model_weights" in weights_file:
+            weights_file = weights_file["model_weights"]
+        arrays: List[np.ndarray] = list()
+        for layer_name in weights_file.attrs["layer_names"]:
+            layer = weights_file[layer_name]
+            arrays.extend(np.asarray(layer[weight_name]) for weight_name in layer.attrs["weight_names"])
+        return arrays
+
+
+def get_states(model: Sequential) -> List[np.ndarray]:
+    """Copies out the hidden states of the stateful layers"""
+    if not isinstance(model, Sequential):
+        # Other backends keep the states themselves
+        return model.get_states()
+    states: List[np.ndarray] = []
+    for layer in model.layers:
+        if getattr(layer, "stateful", False):
+            states.extend(state.numpy() for state in layer.states)
+    return states
+
+
+def set_states(model: Sequential, states: Optional[List[np.ndarray]]):
+    """Restores states taken with get_states, None resets them"""
+    if states is None:
+        model.reset_states()
+        return
+    if not isinstance(model, Sequential):
+        model.set_states(states)
+        return
+
+    index = 0
+    for layer in model.layers:
+        if getattr(layer, "stateful", False):
+            count = len(layer.states)
+            layer.reset_states(states[index : index + count])
+            index += count
+
+
+def configure_threading(intra_op_threads: int, inter_op_threads: int):
+    """Sizes TensorFlow's thread pools, 0 keeps TensorFlow's own default"""
+    if intra_op_threads > 0:
+        tf.config.threading.set_intra_op_parallelism_threads(intra_op_threads)
+    if inter_op_threads > 0:
+        tf.config.threading.set_inter_op_parallelism_threads(inter_op_threads)
+
+
+def split_cpu(workers: int) -> List[str]:
+    """Splits the host CPU into **workers** logical devices, has to happen before TensorFlow initializes"""
+    if workers > 1:
+        cpus = tf.config.list_physical_devices("CPU")
+        tf.config.set_logical_device_configuration(
+            cpus[0], [tf.config.LogicalDeviceConfiguration() for _ in range(workers)]
+        )
+    return ["/cpu:{}".format(i) for i in range(workers)]
+
+
+def create_cpu_strategy(devices: List[str]) -> tf.distribute.Strategy:
+    """A data-parallel strategy that mirrors the model across local CPU devices"""
+    if len(devices) == 1:
+        # Leave placement up to tensorflow so a single worker can still use a GPU
+        return tf.distribute.get_strategy()
+    return tf.distribute.MirroredStrategy(devices=devices, cross_device_ops=tf.distribute.ReductionToOneDevice())
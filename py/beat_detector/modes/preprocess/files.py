@@ -1,7 +1,9 @@
 from typing import List, Dict, Any, Iterable, Optional
+from ..audio import WavReader
 from lib.io import IO
-import wave
+import numpy as np
 import json
+import os
 
 from lib.log import logline, warn
 
@@ -31,8 +33,34 @@ class JSONTimestamp:
 class BinsDescriptor:
     """A descriptor for the bins file"""
 
-    def __init__(self, json_obj: List[List[float]]):
-        self.bins = json_obj
+    def __init__(self, bins: np.ndarray):
+        self.bins = bins
+
+
+def get_base_name(wav_path: str) -> str:
+    """The path without its extension, the bins are stored next to it under this name"""
+    return ".".join(wav_path.split(".")[0:-1])
+
+
+def read_bins(base_name: str) -> np.ndarray:
+    """The bins of a track, memory-mapped from its .bins.npy file or parsed from the older .bins.json one"""
+    npy_path = "{}.bins.npy".format(base_name)
+    if os.path.isfile(npy_path):
+        return np.load(npy_path, mmap_mode="r")
+    with open("{}.bins.json".format(base_name), "rb") as json_str:
+        return np.array(json.load(json_str), dtype=np.float32)
+
+
+def convert_bins(json_path: str) -> str:
+    """Writes the .bins.npy file next to a .bins.json one, returns its path"""
+    with open(json_path, "rb") as json_str:
+        bins = np.array(json.load(json_str), dtype=np.float32)
+    npy_path = json_path[: -len(".json")] + ".npy"
+    # Written under another name first, so a half written file is never picked up
+    with open(npy_path + ".tmp", "wb") as npy_file:
+        np.save(npy_file, bins)
+    os.replace(npy_path + ".tmp", npy_path)
+    return npy_path
 
 
 class TrackAnalysis:
@@ -50,20 +78,18 @@ class MarkedAudioFile:
     """A single marked audio file"""
 
     def __init__(self, wav_path: str, track: "TrackAnalysis"):
-        self.base_name = ".".join(wav_path.split(".")[0:-1])
+        self.base_name = get_base_name(wav_path)
         self.name = self.base_name.split("/")[-1]
 
         self.wav_file = self._get_wav_file(wav_path)
         self.bins_file = self._get_bins_file(wav_path)
         self.timestamps = track.beats
 
-    def _get_wav_file(self, wav_path: str) -> wave.Wave_read:
-        return wave.open(wav_path, "rb")
+    def _get_wav_file(self, wav_path: str) -> WavReader:
+        return WavReader(wav_path)
 
     def _get_bins_file(self, wav_path: str) -> BinsDescriptor:
-        json_path = "{}.bins.json".format(self.base_name)
-        with open(json_path, "rb") as json_str:
-            return BinsDescriptor(json.load(json_str))
+        return BinsDescriptor(read_bins(self.base_name))
 
     def close(self):
         self.wav_file.close()
@@ -87,6 +113,13 @@ class AnalysisFile:
                 return track
         return None
 
+    def find_track_for_file(self, file_name: str) -> Optional[TrackAnalysis]:
+        """Finds the track whose name is part of given file name"""
+        for track in self.tracks:
+            if track.name.lower() in file_name.lower():
+                return track
+        return None
+
 
 def collect_input_paths(io: IO) -> List[str]:
     """Turn the input glob into file paths"""
@@ -107,11 +140,10 @@ def match_files(io: IO, input_paths: List[str]):
     reverse_map: Dict[str, str] = {}
     for in_path in input_paths:
         file_name = in_path.split("/")[-1].split(".")[0]
-        for track_analysis in analysis.tracks:
-            if track_analysis.name.lower() in file_name.lower():
-                mapped[in_path] = track_analysis.name
-                reverse_map[track_analysis.name] = file_name
-                break
+        track_analysis = analysis.find_track_for_file(file_name)
+        if track_analysis:
+            mapped[in_path] = track_analysis.name
+            reverse_map[track_analysis.name] = file_name
 
     logline("came up with the following mapping:")
     logline("")
@@ -1,16 +1,19 @@
 """Main entrypoint for preprocess mode"""
 
-from .files import get_files, collect_input_paths, MarkedAudioFile, match_files
-from modes.features import Features, ExpectedOutput, OUT_VEC_SIZE
+from .files import get_files, collect_input_paths, MarkedAudioFile, match_files, read_bins, get_base_name
+from modes.fingerprint import fingerprint, find_duplicates, get_dropped
+from modes.features import Features, OUT_VEC_SIZE, INTERVAL, BINS
+from modes.dataset import label_outputs, create_writer, is_sharded, SHARD_FILES
 from lib.log import logline, error, enter_group, exit_group
+from modes.frontend import FrontEnd, FRONTENDS
+from modes.silence import find_silent_spans
 from lib.io import IO, IOInput
 from lib.timer import Timer
-from typing import Iterator, List
+from typing import Dict, List, Tuple
 from glob import glob
 import numpy as np
-import pathlib
-import pickle
 import time
+import zlib
 import os
 
 # Take a (somehow) set of wav files, each
@@ -43,71 +46,122 @@ def get_io() -> IO:
                 alias="analysis",
             ),
             "o": IOInput(
-                "../../data/preprocessed.pickle",
+                "../../data/preprocessed/",
                 str,
                 has_input=True,
                 arg_name="output_file",
-                descr="File in which the features and outputs get placed",
+                descr="Directory in which shards of features and outputs get placed, or a single .pickle file",
                 alias="output_file",
             ),
+            "w": IOInput(
+                "0/1",
+                str,
+                has_input=True,
+                arg_name="worker",
+                descr="Part of the files this worker handles, as <index>/<workers>. Every worker writes its own shards",
+                alias="worker",
+            ),
+            "s": IOInput(
+                SHARD_FILES,
+                int,
+                has_input=True,
+                arg_name="shard_files",
+                descr="Files per shard, a crash loses at most this many files of work",
+                alias="shard_files",
+            ),
+            "kd": IOInput(
+                False,
+                bool,
+                has_input=False,
+                arg_name="keep_duplicates",
+                descr="Keep near duplicate tracks, found by fingerprinting their bins",
+                alias="keep_duplicates",
+            ),
             "n": IOInput(
-                50, int, has_input=True, arg_name="interval", descr="Interval at which data is sent", alias="interval"
+                INTERVAL,
+                int,
+                has_input=True,
+                arg_name="interval",
+                descr="Interval the bins were generated at, stored so loaders can resample to coarser ones",
+                alias="interval",
+            ),
+            "f": IOInput(
+                "linear",
+                str,
+                has_input=True,
+                arg_name="frontend",
+                descr="Frontend the bins are pooled by before training, one of {}".format(", ".join(FRONTENDS)),
+                alias="frontend",
+            ),
+            "fb": IOInput(
+                BINS,
+                int,
+                has_input=True,
+                arg_name="bands",
+                descr="Bands a mel or log frontend pools the bins into",
+                alias="bands",
             ),
         }
     )
 
 
-def gen_features(file: MarkedAudioFile) -> Iterator[Features]:
-    """Gen features based on the file"""
-    bins = file.bins_file.bins
-
-    return map(lambda bin_set: Features(bin_set), bins)
+def gen_features(file: MarkedAudioFile) -> np.ndarray:
+    """Gen features based on the file, a row of bins per frame"""
+    # Copies the bins out of the memory-mapped file in one go instead of a row at a time
+    return np.array(file.bins_file.bins, dtype=np.float32)
 
 
-def get_closest(timestamp_time: float, io: IO) -> int:
-    """Get the closest multiple of INTERVAL to the timestamp"""
-    interval = io.get("interval")
-    lowerbound = (timestamp_time // interval) * interval
-    upperbound = lowerbound + interval
+def parse_worker(worker: str) -> Tuple[int, int]:
+    index, workers = map(int, worker.split("/"))
+    if not 0 <= index < workers:
+        raise ValueError("worker has to be <index>/<workers> with an index below the amount of workers")
+    return index, workers
 
-    lowerbound_diff = timestamp_time - lowerbound
-    upperbound_diff = upperbound - timestamp_time
 
-    return lowerbound if lowerbound_diff <= upperbound_diff else upperbound
+def get_file_name(input_path: str) -> str:
+    """The name a track is stored under, the same as MarkedAudioFile's"""
+    return os.path.splitext(os.path.basename(input_path))[0]
 
 
-def gen_outputs(file: MarkedAudioFile, io: IO) -> List[ExpectedOutput]:
-    """Gen a list of marked outputs for given file"""
-    out_len = len(file.bins_file.bins)
-    # TODO: change
-    outputs = [ExpectedOutput(0) for _ in range(out_len)]
+def is_own_file(input_path: str, index: int, workers: int) -> bool:
+    """Whether a file is handled by this worker, based on its name so every machine agrees"""
+    return zlib.crc32(get_file_name(input_path).encode("utf8")) % workers == index
 
-    interval = io.get("interval")
-    for timestamp in file.timestamps:
-        # Round it to the range
-        timestamp_time = timestamp.timestamp * 1000
-        closest = get_closest(timestamp_time, io)
 
-        timestamp_index = int(closest / interval)
+def gen_beats(file: MarkedAudioFile) -> List[Tuple[float, float]]:
+    """Beat times in ms along with their confidence"""
+    return [(timestamp.timestamp * 1000, timestamp.confidence) for timestamp in file.timestamps]
 
-        if timestamp_index >= out_len:
-            continue
 
-        output_mark = outputs[timestamp_index]
-        output_mark.beat_confidence = timestamp.confidence
-
-    return outputs
+def drop_duplicates(mapping: Dict[str, str]) -> Dict[str, str]:
+    """Leaves out all but one of every group of files that hold the same song, the same ones on every worker"""
+    paths = sorted(mapping)
+    groups = find_duplicates(paths, [fingerprint(read_bins(get_base_name(path))) for path in paths])
+    for group in groups:
+        logline('keeping "{}", dropping its duplicates "{}"'.format(group[0], '", "'.join(group[1:])))
+    dropped = get_dropped(groups)
+    return {path: track for path, track in mapping.items() if path not in dropped}
 
 
 def mode_preprocess() -> int:
     """The main preprocessing entrypoint"""
     start_time = time.time()
 
-    preprocessed = []
-
     io = get_io()
     logline("preprocessing")
     enter_group()
+
+    try:
+        frontend = FrontEnd(io.get("frontend"), io.get("bands"))
+        worker, workers = parse_worker(io.get("worker"))
+        if workers > 1 and not is_sharded(io.get("output_file")):
+            raise ValueError("workers can only write to a sharded output directory")
+        writer = create_writer(io.get("output_file"), io.get("interval"), frontend, worker, io.get("shard_files"))
+    except ValueError as e:
+        error(str(e))
+        return 1
+    logline("using a {} frontend".format(frontend))
+
     logline("reading input paths")
     enter_group()
 
@@ -128,33 +182,55 @@ def mode_preprocess() -> int:
 
     exit_group()
 
+    if not io.get("keep_duplicates"):
+        logline("fingerprinting")
+        enter_group()
+        deduplicated = drop_duplicates(mapping)
+        logline("dropped {} duplicate files".format(len(mapping) - len(deduplicated)))
+        mapping = deduplicated
+        exit_group()
+
+    own_paths = sorted(path for path in mapping if is_own_file(path, worker, workers))
+    todo_paths = [path for path in own_paths if get_file_name(path) not in writer.done_files]
+    logline("worker {}/{} handles {} files".format(worker, workers, len(own_paths)))
+    if len(todo_paths) < len(own_paths):
+        logline("{} of them were done in an earlier run".format(len(own_paths) - len(todo_paths)))
+
     logline("iterating files")
     enter_group()
-    for file in get_files(input_paths, analysis, mapping):
+    for file in get_files(todo_paths, analysis, mapping):
         if not file:
             error("no files")
             return 1
 
-        features = gen_features(file)
-        outputs = gen_outputs(file, io)
+        feature_arr = gen_features(file)
+        beats = gen_beats(file)
 
-        feature_arr = list(map(lambda x: x.to_arr(), features))
-        output_arr = list(map(lambda x: x.to_arr(), outputs))
+        output_arr = label_outputs(beats, len(feature_arr), io.get("interval")).tolist()
 
-        assert np.array(feature_arr).shape[1] == Features.length()
+        assert feature_arr.shape[1] == Features.length()
         assert np.array(output_arr).shape[1] == OUT_VEC_SIZE
 
-        preprocessed.append({"file_name": file.name, "features": feature_arr, "outputs": output_arr})
-        logline('done with file: "{}"'.format(file.name))
+        silent_spans = find_silent_spans(feature_arr)
+        writer.add(
+            {
+                "file_name": file.name,
+                "features": feature_arr,
+                "outputs": output_arr,
+                "beats": beats,
+                "silent_spans": silent_spans,
+            }
+        )
+        logline(
+            'done with file: "{}", {} silent frames'.format(file.name, sum(end - start for start, end in silent_spans))
+        )
         file.close()
 
     exit_group()
     logline("done iterating files")
 
-    pathlib.Path(os.path.dirname(io.get("output_file"))).mkdir(parents=True, exist_ok=True)
-    with open(io.get("output_file"), "wb+") as file:
-        pickle.dump(preprocessed, file)
-        logline("wrote output to file: {}".format(io.get("output_file")))
+    writer.close()
+    logline("wrote output to: {}".format(io.get("output_file")))
 
     exit_group()
     logline(
@@ -0,0 +1,76 @@
+"""Main entrypoint for quantize mode"""
+
+from ..inference import convert_weights, get_lite_path, PRECISIONS
+from lib.log import logline, enter_group, exit_group, error
+from lib.io import IO, IOInput
+from ..frontend import load_frontend
+from lib.timer import Timer
+import time
+import os
+
+
+def get_io() -> IO:
+    return IO(
+        {
+            "iw": IOInput(
+                "./data/weights.h5",
+                str,
+                has_input=True,
+                arg_name="input_weights",
+                descr="Input weights file",
+                alias="input_weights",
+                is_generic=True,
+            ),
+            "it": IOInput(
+                "./data/train_config.json",
+                str,
+                has_input=True,
+                arg_name="input_train",
+                descr="Input file for the train config, holds the frontend the weights were trained with",
+                alias="input_train",
+            ),
+            "p": IOInput(
+                "int8,float16",
+                str,
+                has_input=True,
+                arg_name="precisions",
+                descr="Comma separated precisions to convert to, out of {}".format(", ".join(PRECISIONS)),
+                alias="precisions",
+            ),
+        }
+    )
+
+
+def mode_quantize() -> int:
+    """The main quantize entrypoint"""
+    start_time = time.time()
+
+    io = get_io()
+
+    logline("quantize")
+    enter_group()
+
+    precisions = [precision.strip() for precision in io.get("precisions").split(",") if precision.strip()]
+    unknown = [precision for precision in precisions if precision not in PRECISIONS]
+    if unknown or not precisions:
+        error("unknown precisions {}, choose from {}".format(", ".join(unknown), ", ".join(PRECISIONS)))
+        exit_group()
+        return 1
+
+    weights_path = io.get("input_weights")
+    frontend = load_frontend(io.get("input_train"))
+    logline(
+        'converting "{}" ({}KB) with a {} frontend'.format(
+            weights_path, os.path.getsize(weights_path) // 1024, frontend
+        )
+    )
+
+    for precision in precisions:
+        lite_path = get_lite_path(weights_path, precision)
+        with open(lite_path, "wb") as lite_file:
+            lite_file.write(convert_weights(weights_path, precision, frontend.length))
+        logline('wrote {} model to "{}" ({}KB)'.format(precision, lite_path, os.path.getsize(lite_path) // 1024))
+
+    exit_group()
+    logline("done quantizing, runtime is {}".format(Timer.stringify_time(Timer.format_time(time.time() - start_time))))
+    return 0
@@ -0,0 +1,95 @@
+"""Micro-batching of the frames of concurrent sessions, so they share a single step of the model"""
+from typing import List, Optional, Tuple
+from ..inference import StepModel
+from ..model import STATE_NAMES
+import numpy as np
+import threading
+import queue
+import time
+
+
+class Request:
+    """A single frame of a session, along with the states it continues from"""
+
+    def __init__(self, features: np.ndarray, states: Optional[List[np.ndarray]]):
+        self.features = features
+        self.states = states
+        self.prediction: Optional[np.ndarray] = None
+        self.new_states: List[np.ndarray] = list()
+        self.error: Optional[BaseException] = None
+        self.done = threading.Event()
+
+
+class MicroBatcher:
+    """Collects frames until **max_batch** are waiting or the first has waited **deadline** ms, then runs them all.
+    Every frame keeps its own states, so sessions never see each other's"""
+
+    def __init__(self, model: StepModel, max_batch: int, deadline: float):
+        self.model = model
+        self.max_batch = max_batch
+        self.deadline = deadline / 1000
+        self._queue: "queue.Queue[Optional[Request]]" = queue.Queue()
+        self._zero_states = [np.zeros((1, model.feature_len), dtype=np.float32) for _ in STATE_NAMES]
+        threading.Thread(target=self._run, daemon=True).start()
+
+    @property
+    def pending_count(self) -> int:
+        return self._queue.qsize()
+
+    def predict(self, features: np.ndarray, states: Optional[List[np.ndarray]]) -> Tuple[np.ndarray, List[np.ndarray]]:
+        """The prediction for a single (1, features, 1) frame and the states after it, None states start clean"""
+        request = Request(features, states)
+        self._queue.put(request)
+        request.done.wait()
+        if request.error is not None:
+            raise request.error
+        return request.prediction, request.new_states
+
+    def close(self):
+        """Stops the thread running the batches once the ones already waiting are done"""
+        self._queue.put(None)
+
+    def _collect(self) -> List[Request]:
+        first = self._queue.get()
+        if first is None:
+            return list()
+        requests = [first]
+        closes_at = time.perf_counter() + self.deadline
+        while len(requests) < self.max_batch:
+            timeout = closes_at - time.perf_counter()
+            try:
+                request = self._queue.get(timeout=timeout) if timeout > 0 else self._queue.get_nowait()
+            except queue.Empty:
+                break
+            if request is None:
+                # Runs what it has first
+                self._queue.put(None)
+                break
+            requests.append(request)
+        return requests
+
+    def _run_batch(self, requests: List[Request]):
+        frames = np.concatenate([request.features for request in requests])
+        states = {
+            name: np.concatenate([(request.states or self._zero_states)[i] for request in requests])
+            for i, name in enumerate(STATE_NAMES)
+        }
+        outputs = self.model.step(frames, states)
+        predictions = np.asarray(outputs["predictions"])
+        new_states = [np.asarray(outputs[name]) for name in STATE_NAMES]
+        for i, request in enumerate(requests):
+            request.prediction = predictions[i]
+            request.new_states = [state[i : i + 1] for state in new_states]
+
+    def _run(self):
+        while True:
+            requests = self._collect()
+            if not requests:
+                return
+            try:
+                self._run_batch(requests)
+            except Exception as e:
+                for request in requests:
+                    request.error = e
+            for request in requests:
+                request.done.set()
@@ -0,0 +1,111 @@
+"""Downloads tracks and precomputes their timelines in the background"""
+from .timelines import TimelineStore, analyse_track
+from .snapshots import SnapshotStore, Snapshots, SNAPSHOT_SECONDS
+from .media import MediaCache
+from ..inference import load_model
+from ..frontend import FrontEnd
+from lib.log import logline, error
+from typing import Optional, Set
+import threading
+import youtube_dl
+import warnings
+import queue
+import os
+
+with warnings.catch_warnings():
+    warnings.filterwarnings("ignore", category=FutureWarning)
+    from tensorflow.keras.models import Sequential
+
+
+def download(url: str, out_path: str):
+    dl = youtube_dl.YoutubeDL({"format": "bestaudio", "outtmpl": out_path, "verbose": True})
+    logline("starting download of", url)
+    dl.download([url])
+
+
+class DownloadWorker(threading.Thread):
+    """Handles requested URLs one at a time: download, then analyse the whole track once"""
+
+    def __init__(
+        self,
+        media: MediaCache,
+        timelines: TimelineStore,
+        snapshots: SnapshotStore,
+        weights: str,
+        interval: int,
+        frontend: FrontEnd,
+    ):
+        super().__init__(daemon=True)
+        self.media = media
+        self.timelines = timelines
+        self.snapshots = snapshots
+        self.weights = weights
+        self.interval = interval
+        self.frontend = frontend
+
+        self._queue: "queue.Queue[str]" = queue.Queue()
+        self._pending: Set[str] = set()
+        self._lock = threading.Lock()
+        self.jobs_done = 0
+        self.jobs_failed = 0
+        # Separate from the realtime model so analysis never clobbers a listener's state
+        self._model: Optional[Sequential] = None
+
+    def media_path(self, url: str) -> str:
+        return os.path.join(self.media.directory, "{}.mp3".format(url))
+
+    def is_pending(self, url: str) -> bool:
+        with self._lock:
+            return url in self._pending
+
+    @property
+    def pending_count(self) -> int:
+        return len(self._pending)
+
+    def request(self, url: str):
+        """Queues a URL unless it's already queued or fully handled"""
+        if os.path.isfile(self.media_path(url)) and self.is_analysed(url):
+            return
+        with self._lock:
+            if url in self._pending:
+                return
+            self._pending.add(url)
+        self._queue.put(url)
+
+    def is_analysed(self, url: str) -> bool:
+        # Tracks analysed before snapshots were taken, or with another model, get analysed again
+        return self.timelines.get(url) is not None and self.snapshots.has(url)
+
+    def _get_model(self) -> Sequential:
+        if self._model is None:
+            self._model = load_model(self.weights, self.frontend.length)
+        return self._model
+
+    def _handle(self, url: str):
+        media_path = self.media_path(url)
+        if not os.path.isfile(media_path):
+            download(url, media_path)
+            # Never the track that was just asked for
+            self.media.evict(keep=[media_path])
+        if not self.is_analysed(url):
+            logline("analysing", url)
+            snapshots = Snapshots(max(SNAPSHOT_SECONDS * 1000 // self.interval, 1))
+            timeline = analyse_track(self._get_model(), media_path, self.interval, self.frontend, snapshots)
+            self.snapshots.save(url, snapshots)
+            self.timelines.save(url, timeline)
+            logline("stored timeline and {} snapshots of".format(len(snapshots.frames)), url)
+
+    def run(self):
+        # The cap may have been lowered since the last run
+        self.media.evict()
+        while True:
+            url = self._queue.get()
+            try:
+                self._handle(url)
+                self.jobs_done += 1
+            except Exception as e:
+                self.jobs_failed += 1
+                error("failed to handle {}: {}".format(url, e))
+            finally:
+                with self._lock:
+                    self._pending.discard(url)
@@ -0,0 +1,100 @@
+"""Downloaded media kept under a size cap, and serving static files with ranges, validators and sendfile"""
+from typing import Collection, List, Optional, Tuple
+from email.utils import parsedate_to_datetime
+from lib.log import logline
+import threading
+import time
+import os
+
+# Extensions of files that are still being written, never evicted
+PARTIAL_EXTENSIONS = (".part", ".tmp", ".ytdl")
+
+
+class MediaCache:
+    """Files in a directory, the least recently accessed get removed once they take up more than max_bytes"""
+
+    def __init__(self, directory: str, max_bytes: int):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+
+    def contains(self, path: str) -> bool:
+        return os.path.dirname(os.path.realpath(path)) == os.path.realpath(self.directory)
+
+    def touch(self, path: str):
+        """Marks a file as accessed, leaving its modification time and so its validators alone"""
+        try:
+            os.utime(path, ns=(time.time_ns(), os.stat(path).st_mtime_ns))
+        except OSError:
+            pass
+
+    def evict(self, keep: Collection[str] = ()):
+        """Removes the least recently accessed files until the rest fit in max_bytes"""
+        if not os.path.isdir(self.directory):
+            return
+        keep = set(os.path.realpath(path) for path in keep)
+        with self._lock:
+            entries: List[Tuple[os.DirEntry, os.stat_result]] = list()
+            for entry in os.scandir(self.directory):
+                if not entry.is_file() or entry.name.endswith(PARTIAL_EXTENSIONS):
+                    continue
+                try:
+                    entries.append((entry, entry.stat()))
+                except FileNotFoundError:
+                    # Removed since it was listed, by another process for instance
+                    continue
+            entries.sort(key=lambda item: item[1].st_atime)
+
+            total = sum(stat.st_size for _, stat in entries)
+            for entry, stat in entries:
+                if total <= self.max_bytes:
+                    break
+                if os.path.realpath(entry.path) in keep:
+                    continue
+                total -= stat.st_size
+                try:
+                    # Listeners that still have it open keep reading it fine
+                    os.remove(entry.path)
+                except FileNotFoundError:
+                    continue
+                logline("evicted {} from the media cache".format(entry.name))
+
+
+def get_etag(stat: os.stat_result) -> str:
+    return '"{:x}-{:x}"'.format(stat.st_mtime_ns, stat.st_size)
+
+
+def is_not_modified(if_none_match: Optional[str], if_modified_since: Optional[str], stat: os.stat_result) -> bool:
+    """Whether the client's copy is still current, If-None-Match takes precedence like RFC 7232 asks"""
+    if if_none_match is not None:
+        etag = get_etag(stat)
+        return any(tag.strip() in (etag, "*", "W/" + etag) for tag in if_none_match.split(","))
+    if if_modified_since is not None:
+        try:
+            return int(stat.st_mtime) <= parsedate_to_datetime(if_modified_since).timestamp()
+        except (TypeError, ValueError):
+            return False
+    return False
+
+
+def parse_range(header: str, size: int) -> Optional[Tuple[int, int]]:
+    """The first and last byte of a single "bytes=" range, None when it can't be satisfied.
+    Multiple ranges aren't supported, only the first is served"""
+    if not header.startswith("bytes="):
+        return None
+    first_range = header[len("bytes=") :].split(",")[0].strip()
+    start_str, _, end_str = first_range.partition("-")
+    try:
+        if start_str == "":
+            # The last n bytes
+            length = int(end_str)
+            if length <= 0:
+                return None
+            return max(size - length, 0), size - 1
+        start = int(start_str)
+        end = int(end_str) if end_str else size - 1
+    except ValueError:
+        return None
+    if start >= size or end < start:
+        return None
+    return start, min(end, size - 1)
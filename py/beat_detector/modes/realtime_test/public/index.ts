@@ -33,10 +33,43 @@ namespace RealtimeTester {
 		}
 	}
 
+	namespace Timeline {
+		export interface Data {
+			interval: number;
+			frames: number;
+			confidences: string;
+		}
+
+		let confidences: Uint8Array | null = null;
+		let interval: number = 0;
+
+		export function set(data: Data | null) {
+			if (!data) return;
+
+			const raw = atob(data.confidences);
+			confidences = new Uint8Array(raw.length);
+			for (let i = 0; i < raw.length; i++) {
+				confidences[i] = raw.charCodeAt(i);
+			}
+			interval = data.interval;
+		}
+
+		export function has() {
+			return confidences !== null && confidences.length > 0;
+		}
+
+		export function at(time: number) {
+			const index = Math.floor((time * 1000) / interval);
+			return confidences![Math.min(index, confidences!.length - 1)] / 255;
+		}
+	}
+
 	namespace BeatDetector {
 		export namespace YTContent {
 			const BINS = 100;
 			const url = '/api/beat';
+			// Lets the server keep separate model state per listener
+			const session = Math.random().toString(36).slice(2);
 
 			namespace Notify {
 				export function showBeat(intensity: number) {
@@ -48,14 +81,35 @@ namespace RealtimeTester {
 					const rounded = Math.round(intensity * 100) / 100;
 					Elements.melody().style.transform = `scaleX(${rounded})`;
 				}
+
+				let scheduled: number | null = null;
+				export function scheduleBeat(nextBeats: number[], sentAt: number) {
+					// Offsets are relative to the audio that was sent, which
+					// is a round-trip in the past by now
+					const elapsed = performance.now() - sentAt;
+					const upcoming = nextBeats.find((offset) => offset > elapsed);
+					if (upcoming === undefined) return;
+
+					if (scheduled !== null) {
+						window.clearTimeout(scheduled);
+					}
+					scheduled = window.setTimeout(() => {
+						Elements.beat().classList.add('predicted');
+						window.setTimeout(() => {
+							Elements.beat().classList.remove('predicted');
+						}, 100);
+					}, upcoming - elapsed);
+				}
 			}
 		
 			namespace Connection {		
 				export async function send(data: number[]) {
+					const sentAt = performance.now();
 					const result = await fetch(`${url}`, {
 						method: 'POST',
 						body: JSON.stringify({
-							data
+							data,
+							session
 						}),
 						headers: {
 							'Content-Type': 'application/json'
@@ -63,10 +117,27 @@ namespace RealtimeTester {
 					}).then(r => r.json()) as {
 						beat: number;
 						melody: number;
+						next_beats: number[];
 					};
 
 					Notify.showBeat(result.beat);
 					Notify.showMelody(result.melody);
+					Notify.scheduleBeat(result.next_beats, sentAt);
+				}
+
+				export async function seek(trackURL: string, time: number) {
+					// The server restores the model state from its nearest snapshot
+					await fetch('/api/seek', {
+						method: 'POST',
+						body: JSON.stringify({
+							session,
+							url: trackURL,
+							time: Math.round(time * 1000)
+						}),
+						headers: {
+							'Content-Type': 'application/json'
+						}
+					});
 				}
 			}
 		
@@ -110,7 +181,12 @@ namespace RealtimeTester {
 
 					analyser!.getFloatFrequencyData(dataArray!);
 					const bins = cleanData(dataArray!);
-					Connection.send(bins);
+					if (Timeline.has()) {
+						// Precomputed by the server, no need to send anything
+						Notify.showBeat(Timeline.at(_video.currentTime));
+					} else {
+						Connection.send(bins);
+					}
 					onScreen.show(bins);
 				}
 			}
@@ -137,6 +213,11 @@ namespace RealtimeTester {
 				if (!analyser) return;
 				Analysis.init(analyser);
 				setInterval(Analysis.analyse, interval);
+
+				Elements.getVideo().addEventListener('seeked', () => {
+					if (Timeline.has()) return;
+					Connection.seek(Elements.getInput().value, Elements.getVideo().currentTime);
+				});
 			}
 
 			export function play() {
@@ -203,8 +284,8 @@ namespace RealtimeTester {
 	}
 
 	namespace Downloading {
-		async function checkDLStatus(url: string) {
-			const result = await fetch(`/api/dlReady`, {
+		async function getDLStatus(url: string) {
+			return await fetch(`/api/dlReady`, {
 				method: 'POST',
 				body: JSON.stringify({
 					url
@@ -215,9 +296,29 @@ namespace RealtimeTester {
 			}).then(r => r.json()) as {
 				done: boolean;
 				url: string;
+				timeline: Timeline.Data | null;
+				analysing: boolean;
 			};
+		}
+
+		async function awaitTimeline(url: string) {
+			await Util.waitUntil(async () => {
+				const result = await getDLStatus(url);
+				Timeline.set(result.timeline);
+				return Timeline.has() || !result.analysing;
+			}, 5000);
+		}
+
+		async function checkDLStatus(url: string) {
+			const result = await getDLStatus(url);
 
 			if (!result.done) return false;
+
+			Timeline.set(result.timeline);
+			if (!Timeline.has() && result.analysing) {
+				// Live predictions until the timeline is done
+				awaitTimeline(url);
+			}
 			
 			const video = Elements.getVideo();
 			const src = document.createElement('source');
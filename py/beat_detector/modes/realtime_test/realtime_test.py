@@ -1,18 +1,53 @@
 """Main entrypoint for realtime test mode"""
 
+from ..inference import load_model, warm_up, step_latency, LITE_EXTENSION
+from ..model import configure_threading, read_weights, get_states, set_states, STATE_NAMES
 from http.server import SimpleHTTPRequestHandler, HTTPServer
-from lib.log import logline, enter_group, exit_group
-from ..model import create_model, apply_weights
+from lib.log import logline, enter_group, exit_group, debug, warn
+from socketserver import ThreadingMixIn
+from urllib.parse import urlsplit, parse_qs
+from ..spectrum import SpectrumStream
+from .sessions import Session, Sessions
+from .timelines import TimelineStore, read_frames
+from .serving import ServingConfig, load_serving_config, SERVING_CONFIG
+from .snapshots import SnapshotStore, get_snapshot_key
+from .batcher import MicroBatcher
+from .workers import ForwardPool, owner_of, run_workers
+from lib.metrics import Registry, merge_renders
+from .media import MediaCache, get_etag, is_not_modified, parse_range
+from .downloads import DownloadWorker
+from ..test.cache import hash_file
 from lib.io import IO, IOInput
+from ..frontend import FrontEnd, load_frontend
+from ..features import INTERVAL
 from functools import partial
 from http import HTTPStatus
-from typing import Any
-import youtube_dl
+from typing import Any, Dict, List, Optional, Tuple
+import http.client
+import numpy as np
+import threading
 import json
+import time
 import os
 
 CUR_DIR = os.path.join(os.path.dirname(os.path.realpath(__file__)))
 
+# Longest PCM block accepted by /api/stream, keeps per-request memory bounded
+MAX_STREAM_SECONDS = 2
+
+PCM_FORMATS = {"f32": np.dtype("<f4"), "s16": np.dtype("<i2")}
+
+# Sample rates and channel counts /api/stream accepts, the block size limit scales with them
+MIN_SAMPLE_RATE = 8000
+MAX_SAMPLE_RATE = 192000
+CHANNELS = (1, 2)
+
+# Seconds browsers may keep downloaded tracks without asking again, they never change under the same name
+MEDIA_MAX_AGE = 24 * 60 * 60
+
+# Endpoints that get their own latency series, anything else is counted as "other"
+API_ENDPOINTS = ("beat", "stream", "seek", "dlReady", "dl", "interval", "metrics")
+
 
 def get_io() -> IO:
     return IO(
@@ -21,14 +56,298 @@ def get_io() -> IO:
                 1234, int, has_input=True, arg_name="port", descr="The port on which to host it", alias="port"
             ),
             "n": IOInput(
-                50, int, has_input=True, arg_name="interval", descr="Interval at which data is sent", alias="interval"
+                INTERVAL,
+                int,
+                has_input=True,
+                arg_name="interval",
+                descr="Interval at which data is sent, has to match the one the model was trained at",
+                alias="interval",
+            ),
+            "iw": IOInput(
+                "./data/weights.h5",
+                str,
+                has_input=True,
+                arg_name="input_weights",
+                descr="Input weights file, or a .tflite model written by quantize mode",
+                alias="input_weights",
+            ),
+            "it": IOInput(
+                "./data/train_config.json",
+                str,
+                has_input=True,
+                arg_name="input_train",
+                descr="Train config, holds the frontend the model was trained with",
+                alias="input_train",
+            ),
+            "sc": IOInput(
+                SERVING_CONFIG,
+                str,
+                has_input=True,
+                arg_name="serving_config",
+                descr="Workers, threads and batching to serve with, as written by tune mode",
+                alias="serving_config",
+            ),
+            "w": IOInput(
+                0,
+                int,
+                has_input=True,
+                arg_name="workers",
+                descr="Processes serving requests, every session sticks to one of them (0 for the serving config's)",
+                alias="workers",
+            ),
+            "ti": IOInput(
+                0,
+                int,
+                has_input=True,
+                arg_name="intra_threads",
+                descr="Threads a worker uses within a single op (0 for the serving config's)",
+                alias="intra_threads",
+            ),
+            "mb": IOInput(
+                0,
+                int,
+                has_input=True,
+                arg_name="batch_size",
+                descr="Frames of different sessions run through the model at once (0 for the serving config's)",
+                alias="batch_size",
+            ),
+            "bd": IOInput(
+                -1.0,
+                float,
+                has_input=True,
+                arg_name="batch_deadline",
+                descr="ms a frame waits for others to batch with (negative for the serving config's)",
+                alias="batch_deadline",
+            ),
+            "b": IOInput(
+                False,
+                bool,
+                has_input=False,
+                arg_name="benchmark",
+                descr="Benchmark server-side analysis on a single core instead of serving",
+                alias="benchmark",
+            ),
+            "mc": IOInput(
+                2048,
+                int,
+                has_input=True,
+                arg_name="media_cache_mb",
+                descr="Size in MB above which the least recently played downloads get removed",
+                alias="media_cache_mb",
+            ),
+            "kp": IOInput(
+                False,
+                bool,
+                has_input=False,
+                arg_name="keras_predict",
+                descr="Run weights through Keras' own predict instead of the compiled step function",
+                alias="keras_predict",
             ),
         }
     )
 
 
-interval: int = 100
+interval: int = INTERVAL
+frontend = FrontEnd()
+serving = ServingConfig()
 model = None
+# The model's state gets swapped per session, so only one request can use it at a time
+model_lock = threading.Lock()
+# Runs the frames of concurrent sessions together instead, when serving with batches
+batcher: Optional[MicroBatcher] = None
+sessions = Sessions()
+timelines = TimelineStore(os.path.join(CUR_DIR, "timelines"))
+snapshots: SnapshotStore
+downloads: DownloadWorker
+media: MediaCache
+# Set in every worker process when serving with more than one, None otherwise
+forward_pool: Optional[ForwardPool] = None
+worker_index = 0
+
+metrics = Registry()
+api_latency = {
+    endpoint: metrics.histogram("beat_api_request_seconds", "Time spent handling API requests", endpoint=endpoint)
+    for endpoint in API_ENDPOINTS + ("other",)
+}
+model_latency = metrics.histogram("beat_model_seconds", "Time spent running the model per frame")
+frames_total = metrics.counter("beat_frames_total", "Frames received")
+skipped_frames = metrics.counter("beat_skipped_frames_total", "Silent frames that skipped the model")
+deadline_misses = metrics.counter("beat_deadline_misses_total", "Frame requests that took longer than the interval")
+queue_depth = metrics.gauge("beat_queue_depth", "Requests waiting for the model")
+metrics.gauge("beat_active_sessions", "Sessions currently tracked", func=lambda: len(sessions))
+metrics.gauge(
+    "beat_batch_queue_depth", "Frames waiting for a batch", func=lambda: batcher.pending_count if batcher else 0
+)
+metrics.gauge("beat_download_jobs", "Downloads and analyses queued or running", func=lambda: downloads.pending_count)
+metrics.counter("beat_download_jobs_done", "Downloads and analyses finished", func=lambda: downloads.jobs_done)
+metrics.counter("beat_download_jobs_failed", "Downloads and analyses that failed", func=lambda: downloads.jobs_failed)
+metrics.counter("process_cpu_seconds_total", "CPU time used by the server", func=time.process_time)
+
+
+def predict_locked(session: Session, features: np.ndarray, skipped: np.ndarray, resets: np.ndarray) -> List[float]:
+    """Swaps the session's state into the model and runs its frames one after the other"""
+    predictions: List[float] = [0.0] * len(features)
+    queue_depth.inc()
+    with model_lock:
+        queue_depth.dec()
+        set_states(model, session.states)
+        for i in range(len(features)):
+            if resets[i]:
+                set_states(model, None)
+            if skipped[i]:
+                continue
+            start_time = time.perf_counter()
+            prediction = model.predict_on_batch(features[i])
+            predictions[i] = float(np.asarray(prediction)[0][0])
+            model_latency.observe(time.perf_counter() - start_time)
+        session.states = get_states(model)
+    return predictions
+
+
+def predict_batched(session: Session, features: np.ndarray, skipped: np.ndarray, resets: np.ndarray) -> List[float]:
+    """Hands the session's frames to the batcher, which runs them along with those of other sessions"""
+    predictions: List[float] = [0.0] * len(features)
+    states = session.states
+    for i in range(len(features)):
+        if resets[i]:
+            states = None
+        if skipped[i]:
+            continue
+        start_time = time.perf_counter()
+        prediction, states = batcher.predict(features[i], states)
+        predictions[i] = float(prediction[0])
+        # Includes the wait for the batch to fill up, that's what the session sees
+        model_latency.observe(time.perf_counter() - start_time)
+    session.states = states
+    return predictions
+
+
+def predict(session: Session, bins: np.ndarray) -> List[float]:
+    """Runs frames of bins through the model, continuing from the session's own state. Silent frames predict 0.
+    The caller holds the session's lock"""
+    predictions: List[float] = [0.0] * len(bins)
+    skipped, resets = session.get_gate(interval).push(bins)
+    if np.all(skipped):
+        # Silence never touches the model, only its state may have to be dropped
+        if np.any(resets):
+            session.states = None
+    else:
+        # Silence is gated on the bins as they come in, the model sees them after the frontend
+        features = np.reshape(frontend.apply(bins), (len(bins), 1, frontend.length, 1))
+        if batcher is not None:
+            predictions = predict_batched(session, features, skipped, resets)
+        else:
+            predictions = predict_locked(session, features, skipped, resets)
+    frames_total.inc(len(predictions))
+    skipped_frames.inc(int(np.count_nonzero(skipped)))
+    session.get_tempo(interval).push(predictions)
+    return predictions
+
+
+def configure_serving(new_interval: int, new_frontend: FrontEnd, config: ServingConfig):
+    """Sets the interval, frontend and serving config frames are run with"""
+    global interval, frontend, serving
+    interval = new_interval
+    frontend = new_frontend
+    serving = config
+
+
+def start_batcher():
+    """Puts a batcher in front of the model when serving with batches, replacing an earlier one"""
+    global batcher
+    if batcher is not None:
+        batcher.close()
+        batcher = None
+    if serving.batch_size <= 1:
+        return
+    if not getattr(model, "supports_batches", False):
+        warn("only the compiled step model runs batches, serving one frame at a time")
+        return
+    batcher = MicroBatcher(model, serving.batch_size, serving.batch_deadline)
+
+
+def load_serving_model(weights_path: str, compiled: bool = True, weights: Optional[List[np.ndarray]] = None) -> float:
+    """Loads the model the frames are run through, returns the ms warming it up took"""
+    global model
+    model = load_model(weights_path, frontend.length, compiled, weights)
+    # The first prediction builds the graph, a listener shouldn't have to wait for that
+    warmup_time = warm_up(model)
+    start_batcher()
+    return warmup_time
+
+
+def get_serving_config(io: IO) -> ServingConfig:
+    """The serving config file, with anything passed on the command line taking precedence"""
+    config = load_serving_config(io.get("serving_config"))
+    if io.get("workers") > 0:
+        config.workers = io.get("workers")
+    if io.get("intra_threads") > 0:
+        config.intra_threads = io.get("intra_threads")
+    if io.get("batch_size") > 0:
+        config.batch_size = io.get("batch_size")
+    if io.get("batch_deadline") >= 0:
+        config.batch_deadline = io.get("batch_deadline")
+    return config
+
+
+def seek(session: Session, url: str, time_ms: int) -> Tuple[Optional[int], int]:
+    """Puts a session where it would be **time_ms** into a track, starting from the nearest snapshot before it.
+    Returns the ms the snapshot was taken at and how many frames were run after it.
+    The caller holds the session's lock"""
+    # Whatever the session buffered belongs to where the track was before
+    session.states = None
+    session.stream = None
+    session.gate = None
+    session.tempo = None
+
+    frame = max(time_ms // interval, 0)
+    track_snapshots = snapshots.get(url)
+    nearest = track_snapshots.nearest(frame, len(STATE_NAMES)) if track_snapshots else None
+    media_path = downloads.media_path(url)
+    if nearest is None or not os.path.isfile(media_path):
+        # Starts over from a clean state
+        return None, 0
+
+    snapshot_frame, states, quiet_frames = nearest
+    session.states = states
+    session.get_gate(interval).quiet_frames = quiet_frames
+    # Only the frames since the snapshot are run, at most SNAPSHOT_SECONDS of them
+    bins = read_frames(media_path, interval, snapshot_frame, frame)
+    predict(session, bins)
+    return snapshot_frame * interval, len(bins)
+
+
+def parse_stream_query(query: Dict[str, str]) -> Tuple[int, int, str]:
+    """The sample rate, channels and PCM format of a /api/stream request, raises a ValueError for any that's off"""
+    try:
+        sample_rate = int(query.get("rate", 44100))
+        channels = int(query.get("channels", 1))
+    except ValueError:
+        raise ValueError("rate and channels have to be integers") from None
+    if not MIN_SAMPLE_RATE <= sample_rate <= MAX_SAMPLE_RATE:
+        raise ValueError("rate has to be between {} and {}".format(MIN_SAMPLE_RATE, MAX_SAMPLE_RATE))
+    if channels not in CHANNELS:
+        raise ValueError("channels has to be one of {}".format(", ".join(map(str, CHANNELS))))
+    pcm_format = query.get("format", "f32")
+    if pcm_format not in PCM_FORMATS:
+        raise ValueError("unknown format")
+    return sample_rate, channels, pcm_format
+
+
+def decode_pcm(raw: bytes, pcm_format: str, channels: int) -> np.ndarray:
+    """Decodes interleaved PCM into normalized mono float32"""
+    samples = np.frombuffer(raw, dtype=PCM_FORMATS[pcm_format]).astype(np.float32)
+    if pcm_format == "s16":
+        samples *= 1.0 / (1 << 15)
+    if channels > 1:
+        samples = samples[: len(samples) - len(samples) % channels].reshape(-1, channels).mean(axis=1)
+    return samples
+
+
+class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+    # Only reached by other workers, requests coming in on it are always handled by this worker
+    private = False
 
 
 class WebServer(SimpleHTTPRequestHandler):
@@ -36,64 +355,275 @@ class WebServer(SimpleHTTPRequestHandler):
         return "/files/{}.mp3".format(url)
 
     def dl_exists(self, url: str):
-        return os.path.isfile(os.path.join(CUR_DIR, "public/files", "{}.mp3".format(url)))
-
-    def download_url(self, url: str):
-        dl = youtube_dl.YoutubeDL(
-            {
-                "format": "bestaudio",
-                "outtmpl": os.path.join(CUR_DIR, "public/files/{}.mp3".format(url)),
-                "verbose": True,
-            }
-        )
-        print("Starting download")
-        dl.download([url])
+        return os.path.isfile(downloads.media_path(url))
+
+    # Routing to another worker may already have read it
+    body: Optional[bytes] = None
+
+    def read_body(self) -> bytes:
+        if self.body is None:
+            self.body = self.rfile.read(int(self.headers["Content-Length"]))
+        return self.body
 
     def parse_json(self):
-        length = int(self.headers["Content-Length"])
-        return json.loads(self.rfile.read(length))
+        return json.loads(self.read_body())
 
-    def respond_json(self, data: Any, status: int=HTTPStatus.OK):
+    def parse_query(self) -> Dict[str, str]:
+        query = parse_qs(urlsplit(self.path).query)
+        return {key: values[0] for key, values in query.items()}
+
+    def respond(self, status: int, content_type: str, content: bytes):
         self.send_response(status)
-        self.send_header("Content-Type", "application/json")
-        content = json.dumps(data).encode("utf8")
+        self.send_header("Content-Type", content_type)
         self.send_header("Content-Length", str(len(content)))
         self.end_headers()
         self.wfile.write(content)
 
+    def respond_json(self, data: Any, status: int=HTTPStatus.OK):
+        self.respond(status, "application/json", json.dumps(data).encode("utf8"))
+
+    def handle_beat(self):
+        data = self.parse_json()
+        session = sessions.get(data.get("session", ""))
+        with session.lock:
+            beat = predict(session, np.array([data["data"]], dtype=np.float32))[0]
+            tempo = session.get_tempo(interval)
+            response = {"beat": beat, "melody": 0, "next_beats": tempo.predict(), "bpm": tempo.bpm}
+        self.respond_json(response)
+
+    def handle_stream(self):
+        query = self.parse_query()
+        stream_error = self.get_stream_error(query)
+        if stream_error is not None:
+            status, message = stream_error
+            return self.respond_json({"error": message}, status)
+        sample_rate, channels, pcm_format = parse_stream_query(query)
+
+        # Read in before taking the lock, a slow upload shouldn't hold up the session's other requests
+        pcm = decode_pcm(self.read_body(), pcm_format, channels)
+        session = sessions.get(query.get("session", ""))
+        with session.lock:
+            stream: SpectrumStream = session.get_stream(sample_rate, interval)
+            beats = predict(session, stream.push(pcm))
+            tempo = session.get_tempo(interval)
+            response = {"beats": beats, "next_beats": tempo.predict(), "bpm": tempo.bpm}
+        self.respond_json(response)
+
+    def handle_seek(self):
+        data = self.parse_json()
+        session = sessions.get(data.get("session", ""))
+        with session.lock:
+            restored, fast_forwarded = seek(session, data["url"], int(data["time"]))
+        self.respond_json({"restored": restored, "fast_forwarded": fast_forwarded})
+
+    def get_stream_error(self, query: Dict[str, str]) -> Optional[Tuple[HTTPStatus, str]]:
+        """Why a /api/stream request gets turned down before its body is read, None when it doesn't"""
+        try:
+            sample_rate, channels, pcm_format = parse_stream_query(query)
+        except ValueError as e:
+            return HTTPStatus.BAD_REQUEST, str(e)
+        if "Content-Length" not in self.headers:
+            return HTTPStatus.LENGTH_REQUIRED, "missing Content-Length"
+        if not self.headers["Content-Length"].isdigit():
+            return HTTPStatus.BAD_REQUEST, "invalid Content-Length"
+        max_length = MAX_STREAM_SECONDS * sample_rate * channels * PCM_FORMATS[pcm_format].itemsize
+        if int(self.headers["Content-Length"]) > max_length:
+            return HTTPStatus.REQUEST_ENTITY_TOO_LARGE, "block too long"
+        return None
+
     def handle_api(self):
         if self.path.startswith("/api/beat"):
-            self.parse_json()
-            # TODO: make prediction
+            self.handle_beat()
+        elif self.path.startswith("/api/stream"):
+            self.handle_stream()
+        elif self.path.startswith("/api/seek"):
+            self.handle_seek()
+        elif self.path.startswith("/api/dlReady"):
+            url = self.parse_json()["url"]
+            self.respond_json(
+                {
+                    "done": self.dl_exists(url),
+                    "url": self.get_public_url(url),
+                    "timeline": timelines.get(url),
+                    "analysing": downloads.is_pending(url),
+                }
+            )
         elif self.path.startswith("/api/dl"):
             url = self.parse_json()["url"]
+            # Also queues analysis of earlier downloads that don't have a timeline yet
+            downloads.request(url)
             if self.dl_exists(url):
                 return self.respond_json({"done": True, "url": self.get_public_url(url)})
-            self.download_url(url)
             self.respond_json({"status": "downloading"})
-        elif self.path.startswith("/api/dlReady"):
-            url = self.parse_json()["url"]
-            exists = self.dl_exists(url)
-            self.respond_json({"done": exists, "url": self.get_public_url(url)})
         elif self.path.startswith("/api/interval"):
             self.respond_json({"interval": interval})
+        elif self.path.startswith("/api/metrics"):
+            self.respond_metrics()
         else:
             self.respond_json({"?": "?"}, 404)
 
+    def respond_metrics(self):
+        renders = [metrics.render()]
+        if self.routes_requests():
+            # A scrape only reaches one worker, it collects the others' metrics for them
+            for worker in range(len(forward_pool.ports)):
+                if worker == worker_index:
+                    continue
+                try:
+                    _, _, content = forward_pool.request(worker, "GET", "/api/metrics", None, dict())
+                    renders.append(content.decode("utf8"))
+                except (OSError, http.client.HTTPException):
+                    pass
+        self.respond(HTTPStatus.OK, "text/plain; version=0.0.4", merge_renders(renders).encode("utf8"))
+
+    def routes_requests(self) -> bool:
+        """Whether requests to this server may have to go to another worker, ones forwarded to it never do"""
+        return forward_pool is not None and not self.server.private
+
+    def get_owner(self) -> Optional[int]:
+        """The worker that has to handle this request, None when any of them can"""
+        if not self.routes_requests():
+            return None
+        endpoint = self.get_endpoint()
+        if endpoint in ("beat", "seek"):
+            return owner_of(self.parse_json().get("session", ""), len(forward_pool.ports))
+        if endpoint == "stream":
+            query = self.parse_query()
+            # Invalid or too long blocks get turned down right away instead of being passed on
+            if self.get_stream_error(query) is not None:
+                return None
+            return owner_of(query.get("session", ""), len(forward_pool.ports))
+        if endpoint in ("dl", "dlReady"):
+            # Only the first worker downloads, so a track is never downloaded or analysed twice
+            return 0
+        return None
+
+    def forward(self, owner: int):
+        """Passes the request on to the worker that owns its state and relays the response"""
+        body = self.read_body() if self.command == "POST" else None
+        headers = {"Content-Type": self.headers.get("Content-Type", "application/json")}
+        try:
+            status, content_type, content = forward_pool.request(owner, self.command, self.path, body, headers)
+        except (OSError, http.client.HTTPException):
+            return self.respond_json({"error": "worker {} is unavailable".format(owner)}, HTTPStatus.BAD_GATEWAY)
+        self.respond(status, content_type, content)
+
+    def get_endpoint(self) -> str:
+        endpoint = urlsplit(self.path).path[len("/api/") :]
+        return endpoint if endpoint in API_ENDPOINTS else "other"
+
+    def timed_api(self):
+        self.body = None
+        owner = self.get_owner()
+        if owner is not None and owner != worker_index:
+            # The owner records the latency
+            return self.forward(owner)
+
+        start_time = time.perf_counter()
+        self.handle_api()
+        duration = time.perf_counter() - start_time
+
+        endpoint = self.get_endpoint()
+        api_latency[endpoint].observe(duration)
+        if endpoint in ("beat", "stream") and duration * 1000 > interval:
+            deadline_misses.inc()
+
+    def send_validators(self, stat: os.stat_result, is_media: bool):
+        self.send_header("ETag", get_etag(stat))
+        self.send_header("Last-Modified", self.date_time_string(int(stat.st_mtime)))
+        self.send_header("Accept-Ranges", "bytes")
+        # Everything else changes with the code, so it's always revalidated
+        self.send_header("Cache-Control", "public, max-age={}".format(MEDIA_MAX_AGE) if is_media else "no-cache")
+
+    def serve_static(self, head: bool = False):
+        """Serves a file with support for ranges and conditional requests, the body sent with sendfile"""
+        path = self.translate_path(self.path)
+        if os.path.isdir(path) and urlsplit(self.path).path.endswith("/"):
+            path = os.path.join(path, "index.html")
+        if not os.path.isfile(path):
+            # Redirects, listings and 404s are left to the base class
+            return super().do_HEAD() if head else super().do_GET()
+
+        try:
+            static_file = open(path, "rb")
+        except OSError:
+            return self.send_error(HTTPStatus.NOT_FOUND, "File not found")
+        with static_file:
+            stat = os.fstat(static_file.fileno())
+            is_media = media.contains(path)
+            if is_media:
+                media.touch(path)
+
+            if is_not_modified(self.headers.get("If-None-Match"), self.headers.get("If-Modified-Since"), stat):
+                self.send_response(HTTPStatus.NOT_MODIFIED)
+                self.send_validators(stat, is_media)
+                return self.end_headers()
+
+            start, end = 0, stat.st_size - 1
+            status = HTTPStatus.OK
+            range_header = self.headers.get("Range")
+            # A range of a changed file would be stitched to the wrong bytes, If-Range asks for all of it then
+            if range_header and self.headers.get("If-Range", get_etag(stat)) == get_etag(stat):
+                byte_range = parse_range(range_header, stat.st_size)
+                if byte_range is None:
+                    self.send_response(HTTPStatus.REQUESTED_RANGE_NOT_SATISFIABLE)
+                    self.send_header("Content-Range", "bytes */{}".format(stat.st_size))
+                    self.send_header("Content-Length", "0")
+                    return self.end_headers()
+                start, end = byte_range
+                status = HTTPStatus.PARTIAL_CONTENT
+
+            self.send_response(status)
+            self.send_header("Content-Type", self.guess_type(path))
+            self.send_header("Content-Length", str(end - start + 1))
+            if status == HTTPStatus.PARTIAL_CONTENT:
+                self.send_header("Content-Range", "bytes {}-{}/{}".format(start, end, stat.st_size))
+            self.send_validators(stat, is_media)
+            self.end_headers()
+
+            if not head and end >= start:
+                self.wfile.flush()
+                # Straight from the page cache to the socket, never copied through Python
+                self.connection.sendfile(static_file, start, end - start + 1)
+
+    def do_GET(self):
+        # Prometheus scrapes with GET
+        if self.path.startswith("/api/metrics"):
+            return self.timed_api()
+        self.serve_static()
+
+    def do_HEAD(self):
+        self.serve_static(head=True)
+
     def do_POST(self):
         path = self.path
         if path.startswith("/api"):
-            return self.handle_api()
+            return self.timed_api()
 
         self.respond_json({"?": "?"}, 404)
 
 
+def create_server(address: Tuple[str, int]) -> ThreadingHTTPServer:
+    return ThreadingHTTPServer(address, partial(WebServer, directory=os.path.join(CUR_DIR, "public")))
+
+
+def start_downloads(io: IO, run: bool = True):
+    global downloads, media, snapshots
+
+    # Snapshots are only of use to the model they were taken with
+    snapshot_key = get_snapshot_key(hash_file(io.get("input_weights")), interval, frontend)
+    snapshots = SnapshotStore(os.path.join(CUR_DIR, "timelines"), snapshot_key)
+    media = MediaCache(os.path.join(CUR_DIR, "public/files"), io.get("media_cache_mb") * 1024 * 1024)
+    downloads = DownloadWorker(media, timelines, snapshots, io.get("input_weights"), interval, frontend)
+    if run:
+        downloads.start()
+
+
 def start_server(io: IO):
-    global interval
-    interval = io.get("interval")
+    start_downloads(io)
 
     port = io.get("port")
-    httpd = HTTPServer(("", port), partial(WebServer, directory=os.path.join(CUR_DIR, "public")))
+    httpd = create_server(("", port))
     logline("listening at port", port)
     enter_group()
     try:
@@ -105,18 +635,123 @@ def start_server(io: IO):
     logline("stopped listening")
 
 
+def run_worker(
+    io: IO,
+    httpd: ThreadingHTTPServer,
+    private: List[ThreadingHTTPServer],
+    weights: Optional[List[np.ndarray]],
+    index: int,
+):
+    """Serves requests in a forked worker, also taking those other workers forward to its private socket"""
+    global forward_pool, worker_index
+    worker_index = index
+    forward_pool = ForwardPool([server.server_address[1] for server in private])
+    for i, server in enumerate(private):
+        if i != index:
+            server.socket.close()
+    metrics.set_labels(worker=str(index))
+
+    # Workers split the cores between them instead of all of them using every core
+    configure_threading(serving.get_intra_threads(), 1)
+    warmup_time = load_serving_model(io.get("input_weights"), not io.get("keras_predict"), weights)
+    debug("worker {} warmed up in {}ms".format(index, round(warmup_time, 1)))
+    start_downloads(io, run=index == 0)
+
+    threading.Thread(target=private[index].serve_forever, daemon=True).start()
+    httpd.serve_forever()
+
+
+def start_workers(io: IO) -> int:
+    """Reads the weights and binds the socket once, then forks workers that share both.
+    Every worker builds its own model from the arrays it inherits"""
+    workers = serving.workers
+    # Converted models are small enough to read in every worker
+    weights = None if io.get("input_weights").endswith(LITE_EXTENSION) else read_weights(io.get("input_weights"))
+
+    port = io.get("port")
+    httpd = create_server(("", port))
+    # Every worker also gets a socket only its siblings connect to, for sessions it owns
+    private = [create_server(("127.0.0.1", 0)) for _ in range(workers)]
+    for server in private:
+        server.private = True
+
+    logline("listening at port {} with {} workers".format(port, workers))
+    enter_group()
+    debug("worker ports: {}".format(", ".join(str(server.server_address[1]) for server in private)))
+    code = run_workers(workers, partial(run_worker, io, httpd, private, weights))
+    httpd.server_close()
+    exit_group()
+    logline("stopped listening")
+    return code
+
+
+def benchmark(io: IO, seconds: int = 60):
+    """Measures how many frames per second one core can turn from raw PCM into bins and predictions"""
+    sample_rate = 44100
+    block_size = sample_rate * io.get("interval") // 1000
+    audio = np.random.uniform(-0.5, 0.5, sample_rate * seconds).astype(np.float32)
+    blocks = [audio[i : i + block_size] for i in range(0, len(audio), block_size)]
+
+    stream = SpectrumStream(sample_rate, io.get("interval"))
+    start_time = time.time()
+    frames = sum(len(stream.push(block)) for block in blocks)
+    logline("analysis only: {} frames/sec".format(round(frames / (time.time() - start_time), 1)))
+
+    session = Session("benchmark")
+    stream.reset()
+    predict(session, stream.push(blocks[0]))
+    start_time = time.time()
+    frames = sum(len(predict(session, stream.push(block))) for block in blocks[1:])
+    logline("analysis and model: {} frames/sec".format(round(frames / (time.time() - start_time), 1)))
+
+    if io.get("input_weights").endswith(LITE_EXTENSION):
+        return
+    # What a single step costs through Keras' predict against the compiled step function
+    for compiled in (False, True):
+        step_model = load_model(io.get("input_weights"), frontend.length, compiled)
+        logline(
+            "{}: {}ms per step".format(
+                "compiled step" if compiled else "keras predict", round(step_latency(step_model), 3)
+            )
+        )
+
+
 def mode_realtime_test():
     """The main realtime test entrypoint"""
     io = get_io()
 
+    configure_serving(io.get("interval"), load_frontend(io.get("input_train")), get_serving_config(io))
+
     logline("realtime test")
     enter_group()
+    if serving.tuned and serving.tuned.get("interval") != interval:
+        warn("the serving config was tuned at {}ms, not at {}ms".format(serving.tuned.get("interval"), interval))
 
-    logline("reconstructing model")
-    global model
-    model = create_model(1)
+    if not io.get("benchmark"):
+        logline("serving with {}".format(serving))
+    if serving.workers > 1 and not io.get("benchmark"):
+        # TensorFlow doesn't survive a fork once it's running, every worker creates its own model
+        code = start_workers(io)
+        exit_group()
+        return code
+
+    if io.get("benchmark"):
+        # Per core numbers, one frame at a time
+        configure_threading(1, 1)
+        serving.batch_size = 1
+    elif serving.intra_threads > 0:
+        configure_threading(serving.intra_threads, 1)
+
+    logline("loading model with learned weights for a {} frontend".format(frontend))
+    warmup_time = load_serving_model(io.get("input_weights"), not io.get("keras_predict"))
+    logline("warmed up in {}ms".format(round(warmup_time, 1)))
 
-    logline("applying learned weights")
-    model = apply_weights(model, io)
+    if io.get("benchmark"):
+        logline("benchmarking")
+        enter_group()
+        benchmark(io)
+        exit_group()
+        exit_group()
+        return
 
     start_server(io)
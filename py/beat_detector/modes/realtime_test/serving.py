@@ -0,0 +1,71 @@
+"""How the realtime server spreads its work over the machine, written by tune mode and read when the server starts"""
+from typing import Any, Dict, Optional
+import json
+import os
+
+SERVING_CONFIG = "./data/serving_config.json"
+
+
+class ServingConfig:
+    """Worker processes, threads per op and micro-batching of the realtime server. An intra_threads of 0 splits
+    the cores between the workers, a batch_size of 1 runs every frame on its own"""
+
+    def __init__(
+        self,
+        workers: int = 1,
+        intra_threads: int = 0,
+        batch_size: int = 1,
+        batch_deadline: float = 0.0,
+        tuned: Optional[Dict[str, Any]] = None,
+    ):
+        self.workers = workers
+        self.intra_threads = intra_threads
+        self.batch_size = batch_size
+        # ms the first frame of a batch waits for others to join it
+        self.batch_deadline = batch_deadline
+        # What tune mode measured for this config, absent when it wasn't tuned
+        self.tuned = tuned
+
+    def get_intra_threads(self) -> int:
+        return self.intra_threads or max((os.cpu_count() or 1) // self.workers, 1)
+
+    def to_config(self) -> Dict[str, Any]:
+        return {
+            "workers": self.workers,
+            "intra_threads": self.intra_threads,
+            "batch_size": self.batch_size,
+            "batch_deadline": self.batch_deadline,
+            "tuned": self.tuned,
+        }
+
+    @staticmethod
+    def from_config(config: Dict[str, Any]) -> "ServingConfig":
+        return ServingConfig(
+            int(config.get("workers", 1)),
+            int(config.get("intra_threads", 0)),
+            int(config.get("batch_size", 1)),
+            float(config.get("batch_deadline", 0.0)),
+            config.get("tuned"),
+        )
+
+    def __str__(self) -> str:
+        batching = "batches of up to {} within {}ms".format(self.batch_size, self.batch_deadline)
+        return "{} workers, {} threads each, {}".format(
+            self.workers, self.get_intra_threads(), batching if self.batch_size > 1 else "no batching"
+        )
+
+
+def load_serving_config(path: str) -> ServingConfig:
+    """The config written by tune mode, the defaults when it hasn't run"""
+    if not os.path.isfile(path):
+        return ServingConfig()
+    with open(path, "r") as config_file:
+        return ServingConfig.from_config(json.load(config_file))
+
+
+def save_serving_config(path: str, config: ServingConfig):
+    if os.path.dirname(path):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path + ".tmp", "w") as config_file:
+        json.dump(config.to_config(), config_file, indent=4)
+    os.replace(path + ".tmp", path)
@@ -0,0 +1,80 @@
+"""Per-listener state kept by the realtime server"""
+from ..spectrum import SpectrumStream
+from ..silence import SilenceGate
+from ..tempo import TempoTracker
+from typing import List, Optional
+from collections import OrderedDict
+import numpy as np
+import threading
+import time
+
+# Sessions that haven't been heard from for this many seconds get dropped
+SESSION_TIMEOUT = 60
+
+# Upper bound on the amount of sessions kept around at once
+MAX_SESSIONS = 256
+
+
+class Session:
+    """A single listener, with its own model state and PCM buffer"""
+
+    def __init__(self, session_id: str):
+        self.id = session_id
+        self.states: Optional[List[np.ndarray]] = None
+        self.stream: Optional[SpectrumStream] = None
+        self.tempo: Optional[TempoTracker] = None
+        self.gate: Optional[SilenceGate] = None
+        self.last_seen = time.time()
+        # Held for as long as a request uses or changes any of the above, so the
+        # concurrent requests of one listener can't interleave frames or states
+        self.lock = threading.Lock()
+
+    def get_stream(self, sample_rate: int, interval: int) -> SpectrumStream:
+        """The PCM stream of this session, restarted when the sample rate changes"""
+        if self.stream is None or self.stream.sample_rate != sample_rate:
+            self.stream = SpectrumStream(sample_rate, interval)
+        return self.stream
+
+    def get_tempo(self, interval: int) -> TempoTracker:
+        if self.tempo is None:
+            self.tempo = TempoTracker(interval)
+        return self.tempo
+
+    def get_gate(self, interval: int) -> SilenceGate:
+        if self.gate is None:
+            self.gate = SilenceGate(interval)
+        return self.gate
+
+
+class Sessions:
+    """All live sessions, least recently seen ones get evicted first"""
+
+    def __init__(self, timeout: float = SESSION_TIMEOUT, max_sessions: int = MAX_SESSIONS):
+        self.timeout = timeout
+        self.max_sessions = max_sessions
+        self._sessions: "OrderedDict[str, Session]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, session_id: str) -> Session:
+        now = time.time()
+        with self._lock:
+            session = self._sessions.get(session_id)
+            if session is None:
+                session = Session(session_id)
+                self._sessions[session_id] = session
+            else:
+                self._sessions.move_to_end(session_id)
+            session.last_seen = now
+
+            self._evict(now)
+        return session
+
+    def _evict(self, now: float):
+        while len(self._sessions) > 0:
+            oldest = next(iter(self._sessions.values()))
+            if len(self._sessions) <= self.max_sessions and now - oldest.last_seen <= self.timeout:
+                break
+            self._sessions.popitem(last=False)
+
+    def __len__(self) -> int:
+        return len(self._sessions)
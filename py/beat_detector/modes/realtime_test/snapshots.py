@@ -0,0 +1,130 @@
+"""Model state snapshots taken at fixed points in a track, so seeking never has to replay it from the start"""
+from typing import List, Optional, Tuple
+from collections import OrderedDict
+from ..frontend import FrontEnd
+import numpy as np
+import threading
+import hashlib
+import json
+import os
+
+# Seconds of audio between snapshots while a track is analysed
+SNAPSHOT_SECONDS = 10
+
+# Snapshots kept per track, longer tracks get them spaced further apart instead
+MAX_SNAPSHOTS = 64
+
+# Bytes of snapshots held in memory across all tracks, least recently used tracks get dropped first
+CACHE_BYTES = 32 * 1024 * 1024
+
+
+class Snapshots:
+    """The model states and silence gate of a track at every snapshot frame, stored as float16"""
+
+    def __init__(
+        self,
+        spacing: int,
+        frames: Optional[np.ndarray] = None,
+        states: Optional[np.ndarray] = None,
+        quiet_frames: Optional[np.ndarray] = None,
+    ):
+        self.spacing = spacing
+        self.frames: List[int] = [] if frames is None else frames.tolist()
+        self.states: List[np.ndarray] = [] if states is None else list(states)
+        self.quiet_frames: List[int] = [] if quiet_frames is None else quiet_frames.tolist()
+
+    def add(self, frame: int, states: List[np.ndarray], quiet_frames: int):
+        """Records the state the model is in right before **frame**, if that's on the current spacing"""
+        if frame % self.spacing != 0:
+            return
+        self.frames.append(frame)
+        self.states.append(np.concatenate([np.ravel(state) for state in states]).astype(np.float16))
+        self.quiet_frames.append(quiet_frames)
+        if len(self.frames) > MAX_SNAPSHOTS:
+            # Every other one goes, which keeps them evenly spaced
+            self.spacing *= 2
+            kept = [i for i, kept_frame in enumerate(self.frames) if kept_frame % self.spacing == 0]
+            self.frames = [self.frames[i] for i in kept]
+            self.states = [self.states[i] for i in kept]
+            self.quiet_frames = [self.quiet_frames[i] for i in kept]
+
+    def nearest(self, frame: int, state_count: int) -> Optional[Tuple[int, List[np.ndarray], int]]:
+        """The last snapshot at or before **frame** as its frame, model states and quiet frames"""
+        index = int(np.searchsorted(self.frames, frame, side="right")) - 1
+        if index < 0:
+            return None
+        states = np.split(self.states[index].astype(np.float32), state_count)
+        return self.frames[index], [np.reshape(state, (1, -1)) for state in states], self.quiet_frames[index]
+
+    @property
+    def nbytes(self) -> int:
+        return sum(state.nbytes for state in self.states)
+
+
+def get_snapshot_key(weights_hash: str, interval: int, frontend: FrontEnd) -> str:
+    """Identifies the model that snapshots get taken with, the states of any other model don't fit it"""
+    config = {"weights": weights_hash, "interval": interval, "frontend": frontend.to_config()}
+    return hashlib.sha1(json.dumps(config, sort_keys=True).encode("utf8")).hexdigest()
+
+
+class SnapshotStore:
+    """Snapshots on disk next to the timelines, keyed by the URL their track was downloaded from.
+    Stored ones taken with another model than **key** count as missing"""
+
+    def __init__(self, directory: str, key: str, max_bytes: int = CACHE_BYTES):
+        self.directory = directory
+        self.key = key
+        self.max_bytes = max_bytes
+        self._cache: "OrderedDict[str, Snapshots]" = OrderedDict()
+        self._cached_bytes = 0
+        self._lock = threading.Lock()
+
+    def _get_path(self, url: str) -> str:
+        return os.path.join(self.directory, "{}.snapshots.npz".format(hashlib.sha1(url.encode("utf8")).hexdigest()))
+
+    def _remember(self, url: str, snapshots: Snapshots):
+        with self._lock:
+            previous = self._cache.pop(url, None)
+            if previous is not None:
+                self._cached_bytes -= previous.nbytes
+            self._cache[url] = snapshots
+            self._cached_bytes += snapshots.nbytes
+            while self._cached_bytes > self.max_bytes and len(self._cache) > 1:
+                _, evicted = self._cache.popitem(last=False)
+                self._cached_bytes -= evicted.nbytes
+
+    def has(self, url: str) -> bool:
+        # Loading it is the only way to tell which model took them, it's cached for the seeks that follow anyway
+        return self.get(url) is not None
+
+    def get(self, url: str) -> Optional[Snapshots]:
+        with self._lock:
+            if url in self._cache:
+                self._cache.move_to_end(url)
+                return self._cache[url]
+
+        path = self._get_path(url)
+        if not os.path.isfile(path):
+            return None
+        with np.load(path) as stored:
+            # Taken before snapshots were keyed, or with another model
+            if "key" not in stored.files or str(stored["key"]) != self.key:
+                return None
+            snapshots = Snapshots(int(stored["spacing"]), stored["frames"], stored["states"], stored["quiet_frames"])
+        self._remember(url, snapshots)
+        return snapshots
+
+    def save(self, url: str, snapshots: Snapshots):
+        os.makedirs(self.directory, exist_ok=True)
+        path = self._get_path(url)
+        with open(path + ".tmp", "wb") as snapshot_file:
+            np.savez(
+                snapshot_file,
+                key=np.array(self.key),
+                spacing=snapshots.spacing,
+                frames=np.array(snapshots.frames, dtype=np.int64),
+                states=np.array(snapshots.states, dtype=np.float16),
+                quiet_frames=np.array(snapshots.quiet_frames, dtype=np.int64),
+            )
+        os.replace(path + ".tmp", path)
+        self._remember(url, snapshots)
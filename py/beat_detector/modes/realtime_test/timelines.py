@@ -0,0 +1,123 @@
+"""Beat timelines that get computed once per downloaded track"""
+from typing import Any, Dict, Iterable, Iterator, List, Optional
+from ..silence import SilenceGate, predict_audible
+from .snapshots import Snapshots
+from ..model import get_states
+from ..spectrum import SpectrumStream
+from ..frontend import FrontEnd
+from ..audio import open_audio
+import numpy as np
+import threading
+import warnings
+import hashlib
+import base64
+import json
+import os
+
+with warnings.catch_warnings():
+    warnings.filterwarnings("ignore", category=FutureWarning)
+    from tensorflow.keras.models import Sequential
+
+# Frames that get run through the model per predict call
+PREDICT_FRAMES = 1024
+
+# Frames decoded in front of a seek target, they fill the spectrum's window and smoothing like playing would have
+WARMUP_FRAMES = 8
+
+
+def encode_confidences(confidences: np.ndarray) -> str:
+    """Quantizes confidences to a byte per frame"""
+    quantized = np.round(np.clip(confidences, 0, 1) * 255).astype(np.uint8)
+    return base64.b64encode(quantized.tobytes()).decode("ascii")
+
+
+def batch_frames(bins: Iterable[np.ndarray], size: int) -> Iterator[np.ndarray]:
+    """Regroups arrays of frames into batches of **size** frames, the last one may be shorter"""
+    pending: List[np.ndarray] = list()
+    pending_frames = 0
+    for frames in bins:
+        pending.append(frames)
+        pending_frames += len(frames)
+        if pending_frames >= size:
+            joined = np.concatenate(pending)
+            yield joined[:size]
+            pending = [joined[size:]]
+            pending_frames = len(pending[0])
+    if pending_frames > 0:
+        yield np.concatenate(pending)
+
+
+def analyse_track(
+    model: Sequential, path: str, interval: int, frontend: FrontEnd, snapshots: Optional[Snapshots] = None
+) -> Dict[str, Any]:
+    """Runs an entire track through the model in large batched steps, recording **snapshots** between them"""
+    sample_rate, chunks = open_audio(path)
+    stream = SpectrumStream(sample_rate, interval)
+    gate = SilenceGate(interval)
+
+    model.reset_states()
+    confidences: List[np.ndarray] = list()
+    position = 0
+    # Batches end where snapshots are taken
+    batch_size = snapshots.spacing if snapshots is not None else PREDICT_FRAMES
+    for frames in batch_frames(map(stream.push, chunks), batch_size):
+        if snapshots is not None:
+            snapshots.add(position, get_states(model), gate.quiet_frames)
+        position += len(frames)
+        skipped, resets = gate.push(frames)
+        features = np.reshape(frontend.apply(frames), (len(frames), frontend.length, 1))
+        predictions = predict_audible(model, features, skipped, resets)
+        confidences.append(predictions[:, 0])
+    model.reset_states()
+
+    all_confidences = np.concatenate(confidences) if confidences else np.zeros(0)
+    return {"interval": interval, "frames": len(all_confidences), "confidences": encode_confidences(all_confidences)}
+
+
+def read_frames(path: str, interval: int, start_frame: int, end_frame: int) -> np.ndarray:
+    """The bins of frames **start_frame** up to **end_frame** of a track, only decoding that part of it"""
+    lead = min(start_frame, WARMUP_FRAMES)
+    sample_rate, chunks = open_audio(
+        path, (start_frame - lead) * interval / 1000, (end_frame - start_frame + lead + 1) * interval / 1000
+    )
+    stream = SpectrumStream(sample_rate, interval)
+    bins = [stream.push(chunk) for chunk in chunks]
+    if not bins:
+        return np.zeros((0, stream.analyser.pool.shape[1]), dtype=np.float32)
+    return np.concatenate(bins)[lead : lead + end_frame - start_frame]
+
+
+class TimelineStore:
+    """Timelines on disk, keyed by the URL their track was downloaded from"""
+
+    def __init__(self, directory: str):
+        self.directory = directory
+        self._cache: Dict[str, Dict[str, Any]] = dict()
+        self._lock = threading.Lock()
+
+    def _get_path(self, url: str) -> str:
+        return os.path.join(self.directory, "{}.json".format(hashlib.sha1(url.encode("utf8")).hexdigest()))
+
+    def get(self, url: str) -> Optional[Dict[str, Any]]:
+        with self._lock:
+            if url in self._cache:
+                return self._cache[url]
+
+        path = self._get_path(url)
+        if not os.path.isfile(path):
+            return None
+        with open(path, "r") as timeline_file:
+            timeline = json.load(timeline_file)
+        with self._lock:
+            self._cache[url] = timeline
+        return timeline
+
+    def save(self, url: str, timeline: Dict[str, Any]):
+        os.makedirs(self.directory, exist_ok=True)
+        path = self._get_path(url)
+        # Write then rename so readers never see half a timeline
+        with open(path + ".tmp", "w+") as timeline_file:
+            json.dump(timeline, timeline_file)
+        os.replace(path + ".tmp", path)
+        with self._lock:
+            self._cache[url] = timeline
@@ -0,0 +1,136 @@
+"""Pre-forked worker processes that share the realtime server's listening socket"""
+from typing import Callable, Dict, List, Tuple
+from lib.log import logline, warn, error
+import http.client
+import threading
+import traceback
+import signal
+import time
+import queue
+import zlib
+import os
+
+# Idle connections kept open to every sibling worker
+MAX_IDLE_CONNECTIONS = 16
+
+# Seconds a forwarded request may take before it's given up on
+FORWARD_TIMEOUT = 10
+
+# A worker that dies within this many seconds of starting crashed while starting up
+MIN_UPTIME = 10
+# Times in a row a worker may crash while starting up before the supervisor gives up
+MAX_STARTUP_CRASHES = 3
+# Seconds before restarting a worker that crashed while starting up, doubled every time it happens again
+RESTART_DELAY = 1
+
+
+def owner_of(key: str, workers: int) -> int:
+    """The worker that holds the state for **key**, the same in every process"""
+    return zlib.crc32(key.encode("utf8")) % workers
+
+
+class ForwardPool:
+    """Keep-alive connections to the private sockets of the other workers"""
+
+    def __init__(self, ports: List[int]):
+        self.ports = ports
+        self._idle: Dict[int, "queue.Queue[http.client.HTTPConnection]"] = {
+            port: queue.Queue(MAX_IDLE_CONNECTIONS) for port in ports
+        }
+
+    def _take(self, port: int) -> http.client.HTTPConnection:
+        try:
+            return self._idle[port].get_nowait()
+        except queue.Empty:
+            return http.client.HTTPConnection("127.0.0.1", port, timeout=FORWARD_TIMEOUT)
+
+    def _give_back(self, port: int, connection: http.client.HTTPConnection):
+        try:
+            self._idle[port].put_nowait(connection)
+        except queue.Full:
+            connection.close()
+
+    def request(
+        self, worker: int, method: str, path: str, body: bytes, headers: Dict[str, str]
+    ) -> Tuple[int, str, bytes]:
+        """Sends a request to **worker**, returns its status, content type and body"""
+        port = self.ports[worker]
+        connection = self._take(port)
+        try:
+            connection.request(method, path, body, headers)
+            response = connection.getresponse()
+            content = response.read()
+        except (OSError, http.client.HTTPException):
+            connection.close()
+            raise
+        self._give_back(port, connection)
+        return response.status, response.getheader("Content-Type", "application/json"), content
+
+
+def run_workers(count: int, run_worker: Callable[[int], None]) -> int:
+    """Forks **count** workers and restarts any that die, until the supervisor is stopped. Gives up when a worker
+    keeps crashing while starting up, returns 1 then and 0 otherwise"""
+    children: Dict[int, int] = dict()
+    started_at: Dict[int, float] = dict()
+    startup_crashes: Dict[int, int] = {index: 0 for index in range(count)}
+
+    def spawn(index: int):
+        pid = os.fork()
+        if pid == 0:
+            # Ctrl+c is handled by the supervisor, it terminates the workers itself
+            signal.signal(signal.SIGINT, signal.SIG_IGN)
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+            code = 0
+            try:
+                run_worker(index)
+            except BaseException:
+                code = 1
+                # os._exit would drop the exception before it got printed
+                traceback.print_exc()
+            finally:
+                # Never return into the supervisor's code
+                os._exit(code)
+        children[pid] = index
+        started_at[index] = time.monotonic()
+
+    for index in range(count):
+        spawn(index)
+    logline("started {} workers".format(count))
+
+    stopping = threading.Event()
+    failed = False
+
+    def stop(*_):
+        stopping.set()
+        for pid in children:
+            os.kill(pid, signal.SIGTERM)
+
+    signal.signal(signal.SIGTERM, stop)
+    try:
+        while children:
+            pid, status = os.wait()
+            index = children.pop(pid, None)
+            if index is None or stopping.is_set():
+                continue
+            if time.monotonic() - started_at[index] >= MIN_UPTIME:
+                startup_crashes[index] = 0
+                warn("worker {} exited with status {}, restarting it".format(index, status))
+                spawn(index)
+                continue
+
+            startup_crashes[index] += 1
+            if startup_crashes[index] > MAX_STARTUP_CRASHES:
+                error("worker {} keeps crashing while starting up, stopping".format(index))
+                stop()
+                failed = True
+                continue
+            delay = RESTART_DELAY * 2 ** (startup_crashes[index] - 1)
+            warn("worker {} crashed while starting up, restarting it in {}s".format(index, delay))
+            stopping.wait(delay)
+            if not stopping.is_set():
+                spawn(index)
+    except KeyboardInterrupt:
+        stop()
+        for pid in list(children):
+            os.waitpid(pid, 0)
+    return 1 if failed else 0
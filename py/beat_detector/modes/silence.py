@@ -0,0 +1,89 @@
+"""Finds silent stretches of spectrum frames so they can be skipped instead of run through the model"""
+from typing import List, Tuple
+import numpy as np
+import math
+
+# Mean bin level below which a frame counts as silent, 0 is the AnalyserNode's floor and 1 is full scale
+SILENCE_LEVEL = 0.05
+
+# Quiet frames in a row before they count as silence, so short breaks within a track still get predicted
+MIN_SILENT_FRAMES = 4
+
+# Silence at least this long resets the model's state, it most likely separates two tracks
+RESET_SECONDS = 2
+
+# Prediction of a skipped frame, no beat and an offset right on the frame's time. Matches features.NO_OFFSET,
+# which can't be imported here since features imports this module
+SKIPPED_PREDICTION = (0.0, 0.5)
+
+
+def is_silent(frames: np.ndarray) -> np.ndarray:
+    """Whether each of an (n, bins) array of frames is silent on its own"""
+    frames = np.asarray(frames, dtype=np.float32)
+    if len(frames) == 0:
+        return np.zeros(0, dtype=bool)
+    return np.reshape(frames, (len(frames), -1)).mean(axis=1) < SILENCE_LEVEL
+
+
+def find_silent_spans(frames: np.ndarray) -> List[Tuple[int, int]]:
+    """Start and end (exclusive) of every run of at least MIN_SILENT_FRAMES silent frames"""
+    silent = np.concatenate([[False], is_silent(frames), [False]])
+    edges = np.flatnonzero(silent[1:] != silent[:-1])
+    return [(int(start), int(end)) for start, end in zip(edges[::2], edges[1::2]) if end - start >= MIN_SILENT_FRAMES]
+
+
+def silent_mask(length: int, spans: List[Tuple[int, int]]) -> np.ndarray:
+    mask = np.zeros(length, dtype=bool)
+    for start, end in spans:
+        mask[start:end] = True
+    return mask
+
+
+def get_reset_frames(interval: int) -> int:
+    return max(math.ceil(RESET_SECONDS * 1000 / interval), MIN_SILENT_FRAMES)
+
+
+def span_masks(length: int, spans: List[Tuple[int, int]], interval: int) -> Tuple[np.ndarray, np.ndarray]:
+    """Which frames are skipped and before which frames the state is reset, for spans found ahead of time.
+    Runs them through a SilenceGate, so the model sees the same frames as when they come in one after the other"""
+    return SilenceGate(interval).push_silent(silent_mask(length, spans))
+
+
+class SilenceGate:
+    """Finds silence in frames as they come in, only skipping frames once MIN_SILENT_FRAMES quiet ones were seen"""
+
+    def __init__(self, interval: int):
+        self.reset_frames = get_reset_frames(interval)
+        self.quiet_frames = 0
+
+    def push(self, frames: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        """Which of the pushed frames are skipped and before which ones the state is reset"""
+        return self.push_silent(is_silent(frames))
+
+    def push_silent(self, silent: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        """Like push, for frames already known to be silent or not"""
+        skipped = np.zeros(len(silent), dtype=bool)
+        resets = np.zeros(len(silent), dtype=bool)
+        for i in range(len(silent)):
+            self.quiet_frames = self.quiet_frames + 1 if silent[i] else 0
+            skipped[i] = self.quiet_frames >= MIN_SILENT_FRAMES
+            resets[i] = self.quiet_frames == self.reset_frames
+        return skipped, resets
+
+
+def predict_audible(model, frames: np.ndarray, skipped: np.ndarray, resets: np.ndarray, verbose: int = 0) -> np.ndarray:
+    """Predicts only the frames that aren't skipped, skipped ones get SKIPPED_PREDICTION and leave the state as is"""
+    predictions = np.zeros((len(frames), model.output_shape[-1]), dtype=np.float32)
+    predictions[:] = SKIPPED_PREDICTION[: predictions.shape[1]]
+    # Start and end of every run of frames that isn't skipped
+    bounds = np.flatnonzero(np.diff(np.concatenate([[True], skipped, [True]]).astype(np.int8)))
+    previous_end = 0
+    for start, end in zip(bounds[::2], bounds[1::2]):
+        if np.any(resets[previous_end:start]):
+            model.reset_states()
+        predictions[start:end] = model.predict(frames[start:end], batch_size=1, verbose=verbose)
+        previous_end = end
+    # A reset in trailing silence still has to happen before whatever is predicted next
+    if np.any(resets[previous_end:]):
+        model.reset_states()
+    return predictions
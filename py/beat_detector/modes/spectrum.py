@@ -0,0 +1,113 @@
+"""Computes spectrum bins from raw PCM the same way the browser's AnalyserNode does"""
+from scipy.signal import lfilter
+from .features import BINS
+from typing import Optional
+import numpy as np
+
+# AnalyserNode defaults
+FFT_SIZE = 2048
+SMOOTHING = 0.8
+MIN_DECIBELS = -100.0
+
+
+def blackman_window(size: int) -> np.ndarray:
+    """The blackman window the WebAudio spec prescribes"""
+    alpha = 0.16
+    phase = 2 * np.pi * np.arange(size) / size
+    window = (1 - alpha) / 2 - 0.5 * np.cos(phase) + (alpha / 2) * np.cos(2 * phase)
+    return window.astype(np.float32)
+
+
+def pooling_matrix(in_bins: int, out_bins: int) -> np.ndarray:
+    """Averages **in_bins** frequency bins into **out_bins** the way the front-end's cleanData does"""
+    matrix = np.zeros((in_bins, out_bins), dtype=np.float32)
+    delta = in_bins / out_bins
+    position = 0.0
+    for out_bin in range(out_bins):
+        # JS' slice truncates the fractional indices
+        matrix[int(position) : int(position + delta), out_bin] = 1.0 / delta
+        position += delta
+    return matrix
+
+
+class SpectrumAnalyser:
+    """Turns windows of samples into spectrum bins, keeping the smoothing state between calls"""
+
+    def __init__(self, fft_size: int = FFT_SIZE, smoothing: float = SMOOTHING, bins: int = BINS):
+        self.fft_size = fft_size
+        self.smoothing = smoothing
+        self.window = blackman_window(fft_size)
+        self.pool = pooling_matrix(fft_size // 2, bins)
+        self._smoothed = np.zeros(fft_size // 2, dtype=np.float32)
+
+    def reset(self):
+        self._smoothed[:] = 0
+
+    def analyse(self, frames: np.ndarray) -> np.ndarray:
+        """Analyses an (n, fft_size) array of sample windows into (n, bins) spectrum bins"""
+        if len(frames) == 0:
+            return np.zeros((0, self.pool.shape[1]), dtype=np.float32)
+
+        spectrum = np.fft.rfft(frames * self.window, axis=1)[:, : self.fft_size // 2]
+        magnitudes = np.abs(spectrum).astype(np.float32) / self.fft_size
+
+        # Exponential smoothing over time, run as a single IIR filter over all frames
+        smoothed, _ = lfilter(
+            [1 - self.smoothing], [1, -self.smoothing], magnitudes, axis=0, zi=(self.smoothing * self._smoothed)[None]
+        )
+        self._smoothed = smoothed[-1].astype(np.float32)
+
+        with np.errstate(divide="ignore"):
+            decibels = 20 * np.log10(smoothed)
+        cleaned = np.where(
+            (decibels <= MIN_DECIBELS) | (decibels == -80) | (decibels == -50), 0.0, (decibels - MIN_DECIBELS) / 100
+        )
+        return (cleaned @ self.pool).astype(np.float32)
+
+
+class SpectrumStream:
+    """Buffers pushed PCM blocks in a fixed-size ring and emits a frame of bins every interval ms"""
+
+    def __init__(self, sample_rate: int, interval: int, analyser: Optional[SpectrumAnalyser] = None):
+        self.analyser = analyser or SpectrumAnalyser()
+        self.sample_rate = sample_rate
+        self.hop = sample_rate * interval / 1000
+
+        fft_size = self.analyser.fft_size
+        # Twice the window so a block of up to fft_size samples never
+        # overwrites samples an earlier frame in that block still needs
+        self._ring = np.zeros(fft_size * 2, dtype=np.float32)
+        self._offsets = np.arange(-fft_size, 0)
+        self._position = 0
+        self._next_frame = self.hop
+
+    def _write(self, samples: np.ndarray):
+        start = self._position % len(self._ring)
+        first = min(len(samples), len(self._ring) - start)
+        self._ring[start : start + first] = samples[:first]
+        self._ring[: len(samples) - first] = samples[first:]
+        self._position += len(samples)
+
+    def _take_frames(self) -> np.ndarray:
+        frame_count = max(int((self._position - self._next_frame) // self.hop) + 1, 0)
+
+        ends = np.round(self._next_frame + np.arange(frame_count) * self.hop).astype(np.int64)
+        self._next_frame += frame_count * self.hop
+        return self._ring[(ends[:, None] + self._offsets) % len(self._ring)]
+
+    def push(self, samples: np.ndarray) -> np.ndarray:
+        """Adds mono samples, returns the bins of every frame that got completed by them"""
+        results = []
+        block = self.analyser.fft_size
+        for start in range(0, len(samples), block):
+            self._write(samples[start : start + block])
+            results.append(self.analyser.analyse(self._take_frames()))
+        if not results:
+            return np.zeros((0, self.analyser.pool.shape[1]), dtype=np.float32)
+        return np.concatenate(results)
+
+    def reset(self):
+        self.analyser.reset()
+        self._ring[:] = 0
+        self._position = 0
+        self._next_frame = self.hop
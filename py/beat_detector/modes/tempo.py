@@ -0,0 +1,109 @@
+"""Online tempo and phase estimation on the model's stream of beat confidences"""
+from typing import List, Optional
+import numpy as np
+
+# Seconds of confidences that tempo and phase get estimated from
+WINDOW_SECONDS = 8
+
+# Range of tempos that get considered
+MIN_BPM = 60
+MAX_BPM = 200
+
+# Harmonics summed by every comb filter
+COMB_HARMONICS = 4
+
+# Frames between tempo re-estimations, phase is estimated every frame
+TEMPO_EVERY = 10
+
+# How far ahead beats get predicted by default, in milliseconds
+HORIZON = 2000
+
+
+def interpolate(values: np.ndarray, positions: np.ndarray) -> np.ndarray:
+    """Linearly interpolated lookups at fractional positions, 0 outside of **values**"""
+    lower = np.floor(positions).astype(np.int64)
+    fraction = positions - lower
+    valid_lower = (lower >= 0) & (lower < len(values))
+    valid_upper = (lower + 1 >= 0) & (lower + 1 < len(values))
+    lower_values = np.where(valid_lower, values[np.clip(lower, 0, len(values) - 1)], 0.0)
+    upper_values = np.where(valid_upper, values[np.clip(lower + 1, 0, len(values) - 1)], 0.0)
+    return lower_values * (1 - fraction) + upper_values * fraction
+
+
+class TempoTracker:
+    """Tracks tempo with a comb-filter bank over the autocorrelation of a sliding window, and phase by folding"""
+
+    def __init__(self, interval: int, window_seconds: float = WINDOW_SECONDS):
+        self.interval = interval
+        self.size = int(window_seconds * 1000 / interval)
+
+        # Candidate beat periods in frames, one per BPM
+        bpms = np.arange(MIN_BPM, MAX_BPM + 1, dtype=np.float64)
+        self._periods = 60000 / bpms / interval
+        self._harmonics = np.arange(1, COMB_HARMONICS + 1)
+
+        self._window = np.zeros(self.size)
+        self._frames = 0
+        self.period: Optional[float] = None
+        self.phase = 0.0
+
+    @property
+    def bpm(self) -> Optional[float]:
+        if self.period is None:
+            return None
+        return 60000 / (self.period * self.interval)
+
+    def reset(self):
+        self._window[:] = 0
+        self._frames = 0
+        self.period = None
+        self.phase = 0.0
+
+    def _ordered_window(self) -> np.ndarray:
+        """The window with the oldest frame first"""
+        return np.roll(self._window, -(self._frames % self.size))
+
+    def _estimate_tempo(self, window: np.ndarray):
+        centered = window - window.mean()
+        spectrum = np.fft.rfft(centered, n=2 * len(centered))
+        autocorrelation = np.fft.irfft(spectrum * np.conj(spectrum))[: len(centered)]
+        if autocorrelation[0] <= 0:
+            return
+
+        # Every row sums the autocorrelation at the harmonics of one candidate period
+        lags = self._periods[:, None] * self._harmonics[None, :]
+        scores = interpolate(autocorrelation, lags).sum(axis=1)
+        self.period = float(self._periods[np.argmax(scores)])
+
+    def _estimate_phase(self, window: np.ndarray):
+        assert self.period is not None
+        # Frames since the last beat, in quarter frame steps
+        offsets = np.arange(0, self.period, 0.25)
+        beats = np.arange(int(len(window) / self.period))
+        positions = (len(window) - 1) - offsets[:, None] - beats[None, :] * self.period
+        # Recent beats weigh heavier so the phase can follow drift
+        weights = 0.8 ** beats
+        scores = (interpolate(window, positions) * weights[None, :]).sum(axis=1)
+        self.phase = float(offsets[np.argmax(scores)])
+
+    def push(self, confidences: List[float]):
+        """Adds the confidences of the next frames"""
+        for confidence in confidences:
+            self._window[self._frames % self.size] = confidence
+            self._frames += 1
+
+            if self._frames < self.size // 2:
+                continue
+            window = self._ordered_window()
+            if self.period is None or self._frames % TEMPO_EVERY == 0:
+                self._estimate_tempo(window)
+            if self.period is not None:
+                self._estimate_phase(window)
+
+    def predict(self, horizon: float = HORIZON) -> List[float]:
+        """Upcoming beats within **horizon** ms, in ms relative to the newest frame"""
+        if self.period is None:
+            return list()
+        period_ms = self.period * self.interval
+        first = (self.period - self.phase) * self.interval
+        return list(np.arange(first, horizon, period_ms))
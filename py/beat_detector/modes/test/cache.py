@@ -0,0 +1,62 @@
+"""Raw per-frame predictions cached on disk so re-scoring doesn't need to run the model"""
+from typing import Optional, Sequence
+import numpy as np
+import hashlib
+import os
+
+# Frames of features hashed at once
+HASH_FRAMES = 4096
+
+
+def hash_file(path: str) -> str:
+    digest = hashlib.sha1()
+    with open(path, "rb") as in_file:
+        for block in iter(lambda: in_file.read(1 << 20), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+class PredictionCache:
+    """Predictions keyed by the weights, the model config and a track's features, evicting least recently used"""
+
+    def __init__(self, directory: str, weights_hash: str, model_config: str, max_bytes: int):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self._prefix = hashlib.sha1((weights_hash + model_config).encode("utf8")).digest()
+
+    def _get_path(self, features: Sequence) -> str:
+        digest = hashlib.sha1(self._prefix)
+        digest.update(str(len(features)).encode("utf8"))
+        # In blocks, so long tracks never get converted all at once
+        for start in range(0, len(features), HASH_FRAMES):
+            digest.update(np.ascontiguousarray(features[start : start + HASH_FRAMES], dtype=np.float32).tobytes())
+        return os.path.join(self.directory, "{}.npy".format(digest.hexdigest()))
+
+    def get(self, features: Sequence) -> Optional[np.ndarray]:
+        path = self._get_path(features)
+        if not os.path.isfile(path):
+            return None
+        # Mark as recently used
+        os.utime(path)
+        return np.load(path)
+
+    def put(self, features: Sequence, predictions: np.ndarray):
+        os.makedirs(self.directory, exist_ok=True)
+        path = self._get_path(features)
+        # Written through a file object, np.save would add .npy to the name and evict would take it for an entry
+        with open(path + ".tmp", "wb") as tmp_file:
+            np.save(tmp_file, np.asarray(predictions, dtype=np.float32))
+        os.replace(path + ".tmp", path)
+        self.evict()
+
+    def evict(self):
+        """Removes the least recently used entries until the cache fits in max_bytes"""
+        entries = [entry for entry in os.scandir(self.directory) if entry.name.endswith(".npy")]
+        entries.sort(key=lambda entry: entry.stat().st_mtime)
+
+        total = sum(entry.stat().st_size for entry in entries)
+        for entry in entries:
+            if total <= self.max_bytes:
+                break
+            total -= entry.stat().st_size
+            os.remove(entry.path)
@@ -1,16 +1,21 @@
 """Main entrypoint for testing mode"""
 
-from ..features import Preprocessed, Features, OUT_VEC_SIZE, is_in_range
-from lib.log import debug, logline, enter_group, exit_group
-from ..model import create_model, apply_weights
-from sklearn.metrics import mean_squared_error
-from typing import Any, List, Dict, Tuple, Union
+from ..features import Preprocessed, get_beat_times, OUT_VEC_SIZE, OFFSET_INDEX, is_in_range
+from lib.log import debug, logline, enter_group, exit_group, warn
+from ..silence import SILENCE_LEVEL, MIN_SILENT_FRAMES, RESET_SECONDS, SKIPPED_PREDICTION, span_masks, predict_audible
+from ..inference import load_model, convert_weights, get_lite_path, step_latency, warm_up
+from ..inference import LiteModel, StepModel, PRECISIONS, LITE_EXTENSION
+from typing import Any, Iterator, List, Dict, Optional, Tuple, Union
+from .cache import PredictionCache, hash_file
+from ..preprocess.files import AnalysisFile
+from ..dataset import load_dataset
+from ..frontend import FrontEnd
+from ..tempo import TempoTracker
 from lib.io import IO, IOInput
 from lib.timer import Timer
 import numpy as np
 import warnings
 import pathlib
-import pickle
 import time
 import json
 import os
@@ -19,16 +24,21 @@ with warnings.catch_warnings():
     warnings.filterwarnings("ignore", category=FutureWarning)
     from tensorflow.keras.models import Sequential
 
+# Frames run through the model at once, keeps memory use the same no matter how long a track is
+CHUNK_FRAMES = 1024
+
+GENRE = {"hard": 0.5, "uptempo": 0.5}
+
 
 def get_io() -> IO:
     return IO(
         {
             "i": IOInput(
-                "./data/preprocessed.pickle",
+                "./data/preprocessed/",
                 str,
                 has_input=True,
                 arg_name="input_preprocessed",
-                descr="Input preprocessed file",
+                descr="Input preprocessed dataset, a directory of shards or a .pickle file",
                 alias="input_preprocessed",
                 is_generic=True,
             ),
@@ -37,7 +47,7 @@ def get_io() -> IO:
                 str,
                 has_input=True,
                 arg_name="input_weights",
-                descr="Input weights file",
+                descr="Input weights file, or a .tflite model written by quantize mode",
                 alias="input_weights",
             ),
             "it": IOInput(
@@ -57,109 +67,383 @@ def get_io() -> IO:
                 alias="output_annotated",
             ),
             "n": IOInput(
-                50, int, has_input=True, arg_name="interval", descr="Interval at which data is sent", alias="interval"
+                0,
+                int,
+                has_input=True,
+                arg_name="interval",
+                descr="Interval to test at, a multiple of the dataset's (0 for the one trained at)",
+                alias="interval",
+            ),
+            "a": IOInput(
+                "",
+                str,
+                has_input=True,
+                arg_name="analysis",
+                descr="Analysis JSON file, reports tempo tracking timing error against its beats when passed",
+                alias="analysis",
+            ),
+            "l": IOInput(
+                100,
+                int,
+                has_input=True,
+                arg_name="lookahead",
+                descr="How many ms in advance the tempo tracker has to predict beats",
+                alias="lookahead",
+            ),
+            "c": IOInput(
+                "./data/prediction_cache/",
+                str,
+                has_input=True,
+                arg_name="cache",
+                descr="Directory in which raw predictions get cached",
+                alias="cache",
+            ),
+            "cm": IOInput(
+                512,
+                int,
+                has_input=True,
+                arg_name="cache_mb",
+                descr="Size in MB above which the least recently used predictions get evicted",
+                alias="cache_mb",
+            ),
+            "nc": IOInput(
+                False, bool, has_input=False, arg_name="no_cache", descr="Always run the model", alias="no_cache"
+            ),
+            "kp": IOInput(
+                False,
+                bool,
+                has_input=False,
+                arg_name="keras_predict",
+                descr="Run weights through Keras' own predict instead of the compiled step function",
+                alias="keras_predict",
+            ),
+            "cp": IOInput(
+                "",
+                str,
+                has_input=True,
+                arg_name="compare_precisions",
+                descr="Comma separated precisions ({}) to compare against the weights, by accuracy and speed".format(
+                    ", ".join(PRECISIONS)
+                ),
+                alias="compare_precisions",
             ),
         }
     )
 
 
-def read_test_files(io: IO) -> List[Preprocessed]:
-    with open(io.get("input_preprocessed"), "rb") as preprocessed_file:
-        file_configs = pickle.load(preprocessed_file)
-        with open(io.get("input_train"), "rb") as train_config_file:
-            train_config = json.load(train_config_file)
-            test_files_names = train_config["test_set"]
+def read_test_files(io: IO) -> Tuple[List[Preprocessed], int, FrontEnd]:
+    with open(io.get("input_train"), "rb") as train_config_file:
+        train_config = json.load(train_config_file)
+        test_files_names = train_config["test_set"]
 
-            preprocessed = map(lambda x: Preprocessed(x), file_configs)
-            test_files = list(filter(lambda x: x.file_name in test_files_names, preprocessed))
-            return test_files
+    # Train configs from before intervals were recorded leave it up to the dataset
+    # Only reads the shards holding test files
+    test_files, interval, frontend = load_dataset(
+        io.get("input_preprocessed"),
+        io.get("interval") or train_config.get("interval"),
+        FrontEnd.from_config(train_config.get("frontend")),
+        set(test_files_names),
+    )
+    return test_files, interval, frontend
 
 
-def get_test_params(file: Preprocessed) -> Tuple[np.ndarray, np.ndarray]:
-    test_x = file.features
-    test_y = file.outputs
+def iter_test_inputs(file: Preprocessed, feature_len: int) -> Iterator[np.ndarray]:
+    """The features of a file in chunks of CHUNK_FRAMES, shaped for the model"""
+    for start in range(0, len(file.features), CHUNK_FRAMES):
+        test_x = np.asarray(file.features[start : start + CHUNK_FRAMES], dtype=np.float32)
+        assert test_x.shape[1] == feature_len
+        yield np.reshape(test_x, (len(test_x), test_x.shape[1], 1))
 
-    x_np = np.array(test_x)
-    y_np = np.array(test_y)
 
-    x_np = np.reshape(x_np, (x_np.shape[0], x_np.shape[1], 1))
+def get_test_outputs(file: Preprocessed, start: int, end: int) -> np.ndarray:
+    test_y = np.asarray(file.outputs[start:end], dtype=np.float32)
+    assert test_y.shape[1] == OUT_VEC_SIZE
+    return test_y
 
-    assert len(x_np.shape) == 3
-    assert len(y_np.shape) == 2
 
-    x_shape_1, x_shape_2, _ = x_np.shape
-    y_shape_1, y_shape_2 = y_np.shape
+def beat_items(
+    predictions: np.ndarray, start_frame: int, interval: int, skipped: Optional[np.ndarray] = None
+) -> List[Dict[str, Any]]:
+    """Beat items for the frames that are confident enough, **start_frame** being the index of the first one.
+    Their times are moved within the frame by the predicted offset. Silent frames that were **skipped** never are"""
+    in_range = is_in_range(predictions[:, 0])
+    if skipped is not None:
+        in_range = in_range & ~skipped
+    indices = np.flatnonzero(in_range)
+    times = get_beat_times(start_frame + indices, predictions[indices, OFFSET_INDEX], interval)
+    return [{"type": "beat", "time": int(round(beat_time))} for beat_time in times]
 
-    assert x_shape_1 == y_shape_1
-    assert x_shape_2 == Features.length()
-    assert y_shape_2 == OUT_VEC_SIZE
 
-    return x_np, y_np
+def predictions_to_out_file(predictions: np.array, interval: int):
+    return {"items": beat_items(predictions, 0, interval), "genre": GENRE}
 
 
-def predictions_to_out_file(predictions: np.array, io: IO):
-    obj: Dict[str, Any] = {"items": [], "genre": {"hard": 0.5, "uptempo": 0.5}}
-    interval = io.get("interval")
+class BeatFileWriter:
+    """Writes the same JSON as predictions_to_out_file, but appends beats as the predictions come in"""
 
-    cur_time = 0
-    for i in range(len(predictions)):
-        prediction: Tuple[float] = predictions[i]
-        confidence: float = prediction[0]
+    def __init__(self, path: str, interval: int):
+        self.interval = interval
+        self.frames = 0
+        self._file = open(path, "w+")
+        self._file.write('{"items": [')
+        self._first = True
+
+    def add(self, predictions: np.ndarray, skipped: Optional[np.ndarray] = None):
+        for item in beat_items(predictions, self.frames, self.interval, skipped):
+            if not self._first:
+                self._file.write(", ")
+            json.dump(item, self._file)
+            self._first = False
+        self.frames += len(predictions)
+
+    def close(self):
+        self._file.write('], "genre": {}}}'.format(json.dumps(GENRE)))
+        self._file.close()
+
+    def __enter__(self):
+        return self
 
-        if is_in_range(confidence):
-            cur_obj = {}
-            cur_obj["type"] = "beat"
-            cur_obj["time"] = cur_time
-            obj["items"].append(cur_obj)
+    def __exit__(self, *args):
+        self.close()
 
-        cur_time += interval
 
-    return obj
+def tempo_timing_errors(predictions: np.ndarray, beat_times: np.ndarray, interval: int, io: IO) -> np.ndarray:
+    """Errors in ms of the beats the tempo tracker predicted exactly lookahead ms in advance"""
+    lookahead = io.get("lookahead")
 
+    tracker = TempoTracker(interval)
+    errors: List[float] = list()
+    for i in range(len(predictions)):
+        tracker.push([float(predictions[i][0])])
+        for offset in tracker.predict(lookahead + interval):
+            if offset >= lookahead:
+                beat_time = i * interval + offset
+                errors.append(float(np.min(np.abs(beat_times - beat_time))))
+    return np.array(errors)
+
+
+def report_tempo_tracking(predictions: np.ndarray, file: Preprocessed, analysis: AnalysisFile, interval: int, io: IO):
+    track = analysis.find_track_for_file(file.file_name)
+    if track is None or len(track.beats) == 0:
+        warn('no analysed beats for "{}"'.format(file.file_name))
+        return
+
+    beat_times = np.array([beat.timestamp * 1000 for beat in track.beats])
+    errors = tempo_timing_errors(predictions, beat_times, interval, io)
+    if len(errors) == 0:
+        logline("tempo tracker predicted no beats")
+        return
+
+    logline(
+        "tempo tracker predicted {} beats {}ms ahead, timing error mean {}ms, median {}ms, p90 {}ms".format(
+            len(errors),
+            io.get("lookahead"),
+            round(float(np.mean(errors)), 1),
+            round(float(np.median(errors)), 1),
+            round(float(np.percentile(errors, 90)), 1),
+        )
+    )
 
-def run_tests(io: IO, model: Sequential, test_files: List[Preprocessed]):
+
+def iter_predictions(
+    model: Sequential, cache: Optional[PredictionCache], file: Preprocessed, interval: int
+) -> Iterator[np.ndarray]:
+    """Predictions for a file in chunks of CHUNK_FRAMES, the model's state carries over between chunks"""
+    if cache:
+        cached = cache.get(file.features)
+        if cached is not None:
+            logline("using cached predictions")
+            for start in range(0, len(cached), CHUNK_FRAMES):
+                yield cached[start : start + CHUNK_FRAMES]
+            return
+
+    skipped, resets = span_masks(len(file.features), file.silent_spans, interval)
+    logline("making predictions, skipping {} silent frames".format(int(np.count_nonzero(skipped))))
+    # Only the predictions themselves are kept for the cache, a few bytes per frame
+    chunks: List[np.ndarray] = list()
+    start = 0
+    for test_x in iter_test_inputs(file, model.input_shape[1]):
+        end = start + len(test_x)
+        predictions = predict_audible(model, test_x, skipped[start:end], resets[start:end])
+        if cache:
+            chunks.append(predictions)
+        yield predictions
+        start = end
     model.reset_states()
 
-    for file in test_files:
-        logline("creating test params for {}".format(file.file_name))
-        test_x, test_y = get_test_params(file)
+    if cache:
+        cache.put(file.features, np.concatenate(chunks) if chunks else np.zeros((0, OUT_VEC_SIZE)))
+
 
-        logline("making predictions")
-        predictions: List[List[float]] = model.predict(test_x, batch_size=1, verbose=1)
+def create_cache(io: IO, model: Sequential) -> Optional[PredictionCache]:
+    if io.get("no_cache"):
+        return None
+    # Skipped frames and what they predict depend on the silence settings too
+    model_config = model.to_json() + str((SILENCE_LEVEL, MIN_SILENT_FRAMES, RESET_SECONDS, SKIPPED_PREDICTION))
+    return PredictionCache(
+        io.get("cache"), hash_file(io.get("input_weights")), model_config, io.get("cache_mb") * 1024 * 1024
+    )
+
+
+class Score:
+    """Accuracy of predictions against the expected outputs, added up over chunks"""
+
+    def __init__(self, interval: int):
+        self.interval = interval
+        self.frames = 0
+        self.correct = 0
+        self.diff_sum = 0.0
+        self.squared_sum = 0.0
+        # Frames with a beat, and how far off in ms their predicted offset put it
+        self.beats = 0
+        self.offset_error_sum = 0.0
+
+    def add(self, predictions: np.ndarray, test_y: np.ndarray):
+        diffs = np.abs(test_y[:, 0] - predictions[:, 0])
+        self.correct += int(np.count_nonzero(is_in_range(diffs)))
+        self.diff_sum += float(np.sum(diffs))
+        self.squared_sum += float(np.sum((test_y - predictions) ** 2))
+        self.frames += len(predictions)
+
+        beats = test_y[:, 0] > 0
+        offset_diffs = np.clip(predictions[beats, OFFSET_INDEX], 0, 1) - test_y[beats, OFFSET_INDEX]
+        self.beats += int(np.count_nonzero(beats))
+        self.offset_error_sum += float(np.sum(np.abs(offset_diffs))) * self.interval
+
+    @property
+    def accuracy(self) -> float:
+        return round(self.correct / max(self.frames, 1) * 100, 2)
+
+    @property
+    def mse(self) -> float:
+        return round(self.squared_sum / max(self.frames * OUT_VEC_SIZE, 1), 4)
+
+    @property
+    def offset_error(self) -> float:
+        """Mean ms the beats are off by within their frame"""
+        return round(self.offset_error_sum / max(self.beats, 1), 1)
+
+
+def get_precision_model(io: IO, precision: str, feature_len: int) -> LiteModel:
+    """The converted model from next to the weights, or converted in memory when it hasn't been written yet"""
+    lite_path = get_lite_path(io.get("input_weights"), precision)
+    if os.path.isfile(lite_path):
+        return LiteModel(lite_path)
+    return LiteModel(model_content=convert_weights(io.get("input_weights"), precision, feature_len))
+
+
+def score_model(
+    model: Union[Sequential, StepModel], test_files: List[Preprocessed], interval: int
+) -> Tuple[Score, float]:
+    """Scores the model over all test files, along with the ms it took per frame it ran"""
+    score = Score(interval)
+    predict_time = 0.0
+    ran_frames = 0
+    for file in test_files:
+        skipped, resets = span_masks(len(file.features), file.silent_spans, interval)
+        start = 0
+        for test_x in iter_test_inputs(file, model.input_shape[1]):
+            end = start + len(test_x)
+            start_time = time.perf_counter()
+            predictions = predict_audible(model, test_x, skipped[start:end], resets[start:end])
+            predict_time += time.perf_counter() - start_time
+            ran_frames += len(test_x) - int(np.count_nonzero(skipped[start:end]))
+            score.add(predictions, get_test_outputs(file, start, end))
+            start = end
         model.reset_states()
+    return score, predict_time * 1000 / max(ran_frames, 1)
+
+
+def get_backend_name(model: Union[Sequential, StepModel]) -> str:
+    return "keras predict" if isinstance(model, Sequential) else model.backend
+
+
+def compare_precisions(io: IO, model: Sequential, test_files: List[Preprocessed], interval: int):
+    """Reports accuracy against speed for the loaded weights, run through Keras and compiled, and their conversions"""
+    weights_path = io.get("input_weights")
+    models: List[Tuple[str, Union[Sequential, StepModel], int]] = [
+        (get_backend_name(model), model, os.path.getsize(weights_path))
+    ]
+    precisions = io.get("compare_precisions").split(",")
+    if weights_path.endswith(LITE_EXTENSION):
+        # There are no weights to convert, only the loaded conversion gets scored
+        warn("input weights are already converted, skipping the conversions")
+        precisions = []
+    else:
+        other_model = load_model(weights_path, model.input_shape[1], isinstance(model, Sequential))
+        models.append((get_backend_name(other_model), other_model, os.path.getsize(weights_path)))
+    for precision in precisions:
+        precision = precision.strip()
+        if precision not in PRECISIONS:
+            warn('unknown precision "{}", choose one of {}'.format(precision, ", ".join(PRECISIONS)))
+            continue
+        logline("converting to {}".format(precision))
+        lite_model = get_precision_model(io, precision, model.input_shape[1])
+        models.append((precision, lite_model, lite_model.size))
+
+    for name, compared_model, size in models:
+        score, frame_ms = score_model(compared_model, test_files, interval)
+        logline(
+            "{}: mse {}, {}% within range, beat offset error {}ms, {}ms per frame, {}ms per single step, {}KB".format(
+                name,
+                score.mse,
+                score.accuracy,
+                score.offset_error,
+                round(frame_ms, 3),
+                round(step_latency(compared_model), 3),
+                round(size / 1024),
+            )
+        )
+
+
+def run_tests(io: IO, model: Sequential, test_files: List[Preprocessed], interval: int):
+    model.reset_states()
+    cache = create_cache(io, model)
 
-        mse_total: List[float] = list()
-        correct = 0
-        diff_score = 0
-        for i in range(len(predictions)):
-            prediction = predictions[i]
-            actual: List[float] = test_y[i]
+    analysis: Optional[AnalysisFile] = None
+    if io.get("analysis"):
+        analysis = AnalysisFile(io.get("analysis"))
 
-            diff = abs(actual[0] - prediction[0])
-            diff_score += diff
-            if is_in_range(diff):
-                correct += 1
+    pathlib.Path(io.get("output_annotated")).mkdir(parents=True, exist_ok=True)
+    for file in test_files:
+        logline("testing {}".format(file.file_name))
+        out_path = os.path.join(io.get("output_annotated"), "{}.json".format(file.file_name))
 
-            mse_total.append(mean_squared_error(actual, prediction))
+        score = Score(interval)
+        skipped, _ = span_masks(len(file.features), file.silent_spans, interval)
+        # Tempo tracking needs the whole track, it's only kept when that gets reported
+        kept: List[np.ndarray] = list()
+        with BeatFileWriter(out_path, interval) as writer:
+            for predictions in iter_predictions(model, cache, file, interval):
+                score.add(predictions, get_test_outputs(file, score.frames, score.frames + len(predictions)))
+
+                writer.add(predictions, skipped[writer.frames : writer.frames + len(predictions)])
+                if analysis:
+                    kept.append(predictions)
 
         logline(
-            "predicted {}/{} within range ({}%) correct, score was {}/{}, mse was {}".format(
-                correct,
-                len(predictions),
-                round(correct / len(predictions) * 100, 2),
-                diff_score,
-                len(predictions),
-                round(sum(mse_total) / len(predictions), 4),
+            "predicted {}/{} within range ({}%) correct, score was {}/{}, mse was {}, "
+            "beat offset error {}ms over {} beats".format(
+                score.correct,
+                score.frames,
+                score.accuracy,
+                score.diff_sum,
+                score.frames,
+                score.mse,
+                score.offset_error,
+                score.beats,
             )
         )
 
-        out_obj = predictions_to_out_file(predictions, io)
+        if analysis and kept:
+            report_tempo_tracking(np.concatenate(kept), file, analysis, interval, io)
+        logline("wrote object to {}".format(out_path))
 
-        pathlib.Path(io.get("output_annotated")).mkdir(parents=True, exist_ok=True)
-        out_path = os.path.join(io.get("output_annotated"), "{}.json".format(file.file_name))
-        with open(out_path, "w+") as out_file:
-            json.dump(out_obj, out_file)
-            logline("wrote object to {}".format(out_path))
+    if io.get("compare_precisions"):
+        logline("comparing precisions")
+        enter_group()
+        compare_precisions(io, model, test_files, interval)
+        exit_group()
 
 
 def mode_test():
@@ -172,18 +456,17 @@ def mode_test():
     logline("test")
     enter_group()
 
-    logline("reconstructing model")
-    model = create_model(1)
-
-    logline("applying learned weights")
-    model = apply_weights(model, io)
-
     logline("reading testing files")
-    test_files = read_test_files(io)
+    test_files, interval, frontend = read_test_files(io)
+    logline("testing at an interval of {}ms with a {} frontend".format(interval, frontend))
+
+    logline("loading model with learned weights")
+    model = load_model(io.get("input_weights"), frontend.length, not io.get("keras_predict"))
+    logline("warmed up in {}ms".format(round(warm_up(model), 1)))
 
     logline("running testing data")
     enter_group()
-    run_tests(io, model, test_files)
+    run_tests(io, model, test_files, interval)
     exit_group()
 
     exit_group()
@@ -1,9 +1,13 @@
 """Main entrypoint for train mode"""
 
-from ..features import Features, OUT_VEC_SIZE, Preprocessed
+from ..features import OUT_VEC_SIZE, BINS, Preprocessed
+from ..model import create_model, configure_threading, split_cpu, create_cpu_strategy
 from lib.log import debug, logline, enter_group, exit_group
-from typing import List, Tuple
-from ..model import create_model
+from ..silence import span_masks
+from ..frontend import FrontEnd, FRONTENDS
+from ..fingerprint import fingerprint, find_duplicates, get_dropped
+from ..dataset import load_dataset
+from typing import Dict, List, Optional, Tuple
 from lib.io import IO, IOInput
 from lib.timer import Timer
 import numpy as np
@@ -11,7 +15,6 @@ import datetime
 import warnings
 import pathlib
 import random
-import pickle
 import json
 import time
 import os
@@ -23,15 +26,19 @@ with warnings.catch_warnings():
     import tensorflow as tf
 
 
+# Shards a dataset needs before it's split by shard rather than by file, fewer make for a lopsided split
+MIN_SPLIT_SHARDS = 5
+
+
 def get_io() -> IO:
     return IO(
         {
             "i": IOInput(
-                "./data/preprocessed.pickle",
+                "./data/preprocessed/",
                 str,
                 has_input=True,
                 arg_name="input_file",
-                descr="Input preprocessed file",
+                descr="Input preprocessed dataset, a directory of shards or a .pickle file",
                 alias="input_file",
                 is_generic=True,
             ),
@@ -62,61 +69,172 @@ def get_io() -> IO:
             "b": IOInput(32, int, has_input=True, arg_name="batch_size", descr="The batch size", alias="batch_size"),
             "e": IOInput(10, int, has_input=True, arg_name="epochs", descr="The amount of epochs", alias="epochs"),
             "p": IOInput(False, bool, has_input=False, arg_name="profile", descr="Apply profiling", alias="profile"),
+            "n": IOInput(
+                0,
+                int,
+                has_input=True,
+                arg_name="interval",
+                descr="Interval to train at, a multiple of the dataset's (0 for the dataset's own)",
+                alias="interval",
+            ),
+            "f": IOInput(
+                "",
+                str,
+                has_input=True,
+                arg_name="frontend",
+                descr="Frontend to train with, one of {} (empty for the dataset's own)".format(", ".join(FRONTENDS)),
+                alias="frontend",
+            ),
+            "fb": IOInput(
+                BINS,
+                int,
+                has_input=True,
+                arg_name="bands",
+                descr="Bands a mel or log frontend pools the bins into",
+                alias="bands",
+            ),
+            "ti": IOInput(
+                0,
+                int,
+                has_input=True,
+                arg_name="intra_threads",
+                descr="Threads used within a single op (0 for TensorFlow's default)",
+                alias="intra_threads",
+            ),
+            "te": IOInput(
+                0,
+                int,
+                has_input=True,
+                arg_name="inter_threads",
+                descr="Ops that may run in parallel (0 for TensorFlow's default)",
+                alias="inter_threads",
+            ),
+            "w": IOInput(
+                1,
+                int,
+                has_input=True,
+                arg_name="workers",
+                descr="Local CPU replicas the batches are split across",
+                alias="workers",
+            ),
+            "bw": IOInput(
+                False,
+                bool,
+                has_input=False,
+                arg_name="benchmark_workers",
+                descr="Report samples/sec for 1 to <workers> replicas instead of training",
+                alias="benchmark_workers",
+            ),
+            "kd": IOInput(
+                False,
+                bool,
+                has_input=False,
+                arg_name="keep_duplicates",
+                descr="Keep near duplicate tracks, they still end up on the same side of the split",
+                alias="keep_duplicates",
+            ),
+            "bn": IOInput(
+                50,
+                int,
+                has_input=True,
+                arg_name="benchmark_batches",
+                descr="Batches trained per worker count when benchmarking",
+                alias="benchmark_batches",
+            ),
         }
     )
 
 
-def load_preprocessed(io: IO) -> List[Preprocessed]:
-    with open(io.get("input_file"), "rb") as in_file:
-        return list(map(lambda x: Preprocessed(x), pickle.load(in_file)))
-
-
-def output_split(all: List[Preprocessed], train: List[Preprocessed], io: IO):
+def output_split(all: List[Preprocessed], train: List[Preprocessed], io: IO, interval: int, frontend: FrontEnd):
+    test = list(filter(lambda x: x not in train, all))
     obj = {
         "training_set": list(map(lambda x: x.file_name, train)),
-        "test_set": list(map(lambda x: x.file_name, filter(lambda x: x not in train, all))),
+        "test_set": list(map(lambda x: x.file_name, test)),
+        "interval": interval,
+        "frontend": frontend.to_config(),
     }
+    if all and all[0].shard is not None:
+        obj["training_shards"] = sorted(set(x.shard for x in train))
+        obj["test_shards"] = sorted(set(x.shard for x in test))
     pathlib.Path(os.path.dirname(io.get("output_train"))).mkdir(parents=True, exist_ok=True)
     with open(io.get("output_train"), "w+") as out_file:
         json.dump(obj, out_file)
         logline("wrote training/testing config to {}".format(io.get("output_train")))
 
 
-def gen_split(preprocessed: List[Preprocessed], io: IO) -> List[Preprocessed]:
+def group_shards(preprocessed: List[Preprocessed]) -> List[List[Preprocessed]]:
+    """Splits into whole shards when there are enough of them, so testing never has to read training shards"""
+    shards: Dict[Optional[str], List[Preprocessed]] = dict()
+    for file in preprocessed:
+        shards.setdefault(file.shard, list()).append(file)
+    if None in shards or len(shards) < MIN_SPLIT_SHARDS:
+        return [[file] for file in preprocessed]
+    return list(shards.values())
+
+
+def merge_duplicates(groups: List[List[Preprocessed]], duplicates: List[List[str]]) -> List[List[Preprocessed]]:
+    """Merges groups holding duplicates of the same song, so they can't leak from the training into the test set"""
+    group_of = {file.file_name: i for i, group in enumerate(groups) for file in group}
+    merged_into = list(range(len(groups)))
+
+    def find(group: int) -> int:
+        while merged_into[group] != group:
+            group = merged_into[group]
+        return group
+
+    for names in duplicates:
+        first = find(group_of[names[0]])
+        for name in names[1:]:
+            other = find(group_of[name])
+            if other != first:
+                merged_into[other] = first
+
+    merged: Dict[int, List[Preprocessed]] = dict()
+    for i, group in enumerate(groups):
+        merged.setdefault(find(i), list()).extend(group)
+    return list(merged.values())
+
+
+def gen_split(
+    preprocessed: List[Preprocessed], io: IO, interval: int, frontend: FrontEnd, duplicates: List[List[str]]
+) -> List[Preprocessed]:
     split = io.get("split")
     if split == 100:
-        output_split(preprocessed, preprocessed, io)
+        output_split(preprocessed, preprocessed, io, interval, frontend)
         return preprocessed
 
-    shuffled = random.sample(preprocessed, len(preprocessed))
+    groups = merge_duplicates(group_shards(preprocessed), duplicates)
+    shuffled = random.sample(groups, len(groups))
 
     total_len = sum(map(lambda x: len(x.features), preprocessed))
     train_len = (total_len / 100.0) * split
 
     train_items = list()
     current_len = 0
-    for i in range(len(preprocessed) - 1):
-        new_len = current_len + len(shuffled[i].features)
+    for i in range(len(groups) - 1):
+        new_len = current_len + sum(len(x.features) for x in shuffled[i])
 
         if new_len >= train_len:
-            output_split(preprocessed, train_items, io)
+            output_split(preprocessed, train_items, io, interval, frontend)
             return train_items
 
         current_len = new_len
-        train_items.append(shuffled[i])
+        train_items.extend(shuffled[i])
 
-    output_split(preprocessed, train_items, io)
+    output_split(preprocessed, train_items, io, interval, frontend)
     return train_items
 
 
-def gen_fit_params(preprocessed: List[Preprocessed]) -> Tuple[np.ndarray, np.ndarray]:
+def gen_fit_params(preprocessed: List[Preprocessed], interval: int) -> Tuple[np.ndarray, np.ndarray]:
     shuffled = random.sample(preprocessed, len(preprocessed))
 
     train_x = list()
     train_y = list()
     for i in range(len(shuffled)):
-        train_x = train_x + shuffled[i].features
-        train_y = train_y + shuffled[i].outputs
+        # Silence carries no beats, skipping it saves time and keeps the model from learning it
+        skipped, _ = span_masks(len(shuffled[i].features), shuffled[i].silent_spans, interval)
+        train_x.extend(frame for frame, skip in zip(shuffled[i].features, skipped) if not skip)
+        train_y.extend(output for output, skip in zip(shuffled[i].outputs, skipped) if not skip)
 
     x_np = np.array(train_x)
     y_np = np.array(train_y)
@@ -130,7 +248,7 @@ def gen_fit_params(preprocessed: List[Preprocessed]) -> Tuple[np.ndarray, np.nda
     y_shape_1, y_shape_2 = y_np.shape
 
     assert x_shape_1 == y_shape_1
-    assert x_shape_2 == Features.length()
+    assert x_shape_2 == len(preprocessed[0].features[0])
     assert y_shape_2 == OUT_VEC_SIZE
 
     return x_np, y_np
@@ -149,20 +267,105 @@ def trim_params(params: Tuple[np.ndarray, np.ndarray], io: IO) -> Tuple[np.ndarr
     return x_param[:-remainder], y_param[:-remainder]
 
 
-def fit_model(io: IO, model: Sequential, preprocessed: List[Preprocessed]):
+class ThroughputLogger(tf.keras.callbacks.Callback):
+    """Logs the amount of samples trained on per second"""
+
+    def __init__(self, samples: int):
+        super().__init__()
+        self.samples = samples
+        self.samples_per_sec = 0.0
+        self._start_time = 0.0
+
+    def on_epoch_begin(self, epoch: int, logs=None):
+        self._start_time = time.time()
+
+    def on_epoch_end(self, epoch: int, logs=None):
+        self.samples_per_sec = self.samples / (time.time() - self._start_time)
+        logline("trained at {} samples/sec".format(round(self.samples_per_sec, 1)))
+
+
+def build_model(io: IO, strategy: tf.distribute.Strategy, feature_len: int, stateful: bool = True) -> Sequential:
+    batch_size = io.get("batch_size")
+    replicas = strategy.num_replicas_in_sync
+    assert batch_size % replicas == 0, "batch size has to be divisible by the amount of workers"
+
+    # Keras splits every global batch across the replicas. Stateful RNNs
+    # can't be mirrored, the weights are the same either way so the
+    # stateful inference model can still load them
+    with strategy.scope():
+        return create_model(
+            batch_size=batch_size // replicas, stateful=stateful and replicas == 1, feature_len=feature_len
+        )
+
+
+def benchmark_workers(io: IO, devices: List[str], preprocessed: List[Preprocessed], interval: int, frontend: FrontEnd):
+    batches = io.get("benchmark_batches")
+    batch_size = io.get("batch_size")
+
+    train_x, train_y = trim_params(gen_fit_params(preprocessed, interval), io)
+    train_x, train_y = train_x[: batches * batch_size], train_y[: batches * batch_size]
+
+    base_samples_per_sec = 0.0
+    for workers in range(1, len(devices) + 1):
+        if batch_size % workers != 0:
+            logline("skipping {} workers, batch size {} is not divisible by it".format(workers, batch_size))
+            continue
+
+        # Stateless for every worker count so the numbers are comparable
+        model = build_model(io, create_cpu_strategy(devices[:workers]), frontend.length, stateful=False)
+
+        # Warm up first so graph tracing doesn't count towards throughput
+        model.fit(train_x[:batch_size], train_y[:batch_size], batch_size=batch_size, epochs=1, verbose=0)
+        model.reset_states()
+
+        throughput = ThroughputLogger(len(train_x))
+        model.fit(train_x, train_y, batch_size=batch_size, epochs=1, shuffle=False, verbose=0, callbacks=[throughput])
+
+        if base_samples_per_sec == 0.0:
+            base_samples_per_sec = throughput.samples_per_sec
+        logline(
+            "{} worker(s): {} samples/sec, {}x speedup".format(
+                workers,
+                round(throughput.samples_per_sec, 1),
+                round(throughput.samples_per_sec / base_samples_per_sec, 2),
+            )
+        )
+
+
+def get_duplicates(io: IO, preprocessed: List[Preprocessed]) -> Tuple[List[Preprocessed], List[List[str]]]:
+    """Drops near duplicate tracks, or only finds them when they're kept"""
+    groups = find_duplicates(
+        [file.file_name for file in preprocessed], [fingerprint(file.features) for file in preprocessed]
+    )
+    for group in groups:
+        logline('"{}" hold the same song'.format('", "'.join(group)))
+    if io.get("keep_duplicates"):
+        return preprocessed, groups
+
+    dropped = get_dropped(groups)
+    logline("dropped {} duplicate files".format(len(dropped)))
+    return [file for file in preprocessed if file.file_name not in dropped], list()
+
+
+def fit_model(io: IO, model: Sequential, preprocessed: List[Preprocessed], interval: int, frontend: FrontEnd):
     epochs = io.get("epochs")
     model.reset_states()
 
+    logline("finding duplicate tracks")
+    enter_group()
+    preprocessed, duplicates = get_duplicates(io, preprocessed)
+    exit_group()
+
     logline("splitting into training set and testing set ({}%)".format(io.get("split")))
-    split = gen_split(preprocessed, io)
+    split = gen_split(preprocessed, io, interval, frontend, duplicates)
 
     log_dir = "logs/" + datetime.datetime.now().strftime("%Y%m%d-%H%M%S")
     for i in range(epochs):
         logline("generating input and expected data for epoch {}/{}".format(i + 1, epochs))
-        train_x, train_y = trim_params(gen_fit_params(split), io)
+        train_x, train_y = trim_params(gen_fit_params(split, interval), io)
 
         logline("training epoch {}/{}".format(i + 1, epochs))
-        callbacks = []
+        callbacks: List[tf.keras.callbacks.Callback] = [ThroughputLogger(len(train_x))]
         if io.get("profile"):
             debug("profiling")
             callbacks.append(tf.keras.callbacks.TensorBoard(log_dir=log_dir, histogram_freq=1))
@@ -183,20 +386,33 @@ def mode_train():
 
     io = get_io()
 
+    configure_threading(io.get("intra_threads"), io.get("inter_threads"))
+    devices = split_cpu(io.get("workers"))
+
     logline("using GPU?", tf.test.is_gpu_available())
 
     logline("train")
     enter_group()
 
     logline("loading preprocessed data")
-    preprocessed = load_preprocessed(io)
+    frontend = FrontEnd(io.get("frontend"), io.get("bands")) if io.get("frontend") else None
+    preprocessed, interval, frontend = load_dataset(io.get("input_file"), io.get("interval"), frontend)
+    logline("training at an interval of {}ms with a {} frontend".format(interval, frontend))
+
+    if io.get("benchmark_workers"):
+        logline("benchmarking 1 to {} workers".format(len(devices)))
+        enter_group()
+        benchmark_workers(io, devices, preprocessed, interval, frontend)
+        exit_group()
+        exit_group()
+        return
 
     logline("creating models")
-    train_model = create_model(batch_size=io.get("batch_size"))
+    train_model = build_model(io, create_cpu_strategy(devices), frontend.length)
 
     logline("fitting model")
     enter_group()
-    fit_model(io, train_model, preprocessed)
+    fit_model(io, train_model, preprocessed, interval, frontend)
     exit_group()
 
     logline("exporting model")
@@ -0,0 +1,357 @@
+"""Main entrypoint for tune mode"""
+
+from ..realtime_test.serving import ServingConfig, save_serving_config, SERVING_CONFIG
+from lib.log import logline, enter_group, exit_group, debug, warn, error
+from ..realtime_test.sessions import Session, MAX_SESSIONS
+from ..realtime_test import realtime_test
+from multiprocessing.connection import Connection
+from typing import Dict, List, Optional, Tuple
+from ..frontend import FrontEnd, load_frontend
+from ..inference import LITE_EXTENSION
+from ..model import configure_threading
+from ..features import INTERVAL, BINS
+from lib.io import IO, IOInput
+from lib.timer import Timer
+import multiprocessing
+import numpy as np
+import threading
+import time
+import os
+
+
+def get_io() -> IO:
+    return IO(
+        {
+            "iw": IOInput(
+                "./data/weights.h5",
+                str,
+                has_input=True,
+                arg_name="input_weights",
+                descr="Input weights file, or a .tflite model written by quantize mode",
+                alias="input_weights",
+            ),
+            "it": IOInput(
+                "./data/train_config.json",
+                str,
+                has_input=True,
+                arg_name="input_train",
+                descr="Train config, holds the frontend the model was trained with",
+                alias="input_train",
+            ),
+            "n": IOInput(
+                INTERVAL,
+                int,
+                has_input=True,
+                arg_name="interval",
+                descr="Interval at which every session sends a frame",
+                alias="interval",
+            ),
+            "o": IOInput(
+                SERVING_CONFIG,
+                str,
+                has_input=True,
+                arg_name="output_config",
+                descr="File the best serving config gets written to, realtime_test reads it when it starts",
+                alias="output_config",
+            ),
+            "s": IOInput(
+                0.5,
+                float,
+                has_input=True,
+                arg_name="slo",
+                descr="Share of the interval the latency percentile has to stay below",
+                alias="slo",
+            ),
+            "q": IOInput(
+                99.0,
+                float,
+                has_input=True,
+                arg_name="percentile",
+                descr="Latency percentile that has to stay within the SLO",
+                alias="percentile",
+            ),
+            "w": IOInput(
+                "",
+                str,
+                has_input=True,
+                arg_name="workers",
+                descr="Comma separated worker counts to try (empty for powers of two up to the core count)",
+                alias="workers",
+            ),
+            "ti": IOInput(
+                "",
+                str,
+                has_input=True,
+                arg_name="intra_threads",
+                descr="Comma separated threads per op to try (empty for powers of two up to the core count)",
+                alias="intra_threads",
+            ),
+            "mb": IOInput(
+                "1,4,16",
+                str,
+                has_input=True,
+                arg_name="batch_sizes",
+                descr="Comma separated micro-batch sizes to try",
+                alias="batch_sizes",
+            ),
+            "bd": IOInput(
+                "0,2,5",
+                str,
+                has_input=True,
+                arg_name="batch_deadlines",
+                descr="Comma separated ms a frame may wait for a batch to fill, tried with every batch size above 1",
+                alias="batch_deadlines",
+            ),
+            "d": IOInput(
+                3.0,
+                float,
+                has_input=True,
+                arg_name="duration",
+                descr="Seconds every trial runs for",
+                alias="duration",
+            ),
+            "ms": IOInput(
+                MAX_SESSIONS,
+                int,
+                has_input=True,
+                arg_name="max_sessions",
+                descr="Most sessions tried on the whole machine",
+                alias="max_sessions",
+            ),
+        }
+    )
+
+
+def parse_counts(value: str, limit: int) -> List[int]:
+    """The numbers in a comma separated list, or the powers of two up to **limit** when it's empty"""
+    if value.strip():
+        return sorted(set(int(count) for count in value.split(",") if count.strip()))
+    return [2**i for i in range(limit.bit_length()) if 2**i <= limit]
+
+
+def parse_deadlines(value: str) -> List[float]:
+    return sorted(set(float(deadline) for deadline in value.split(",") if deadline.strip())) or [0.0]
+
+
+class Listener(threading.Thread):
+    """A simulated session, running a synthetic frame through the realtime prediction path every interval"""
+
+    def __init__(self, session_id: str, interval: int, start_at: float, stop_at: float):
+        super().__init__(daemon=True)
+        self.session = Session(session_id)
+        self.interval = interval / 1000
+        self.start_at = start_at
+        self.stop_at = stop_at
+        # Loud enough that the silence gate never skips the model
+        self.frames = np.random.uniform(0.2, 1, (16, 1, BINS)).astype(np.float32)
+        self.latencies: List[float] = list()
+        self.late_sends = 0
+
+    def run(self):
+        next_send = self.start_at
+        index = 0
+        while next_send < self.stop_at:
+            delay = next_send - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+            elif delay < -self.interval:
+                skipped = int(-delay / self.interval)
+                self.late_sends += skipped
+                next_send += skipped * self.interval
+
+            start_time = time.perf_counter()
+            realtime_test.predict(self.session, self.frames[index % len(self.frames)])
+            self.latencies.append(time.perf_counter() - start_time)
+            index += 1
+            next_send += self.interval
+
+
+def simulate(sessions: int, interval: int, duration: float) -> Tuple[List[float], int]:
+    """Latencies in ms of every frame the sessions sent and how many sends were skipped for being late"""
+    start_at = time.perf_counter() + 0.1
+    stop_at = start_at + duration
+    # Spread over a single interval so they don't all send at once
+    listeners = [
+        Listener("tune-{}".format(i), interval, start_at + interval / 1000 * i / sessions, stop_at)
+        for i in range(sessions)
+    ]
+    for listener in listeners:
+        listener.start()
+    for listener in listeners:
+        listener.join()
+    latencies = [latency * 1000 for listener in listeners for latency in listener.latencies]
+    return latencies, sum(listener.late_sends for listener in listeners)
+
+
+def run_tune_worker(io: IO, frontend: FrontEnd, intra_threads: int, connection: Connection):
+    """Loads the model once, then runs every trial it's sent until it gets None"""
+    configure_threading(intra_threads, 1)
+    realtime_test.configure_serving(io.get("interval"), frontend, ServingConfig(intra_threads=intra_threads))
+    realtime_test.load_serving_model(io.get("input_weights"))
+    connection.send(None)
+
+    while True:
+        trial = connection.recv()
+        if trial is None:
+            break
+        batch_size, batch_deadline, sessions = trial
+        realtime_test.configure_serving(
+            io.get("interval"), frontend, ServingConfig(1, intra_threads, batch_size, batch_deadline)
+        )
+        realtime_test.start_batcher()
+        connection.send(simulate(sessions, io.get("interval"), io.get("duration")) if sessions > 0 else ([], 0))
+    connection.close()
+
+
+class WorkerGroup:
+    """Worker processes with their own model and threads, like the realtime server forks them"""
+
+    def __init__(self, io: IO, frontend: FrontEnd, workers: int, intra_threads: int):
+        # TensorFlow hasn't run in this process, so forking is safe
+        context = multiprocessing.get_context("fork")
+        self.connections: List[Connection] = list()
+        self.processes: List[multiprocessing.Process] = list()
+        for _ in range(workers):
+            parent_connection, child_connection = context.Pipe()
+            process = context.Process(
+                target=run_tune_worker, args=(io, frontend, intra_threads, child_connection), daemon=True
+            )
+            process.start()
+            self.connections.append(parent_connection)
+            self.processes.append(process)
+        for connection in self.connections:
+            connection.recv()
+
+    def run(self, batch_size: int, batch_deadline: float, sessions: int) -> Tuple[np.ndarray, int, int]:
+        """Spreads the sessions over the workers, returns the latencies of all of them, the frames sent and
+        the sends skipped"""
+        workers = len(self.connections)
+        for i, connection in enumerate(self.connections):
+            connection.send((batch_size, batch_deadline, sessions // workers + (i < sessions % workers)))
+        results = [connection.recv() for connection in self.connections]
+        latencies = np.array([latency for worker_latencies, _ in results for latency in worker_latencies])
+        return latencies, len(latencies), sum(late_sends for _, late_sends in results)
+
+    def close(self):
+        for connection in self.connections:
+            connection.send(None)
+        for process in self.processes:
+            process.join()
+
+
+def find_capacity(io: IO, group: WorkerGroup, batch_size: int, batch_deadline: float) -> Tuple[int, Optional[float]]:
+    """The most sessions the group sustains with the latency percentile within the SLO, doubling them until
+    it breaks and then searching in between. Returns them with the latency percentile they ran at"""
+    budget = io.get("slo") * io.get("interval")
+    percentile = io.get("percentile")
+    results: Dict[int, Tuple[bool, float]] = dict()
+
+    def passes(sessions: int) -> bool:
+        latencies, sent, late_sends = group.run(batch_size, batch_deadline, sessions)
+        latency = float(np.percentile(latencies, percentile)) if sent else float("inf")
+        # Skipped sends never show up in the latencies, too many of them means it didn't keep up either
+        passed = latency <= budget and late_sends <= (sent + late_sends) * (100 - percentile) / 100
+        debug(
+            "{} sessions: p{:g} {:.1f}ms, {} late sends, {}".format(
+                sessions, percentile, latency, late_sends, "held" if passed else "broke"
+            )
+        )
+        results[sessions] = (passed, latency)
+        return passed
+
+    low, high = 0, io.get("max_sessions") + 1
+    sessions = min(len(group.connections), io.get("max_sessions"))
+    while sessions < high:
+        if not passes(sessions):
+            high = sessions
+            break
+        low = sessions
+        sessions *= 2
+    # Within an eighth is close enough, every trial takes a while
+    while high - low > max(low // 8, 1):
+        middle = (low + high) // 2
+        if passes(middle):
+            low = middle
+        else:
+            high = middle
+    return low, results[low][1] if low in results else None
+
+
+def get_trials(io: IO) -> List[Tuple[int, float]]:
+    """Every batch size with every deadline, batches of 1 never wait"""
+    batch_sizes = parse_counts(io.get("batch_sizes"), 1)
+    if io.get("input_weights").endswith(LITE_EXTENSION) and any(batch_size > 1 for batch_size in batch_sizes):
+        warn("only the compiled step model runs batches, a .tflite model is tuned without them")
+        batch_sizes = [1]
+    deadlines = parse_deadlines(io.get("batch_deadlines"))
+    return [
+        (batch_size, deadline) for batch_size in batch_sizes for deadline in (deadlines if batch_size > 1 else [0.0])
+    ]
+
+
+def mode_tune() -> int:
+    """The main tune entrypoint"""
+    start_time = time.time()
+
+    io = get_io()
+
+    logline("tune")
+    enter_group()
+
+    cores = os.cpu_count() or 1
+    frontend = load_frontend(io.get("input_train"))
+    budget = io.get("slo") * io.get("interval")
+    logline(
+        "finding the most sessions with p{:g} under {}ms on {} cores with a {} frontend".format(
+            io.get("percentile"), round(budget, 1), cores, frontend
+        )
+    )
+
+    trials = get_trials(io)
+    best: Optional[Tuple[int, float, ServingConfig]] = None
+    for workers in parse_counts(io.get("workers"), cores):
+        for intra_threads in parse_counts(io.get("intra_threads"), cores):
+            if workers * intra_threads > cores:
+                debug(
+                    "skipping {} workers with {} threads, that's more than {} cores".format(
+                        workers, intra_threads, cores
+                    )
+                )
+                continue
+            group = WorkerGroup(io, frontend, workers, intra_threads)
+            for batch_size, batch_deadline in trials:
+                config = ServingConfig(workers, intra_threads, batch_size, batch_deadline)
+                logline("trying {}".format(config))
+                enter_group()
+                sessions, latency = find_capacity(io, group, batch_size, batch_deadline)
+                exit_group()
+                if latency is None:
+                    logline("not even {} sessions stayed within {}ms".format(workers, round(budget, 1)))
+                    continue
+                logline("sustained {} sessions, p{:g} {:.1f}ms".format(sessions, io.get("percentile"), latency))
+                if best is None or (sessions, -latency) > (best[0], -best[1]):
+                    best = (sessions, latency, config)
+            group.close()
+
+    if best is None:
+        error("no configuration kept p{:g} under {}ms".format(io.get("percentile"), round(budget, 1)))
+        exit_group()
+        return 1
+
+    sessions, latency, config = best
+    config.tuned = {
+        "interval": io.get("interval"),
+        "sessions": sessions,
+        "percentile": io.get("percentile"),
+        "latency": round(latency, 2),
+        "slo": io.get("slo"),
+        "cores": cores,
+        "weights": io.get("input_weights"),
+    }
+    save_serving_config(io.get("output_config"), config)
+    logline("best is {}, sustaining {} sessions".format(config, sessions))
+    logline('wrote serving config to "{}"'.format(io.get("output_config")))
+
+    exit_group()
+    logline("done tuning, runtime is {}".format(Timer.stringify_time(Timer.format_time(time.time() - start_time))))
+    return 0